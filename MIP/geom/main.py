@@ -18,41 +18,24 @@ def extract_surfaces(ast):
     """
     Return set of surfaces used in ast.
     """
-    if isinstance(ast, Surface):
-        return set((abs(ast), ))
-    elif isinstance(ast, Cell):
-        return set()
-
-    s = set()
-    if isinstance(ast[1], tuple):
-        s.update(extract_surfaces(ast[1]))
-    else:
-        s.add(abs(ast[1]))
-    if isinstance(ast[2], tuple):
-        s.update(extract_surfaces(ast[2]))
-    else:
-        s.add(abs(ast[2]))
-    return s
+    return set(abs(surf) for surf in extract_surfaces_list(ast))
 
 
 def extract_surfaces_list(ast):
     """
-    Return set of surfaces used in ast.
+    Return list of surfaces used in ast.
     """
-    if isinstance(ast, Surface):
-        return [ast]
-    elif isinstance(ast, Cell):
-        return []
-
     l = []
-    if isinstance(ast[1], tuple):
-        l.extend(extract_surfaces_list(ast[1]))
-    else:
-        l.append(ast[1])
-    if isinstance(ast[2], tuple):
-        l.extend(extract_surfaces_list(ast[2]))
-    else:
-        l.append(ast[2])
+    to_visit = [ast]
+    while to_visit:
+        node = to_visit.pop()
+        if isinstance(node, Surface):
+            l.append(node)
+        elif isinstance(node, tuple):
+            if node[0] != '^':
+                to_visit.extend(reversed(node[1:]))
+        elif not isinstance(node, Cell):
+            l.append(node)
     return l
 
 def replace_surfaces(ast, dic):
@@ -63,22 +63,56 @@ class Surface:
         # required to use Surfaces as dictionary keys or set elements
         return hash((self.surface, self.sub))
 
+
+# De Morgan: the operator of the inverse of a union/intersection
+FLIP = {'*': ':', ':': '*'}
+
+
 class GeomExpression(tuple):
     """
-    Any binary operation. Can be inversed.
+    Any n-ary operation. Can be inversed.
+
+    The operands of a union (intersection) node are never unions
+    (intersections) themselves; use :meth:`join` to build nodes.
     """
 
+    @classmethod
+    def join(cls, op, args):
+        """
+        Return the node applying `op` to `args`, flattening the operands
+        that apply the same operator.
+        """
+        l = [op]
+        for arg in args:
+            if isinstance(arg, GeomExpression) and arg[0] == op:
+                l.extend(arg[1:])
+            else:
+                l.append(arg)
+        return cls(l)
+
     def inverse(self):
-        if self[0] == '*':
-            return GeomExpression((':', self[1].inverse(), self[2].inverse()))
-        elif self[0] == ':':
-            return GeomExpression(('*', self[1].inverse(), self[2].inverse()))
-        else:
+        if self[0] not in FLIP:
             return self[0].inverse()
+        # explicit stack instead of recursion, for deeply nested expressions
+        stack = [(self, iter(self[1:]), [FLIP[self[0]]])]
+        while True:
+            node, args, l = stack[-1]
+            for a in args:
+                if isinstance(a, GeomExpression) and a[0] in FLIP:
+                    stack.append((a, iter(a[1:]), [FLIP[a[0]]]))
+                    break
+                l.append(a.inverse())
+            else:
+                stack.pop()
+                e = GeomExpression(l)
+                if not stack:
+                    return e
+                stack[-1][2].append(e)
 
     def evaluate(self):
         if self[0] in '*:':
-            return '({} {} {})'.format(self[1].evaluate(), self[0], self[2].evaluate())
+            op = ' {} '.format(self[0])
+            return '({})'.format(op.join(a.evaluate() for a in self[1:]))
         else:
             return str(self[0])
 
@@ -111,14 +145,12 @@ class GeomSemantics:
 
     def isect(self, ast):
         if ast.o == '*':
-            e = GeomExpression(('*', ast.l, ast.r))
-            return e
+            return GeomExpression.join('*', (ast.l, ast.r))
         else:
             return ast.o
 
     def union(self, ast):
         if ast.o == ':':
-            e = GeomExpression((':', ast.l, ast.r))
-            return e
+            return GeomExpression.join(':', (ast.l, ast.r))
         else:
             return ast.o
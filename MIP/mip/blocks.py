@@ -61,13 +61,17 @@ def get_block_positions(text, firstblock=None):
     """
     Returns a dictionary with tuple of indices that identify block start and
     end lines.
+
+    The text can also be a bytes-like object, e.g. a memory map of the input
+    file in an ASCII-compatible encoding.
     """
 
     # Resulting dictionary
     dres = {}
 
     # Regular expresison for blank line delimiter
-    bld = re.compile('^\s*$', re.MULTILINE)
+    binary = not isinstance(text, str)
+    bld = re.compile(br'^\s*$' if binary else '^\s*$', re.MULTILINE)
 
     # Re.split() does not split on empty matches. Therefore, match positions
     # are searched and blocks are build manually.
@@ -87,7 +91,8 @@ def get_block_positions(text, firstblock=None):
     # Line count. Starts form 1, to be consistent with vim's G
     line = 1
     # Check if message block exists
-    if text[:20].split()[0].lower() == 'message:':
+    message = b'message:' if binary else 'message:'
+    if text[:20].split()[0].lower() == message:
         dres['m'] = bi[0], line
         line += utils.nol(text, *bi[0])
         bi.pop(0)
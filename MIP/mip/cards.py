@@ -10,6 +10,12 @@ re_comment = re.compile(r'^\s{0,4}[cC](\s|$)')
 re_continuation_spaces = re.compile(r'^\s{5,}')
 re_continuation_prev = re.compile(r'[^$]*&\s*($|\$.*$)')
 
+# Same, for the encoded input file
+re_comment_bytes = re.compile(re_comment.pattern.encode())
+re_continuation_spaces_bytes = re.compile(
+    re_continuation_spaces.pattern.encode())
+re_continuation_prev_bytes = re.compile(re_continuation_prev.pattern.encode())
+
 
 # Function used at two places below
 def _yield(c1, n1, f, c2, n2):
@@ -80,6 +86,87 @@ def get_cards(block, skipcomments=False):
         yield r
 
 
+def index_cards(text, start=0, end=None):
+    r"""
+    Split the block ``text[start:end]`` of the encoded input file into cards,
+    in a single pass over its lines.
+
+    `text` is a bytes-like object (for instance a memory map of the input
+    file) in an ASCII-compatible encoding; the lines can end with '\n' or
+    '\r\n'. Return a list of ``(type, n, start, end, comments)`` tuples, one
+    for each element that `get_cards` would return with
+    ``skipcomments=False``: `type` is 'card' or 'cmnt', `n` is the line number
+    in the block where the element starts, `start` and `end` are the offsets
+    in `text` of the beginning of its first line and of the end of its last
+    line, and `comments` tells whether the element contains c-comment lines.
+
+    >>> text = b'c b-comment\n1 0 -1\nc c-comment\n     2\n2 0 1\n'
+    >>> for t, n, s, e, c in index_cards(text):
+    ...     print(t, n, c, text[s:e].splitlines())
+    cmnt 0 True [b'c b-comment']
+    card 1 True [b'1 0 -1', b'c c-comment', b'     2']
+    card 4 False [b'2 0 1']
+    """
+    if end is None:
+        end = len(text)
+    res = []
+    # Current card and current block of comments, as [n, start, end, comments]
+    card = None
+    cmnt = None
+    lprev = None  # previous card line
+    n = 0
+    pos = start
+    while pos < end:
+        eol = text.find(b'\n', pos, end)
+        if eol < 0:
+            eol = end
+        nxt = eol + 1
+        if eol > pos and text[eol - 1] == 13:  # '\r'
+            eol -= 1
+        l = text[pos:eol]
+        if re_comment_bytes.match(l):
+            if cmnt is None:
+                cmnt = [n, pos, eol, True]
+            else:
+                cmnt[2] = eol
+        elif _is_continuation(l, lprev):
+            if card is None:
+                card = cmnt or [n, pos, eol, False]
+            card[2] = eol
+            card[3] = card[3] or cmnt is not None
+            cmnt = None
+            lprev = l
+        else:
+            if card is not None:
+                res.append(('card',) + tuple(card))
+            if cmnt is not None:
+                res.append(('cmnt',) + tuple(cmnt))
+            cmnt = None
+            card = [n, pos, eol, False]
+            lprev = l
+        n += 1
+        pos = nxt
+    if card is not None:
+        res.append(('card',) + tuple(card))
+    if cmnt is not None:
+        res.append(('cmnt',) + tuple(cmnt))
+    return res
+
+
+def _is_continuation(l, prev):
+    """
+    Same as `is_continuation`, for encoded lines; avoid expanding the tabs
+    when possible.
+    """
+    head = l[:5]
+    if len(head) == 5 and head.isspace() and b'\t' not in head:
+        return True
+    if b'\t' in l and re_continuation_spaces_bytes.match(l.expandtabs(8)):
+        return True
+    return bool(prev and b'&' in prev
+                and re_continuation_prev_bytes.match(prev))
+
+
 def expand_tabs(line):
     r'''Expand tabs in a line.
 
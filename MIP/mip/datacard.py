@@ -4,6 +4,9 @@ Split data card into its name, type and the rest parameters.
 """
 
 import re
+from bisect import bisect_left
+
+import numpy as np
 
 re_data = re.compile('^\s*(\**[a-zA-Z]+[^0-9]*)([0-9]*)(.*)$')
 
@@ -12,12 +15,15 @@ def split(txt):
     return m.groups()
 
 
+_SPECIFIERS = frozenset('rimjgRIMJG')
+_CANDIDATES = _SPECIFIERS | frozenset(' \t\n\r\f\v')
+
+
 def expand_data_card(tokens, *, expected=None, dtype='float'):
     '''Expand the numerical data described by `tokens` into a full list of
     numbers, without any abbreviation.
 
-    :param list(str) tokens: a list of tokens to convert, as strings, in
-        reverse order.
+    :param list(str) tokens: a list of tokens to convert, as strings.
     :param expected: the number of expected arguments, or `None` if as many
         tokens as possible should be parsed.
     :param str dtype: the type of the elements of the resulting list, as a
@@ -66,43 +72,196 @@ def expand_data_card(tokens, *, expected=None, dtype='float'):
     ...                  dtype='int', expected=5)
     ([1, 2, 3, 4, 12], 4)
     '''
-    if dtype == 'int':
-        conv = round
-    elif dtype == 'float':
-        conv = float
-    else:
+    _check_dtype(dtype)
+    values, jumps, consumed = _expand(tokens, expected)
+    if jumps is None:
+        return _convert(values, dtype).tolist(), consumed
+    result = _convert(np.where(jumps, 0.0, values), dtype).tolist()
+    for index in np.flatnonzero(jumps).tolist():
+        result[index] = None
+    return result, consumed
+
+
+def expand_data_array(tokens, *, expected=None, dtype='float'):
+    '''Expand the numerical data described by `tokens` into a NumPy array.
+
+    This is the vectorized counterpart of :func:`expand_data_card`, meant for
+    long data (lattice fills, importance cards): the runs of plain numbers are
+    converted in bulk and the abbreviations are expanded with NumPy. Jumps
+    (``nJ``) are represented as NaNs, and are not allowed if `dtype` is
+    ``'int'``.
+
+    :returns: a pair consisting of an array of expanded data, with type
+        `dtype`, and the number of tokens consumed.
+    :rtype: (numpy.ndarray, int)
+
+    >>> values, consumed = expand_data_array(['1', '2R', '2I', '2.5'])
+    >>> values.tolist(), consumed
+    ([1.0, 1.0, 1.0, 1.5, 2.0, 2.5], 4)
+    >>> values, consumed = expand_data_array(['3', '4r', '2', 'other'],
+    ...                                      dtype='int', expected=6)
+    >>> values.dtype, values.tolist(), consumed
+    (dtype('int64'), [3, 3, 3, 3, 3, 2], 3)
+    >>> expand_data_array(['0.1', '2j', '0.8'])[0].tolist()
+    [0.1, nan, nan, 0.8]
+    >>> expand_data_array(['1', 'j'], dtype='int')
+    Traceback (most recent call last):
+        ...
+    ValueError: "j" data specifier cannot be used with integer data
+    '''
+    _check_dtype(dtype)
+    values, jumps, consumed = _expand(tokens, expected)
+    if jumps is not None and dtype == 'int':
+        raise ValueError('"j" data specifier cannot be used with integer '
+                         'data')
+    return _convert(values, dtype), consumed
+
+
+def _check_dtype(dtype):
+    if dtype not in ('int', 'float'):
         raise ValueError('unrecognized dtype: {}'.format(dtype))
 
-    result = []
-    tokens = [token.strip().lower() for token in reversed(tokens)]
-    consumed = 0
-    while tokens and (expected is None or len(result) < expected):
-        token = tokens.pop()
-        consumed += 1
+
+def _convert(values, dtype):
+    '''Convert an array of floats to `dtype`, rounding to the nearest integer
+    (half to even, like :func:`round`) if necessary.'''
+    if dtype == 'float':
+        return values
+    if not np.isfinite(values).all():
+        raise ValueError('cannot convert non-finite data to integers')
+    return np.rint(values).astype(np.int64)
+
+
+def _expand(tokens, expected):
+    '''Expand `tokens` as floats.
+
+    :returns: the array of expanded values, a boolean array marking the jumps
+        (or `None` if there are no jumps) and the number of tokens consumed.
+    '''
+    # tokens ending with whitespace are candidates too
+    candidates = [i for i, token in enumerate(tokens)
+                  if token[-1:] in _CANDIDATES]
+    specials = [i for i in candidates
+                if tokens[i].rstrip()[-1:] in _SPECIFIERS]
+    repeats = [i for i in specials if tokens[i].rstrip()[-1] in 'rR']
+    others = [i for i in specials if tokens[i].rstrip()[-1] not in 'rR']
+    others.append(len(tokens))
+    chunks = []
+    masks = []
+    size = 0
+    last = None     # the last value, or None at the start or after a jump
+    pos = 0
+    for special in others:
+        if pos < special and (expected is None or size < expected):
+            run_repeats = repeats[bisect_left(repeats, pos):
+                                  bisect_left(repeats, special)]
+            chunk, mask, consumed, last = _expand_run(
+                tokens[pos:special], [i - pos for i in run_repeats], last,
+                size, None if expected is None else expected - size)
+            chunks.append(chunk)
+            masks.append(mask)
+            size += len(chunk)
+            pos += consumed
+        if pos < special or special == len(tokens):
+            break
+        if expected is not None and size >= expected:
+            break
+        token = tokens[special].strip().lower()
+        pos = special + 1
         last_char = token[-1]
-        if last_char == 'r':
-            n_reps = int(token[:-1]) if len(token) > 1 else 1
-            result.extend([result[-1]]*n_reps)
-        elif last_char == 'i':
-            result.extend(linspace(result[-1], tokens.pop(), token))
-            consumed += 1
+        if last_char == 'j':
+            n_reps = max(int(token[:-1]), 0) if len(token) > 1 else 1
+            chunk = np.full(n_reps, np.nan)
+            mask = np.ones(n_reps, dtype=bool)
+        elif last is None:
+            raise ValueError('"{}" data specifier requires a preceding value'
+                             .format(token))
         elif last_char == 'm':
             if len(token) == 1:
                 raise ValueError('"m" data specifier requires a multiplier')
-            factor = float(token[:-1])
-            result.append(result[-1] * factor)
-        elif last_char == 'j':
-            n_reps = int(token[:-1]) if len(token) > 1 else 1
-            result.extend([None]*n_reps)
-        elif len(token) >= 3 and token[-3:] == 'log':
-            result.extend(logspace(result[-1], tokens.pop(), token))
-            consumed += 1
+            chunk, mask = np.array([last * float(token[:-1])]), None
+        elif last_char == 'i' or token.endswith('log'):
+            if pos == len(tokens):
+                raise ValueError('"{}" data specifier requires an upper bound'
+                                 .format(token))
+            space = linspace if last_char == 'i' else logspace
+            chunk = np.fromiter(space(last, tokens[pos], token), dtype=float)
+            mask = None
+            pos += 1
         else:
-            result.append(float(token))
-    if expected is not None and len(result) != expected:
+            chunk, mask = np.array([float(token)]), None
+        chunks.append(chunk)
+        masks.append(mask)
+        size += len(chunk)
+        if len(chunk):
+            last = None if mask is not None else chunk[-1].item()
+    if expected is not None and size != expected:
         raise ValueError('expected exactly {:d} items in data card, found {:d}'
-                         .format(expected, len(result)))
-    return [conv(res) if res is not None else None for res in result], consumed
+                         .format(expected, size))
+    values = np.concatenate(chunks) if chunks else np.empty(0)
+    if all(mask is None for mask in masks):
+        return values, None, pos
+    jumps = np.concatenate([np.zeros(len(chunk), dtype=bool)
+                            if mask is None else mask
+                            for chunk, mask in zip(chunks, masks)])
+    return values, jumps, pos
+
+
+def _expand_run(run, repeats, last, size, remaining):
+    '''Expand a run of plain numbers and repetitions (``nR``).
+
+    :param list(str) run: the tokens of the run.
+    :param list(int) repeats: the indices of the repetitions in `run`.
+    :param last: the value preceding the run, or `None` after a jump.
+    :param int size: the number of values preceding the run.
+    :param remaining: the number of values to collect, or `None`.
+    :returns: the expanded values, a boolean array marking the jumps (or
+        `None`), the number of tokens consumed and the new last value.
+    '''
+    # find the tokens to consume before parsing them
+    counts = []
+    consumed = len(run)
+    total = 0
+    start = 0
+    for i in repeats + [len(run)]:
+        if remaining is not None and total + i - start >= remaining:
+            consumed = start + remaining - total
+            break
+        total += i - start
+        if i == len(run):
+            break
+        token = run[i].strip()
+        counts.append(max(int(token[:-1]), 0) if len(token) > 1 else 1)
+        total += counts[-1]
+        start = i + 1
+        if remaining is not None and total >= remaining:
+            consumed = start
+            break
+    positions = [i + 1 for i in repeats[:len(counts)]]
+    run = run[:consumed]
+    for i in positions:
+        run[i - 1] = 'nan'
+    # element 0 stands for the value preceding the run
+    values = np.empty(consumed + 1)
+    values[0] = np.nan if last is None else last
+    values[1:] = np.array(run, dtype=float)
+    weights = np.ones(consumed + 1, dtype=np.int64)
+    weights[0] = 0
+    weights[positions] = counts
+    # each repetition refers to the last plain number before it
+    sources = np.arange(consumed + 1)
+    sources[positions] = 0
+    np.maximum.accumulate(sources, out=sources)
+    carried = sources == 0
+    if size == 0 and carried[1:].any():
+        raise ValueError('"r" data specifier requires a preceding value')
+    chunk = np.repeat(values[sources], weights)
+    mask = None
+    if last is None and carried[1:].any():
+        mask = np.repeat(carried, weights)
+    if sources[-1] != 0:
+        last = values[sources[-1]].item()
+    return chunk, mask, consumed, last
 
 
 def linspace(lower_token, upper_token, n_vals_token):
@@ -1,8 +1,10 @@
+import locale
+import mmap
 import re
 from functools import wraps
 
 from .blocks import get_block_positions
-from .cards import get_cards
+from .cards import index_cards, re_comment as re_c_comment
 
 from . import cellcard
 from . import surfacecard
@@ -94,6 +96,78 @@ class Card:
             raise NotImplementedError
 
 
+class IndexedCard(Card):
+    """
+    A card stored as a pair of offsets into the encoded input file.
+
+    The lines are decoded on demand and do not include the c-comments. The
+    results of `content` and `parts` are computed only once.
+    """
+    def __init__(self, mip, start, end, comments, position=0, type=None):
+        self.mip = mip
+        self.start = start
+        self.end = end
+        self.comments = comments
+        self.position = position
+        self.type = type
+        self._content = None
+        self._parts = None
+
+    def all_lines(self):
+        """
+        Return the decoded lines of the card, including the c-comments.
+        """
+        raw = self.mip.text[self.start:self.end]
+        return raw.decode(self.mip.encoding).splitlines()
+
+    @property
+    def lines(self):
+        lines = self.all_lines()
+        if self.comments:
+            lines = [l for l in lines if not re_c_comment.match(l)]
+        return lines
+
+    def with_comments(self):
+        """
+        Return a `Card` whose lines include the c-comments.
+        """
+        return Card(lines=self.all_lines(), position=self.position,
+                    type=self.type)
+
+    def content(self):
+        if self._content is None:
+            self._content = Card.content(self)
+        return self._content
+
+    def parts(self):
+        if self._parts is None:
+            self._parts = Card.parts(self)
+        return self._parts
+
+
+def map_input(fname, encoding):
+    """
+    Return the content of the input file as a read-only memory map, and its
+    encoding.
+
+    The blocks and cards are located on the raw bytes, which requires an
+    ASCII-compatible encoding and '\\n' line ends. Other files are read as
+    text and re-encoded in UTF-8.
+    """
+    probe = '\n\r\t $&cC0123456789'
+    with open(fname, 'rb') as f:
+        try:
+            text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            text = b''
+    ascii_ok = probe.encode(encoding) == probe.encode('ascii')
+    if ascii_ok and (text.find(b'\r') < 0 or text.find(b'\n') >= 0):
+        return text, encoding
+    with open(fname, 'r', encoding=encoding) as f:
+        return f.read().encode('utf-8'), 'utf-8'
+
+
 class MIP:
     """
     Class to read general structure of an MCNP input file.
@@ -101,14 +175,34 @@ class MIP:
     When created a new instance, it reads the content of the specified input
     file.  Methods of the class help to access separate blocks and cards of the
     input file.
+
+    The cards of all the blocks are indexed once, when the instance is
+    created; all the queries are served from the index.
+
+    The input file is memory-mapped: the blocks and the cards are located on
+    the raw bytes, and each card is decoded only when it is used.
     """
     def __init__(self, fname, firstblock=None, encoding=None):
 
-        # Text from the input file
-        self.text = open(fname, 'r', encoding=encoding).read()
+        # Encoding of the input file, as for open()
+        if encoding is None:
+            encoding = locale.getpreferredencoding(False)
+
+        # Encoded text from the input file (usually a memory map), and the
+        # encoding to use to decode it
+        self.text, self.encoding = map_input(fname, encoding)
 
         # Dictioary of indices describing position of blocks
         self.bi = get_block_positions(self.text, firstblock=firstblock)
+
+        # Dictionary of the cards and comments of each block, as lists of
+        # IndexedCard instances, with type 'cmnt' for the b-comments
+        self.index = {}
+        for b, ((start, end), n0) in self.bi.items():
+            self.index[b] = [
+                IndexedCard(self, s, e, c, position=n0 + n,
+                            type=b if t == 'card' else t)
+                for t, n, s, e, c in index_cards(self.text, start, end)]
         return
 
     def block(self, bid):
@@ -116,7 +210,7 @@ class MIP:
         Return text of the specififed block.
         """
         ii, l = self.bi[bid]
-        return l, self.text[slice(*ii)]
+        return l, self.text[slice(*ii)].decode(self.encoding)
 
     def blocks(self, blocks='mtcsd'):
         """
@@ -125,7 +219,7 @@ class MIP:
         for b in blocks:
             if b in self.bi:
                 ii, l = self.bi[b]
-                yield b, l, self.text[slice(*ii)]
+                yield b, l, self.text[slice(*ii)].decode(self.encoding)
 
     def cards(self, blocks='csd', skipcomments=False):
         """
@@ -135,11 +229,13 @@ class MIP:
         The c-comment lines between cards can be skipped if `skipcomments` is
         True.
         """
-        for b, n0, txt in self.blocks(blocks):
-            for c, n, t in get_cards(txt, skipcomments=skipcomments):
-                if t == 'card':
-                    t = b
-                yield Card(lines=c, position=n0 + n, type=t)
+        for b in blocks:
+            for card in self.index.get(b, ()):
+                if skipcomments:
+                    if card.type != 'cmnt':
+                        yield card
+                else:
+                    yield card.with_comments()
 
 
 if __name__ == '__main__':
@@ -16,7 +16,7 @@ def newlineindex(mlstring, start=0):
     """
     Return two indices, for the end of the 1-st line and start of the next one.
     """
-    r = re.compile('[\r\n]+')
+    r = re.compile('[\r\n]+' if isinstance(mlstring, str) else b'[\r\n]+')
     m = r.search(mlstring, start)
     return m.start(), m.end()
 
@@ -29,6 +29,12 @@ def nol(txt, start=None, end=None):
         start = 0
     if end is None:
         end = len(txt)
+    if not isinstance(txt, str):
+        # bytes-like object, possibly without a count method (memory map):
+        # count in chunks, to avoid copying the whole range
+        step = 1 << 20
+        return sum(txt[i:min(i + step, end)].count(b'\n')
+                   for i in range(start, end, step)) + 1
     if '\r' in txt:
         return txt.count('\r', start, end) + 1
     else:
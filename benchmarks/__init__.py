@@ -0,0 +1,7 @@
+'''Performance benchmarks for the conversion pipeline.
+
+The :mod:`~benchmarks.decks` module generates synthetic MCNP decks whose size
+and complexity are controlled by a few parameters; the
+:mod:`~benchmarks.run` module converts them and records the time spent in
+each phase of the conversion as JSON.
+'''
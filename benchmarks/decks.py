@@ -0,0 +1,272 @@
+'''Module containing a generator of synthetic MCNP decks for the benchmarks.
+
+The generated geometry is a stack of `n_cells` slabs along the x axis. Each
+slab contains an object (a sphere, a box bounded by planes or a macrobody)
+and is filled with a material around it. The objects may be filled with a
+chain of `fill_depth` nested universes. A lattice of
+``lattice_size`` elements (each one containing a sphere) may be placed next
+to the slabs. A fraction of the slab cells refer to their object with a
+complement operator (``#n``) instead of spelling out its outside.
+'''
+
+import random
+
+
+#: Distance between two consecutive slab planes.
+PITCH = 10.
+
+#: Half-size of the objects contained in the slabs.
+HALF_SIZE = 3.
+
+#: The macrobodies used for the objects.
+MACROBODIES = ('RPP', 'RCC', 'SPH', 'BOX')
+
+#: The objects built from ordinary surfaces.
+BASIC_OBJECTS = ('S', 'PLANES')
+
+
+def _lattice_dims(lattice_size):
+    '''Return the number of lattice elements along each axis.
+
+    >>> _lattice_dims(3)
+    (3, 3, 3)
+    >>> _lattice_dims((4, 2, 1))
+    (4, 2, 1)
+    '''
+    if isinstance(lattice_size, int):
+        return (lattice_size,) * 3
+    return tuple(lattice_size)
+
+
+def _fmt(*values):
+    '''Format numbers for an MCNP card.'''
+    return ' '.join('{:g}'.format(value) if isinstance(value, float)
+                    else str(value) for value in values)
+
+
+def _card(text, width=78):
+    '''Split a card into continuation lines no longer than `width`.
+
+    >>> print(_card('1 0 -1 2 -3 imp:n=1', width=12))
+    1 0 -1 2 -3
+         imp:n=1
+    '''
+    lines = []
+    line = ''
+    for word in text.split():
+        if line and len(line) + 1 + len(word) > width:
+            lines.append(line)
+            line = '    '
+        line = line + ' ' + word if line else word
+    lines.append(line)
+    return '\n'.join(lines)
+
+
+class DeckGenerator:
+    '''Accumulate the cell and surface cards of a synthetic MCNP deck.'''
+
+    def __init__(self):
+        self.cells = []
+        self.surfaces = []
+        self.options = []
+
+    def surface(self, *params):
+        '''Add a surface card and return the ID of the new surface.'''
+        key = len(self.surfaces) + 1
+        self.surfaces.append('{} {}'.format(key, _fmt(*params)))
+        return key
+
+    def cell(self, material, geometry, importance=1, **params):
+        '''Add a cell card and return the ID of the new cell.'''
+        key = len(self.cells) + 1
+        words = [str(key), '0' if material is None
+                 else '{} -1.0'.format(material), geometry]
+        words.extend('{}={}'.format(name, value)
+                     for name, value in params.items())
+        words.append('imp:n={}'.format(importance))
+        self.cells.append(' '.join(words))
+        return key
+
+    def text(self, title):
+        '''Return the text of the deck.'''
+        lines = [title]
+        if self.options:
+            lines.append('c converter-flags: ' + ' '.join(self.options))
+        lines.extend(_card(card) for card in self.cells)
+        lines.append('')
+        lines.extend(_card(card) for card in self.surfaces)
+        lines.append('')
+        lines.extend(['m1 13027 1.', 'm2 13027 1.'])
+        return '\n'.join(lines) + '\n'
+
+    def add_object(self, kind, x_center):
+        '''Add the surfaces of an object centered in `(x_center, 0, 0)`.
+
+        :returns: a pair containing the geometry of the inside and of the
+            outside of the object.
+        '''
+        size = HALF_SIZE
+        if kind == 'PLANES':
+            keys = [self.surface('PX', x_center - size),
+                    self.surface('PX', x_center + size),
+                    self.surface('PY', -size), self.surface('PY', size),
+                    self.surface('PZ', -size), self.surface('PZ', size)]
+            inside = ' '.join(str(key if i % 2 == 0 else -key)
+                              for i, key in enumerate(keys))
+            outside = ':'.join(str(-key if i % 2 == 0 else key)
+                               for i, key in enumerate(keys))
+            return inside, '(' + outside + ')'
+        if kind == 'S':
+            key = self.surface('S', x_center, 0., 0., size)
+        elif kind == 'SPH':
+            key = self.surface('SPH', x_center, 0., 0., size)
+        elif kind == 'RPP':
+            key = self.surface('RPP', x_center - size, x_center + size,
+                               -size, size, -size, size)
+        elif kind == 'RCC':
+            key = self.surface('RCC', x_center - size, 0., 0.,
+                               2 * size, 0., 0., size)
+        elif kind == 'BOX':
+            key = self.surface('BOX', x_center - size, -size, -size,
+                               2 * size, 0., 0., 0., 2 * size, 0.,
+                               0., 0., 2 * size)
+        else:
+            raise ValueError('unknown object kind {!r}'.format(kind))
+        return str(-key), str(key)
+
+    def add_universe_chain(self, depth):
+        '''Add a chain of `depth` nested universes, each one consisting of a
+        sphere filled with the next universe and of the space around it.
+
+        :returns: the number of the outermost universe, or `None` if `depth`
+            is zero.
+        '''
+        for level in range(1, depth + 1):
+            radius = 0.8 * HALF_SIZE * 0.8**(level - 1)
+            sphere = self.surface('SO', radius)
+            if level < depth:
+                self.cell(None, str(-sphere), u=level, fill=level + 1)
+            else:
+                self.cell(1, str(-sphere), u=level)
+            self.cell(2, str(sphere), u=level)
+        return 1 if depth else None
+
+    def add_lattice(self, dims, universe, x_max):
+        '''Add a lattice of unit elements with `dims` elements along each
+        axis, filled with spheres, in a container ending at `x_max`.
+
+        :returns: the geometry of the outside of the container.
+        '''
+        n_x, n_y, n_z = dims
+        # MCNP numbers the element across the first surface of each pair
+        # as 1, so the upper planes come first
+        planes = [self.surface('PX', 0.5), self.surface('PX', -0.5),
+                  self.surface('PY', 0.5), self.surface('PY', -0.5),
+                  self.surface('PZ', 0.5), self.surface('PZ', -0.5)]
+        sphere = self.surface('SO', 0.4)
+        self.cell(1, str(-sphere), u=universe + 1)
+        self.cell(2, str(sphere), u=universe + 1)
+        element = ' '.join(str(-key if i % 2 == 0 else key)
+                           for i, key in enumerate(planes))
+        lat_cell = self.cell(None, element, lat=1, u=universe,
+                             fill=universe + 1)
+        x_min = x_max - n_x
+        container = self.surface('RPP', float(x_min), float(x_max),
+                                 -n_y / 2, n_y / 2, -n_z / 2, n_z / 2)
+        shift = _fmt(x_min + 0.5, -n_y / 2 + 0.5, -n_z / 2 + 0.5)
+        self.cell(None, str(-container),
+                  fill='{} ({})'.format(universe, shift))
+        self.options.extend(['--lattice', '{},0:{},0:{},0:{}'
+                             .format(lat_cell, n_x - 1, n_y - 1, n_z - 1)])
+        return str(container)
+
+
+def generate_deck(n_cells=10, fill_depth=0, lattice_size=0,
+                  macrobody_fraction=0.5, complement_fraction=0.2, seed=0):
+    '''Generate a synthetic MCNP deck.
+
+    :param int n_cells: the number of slabs; each slab contributes two cells
+        and between two and seven surfaces
+    :param int fill_depth: the depth of the chain of universes filling the
+        objects in the slabs (0 for no filling)
+    :param lattice_size: the number of lattice elements along each axis, as
+        an integer or as a triple (0 for no lattice)
+    :param float macrobody_fraction: the fraction of objects defined as
+        macrobodies
+    :param float complement_fraction: the fraction of slab cells using a
+        complement operator
+    :param int seed: the seed of the random choices
+    :returns: a pair containing the text of the deck and the list of the
+        command-line options required to convert it
+
+    >>> text, options = generate_deck(n_cells=2, lattice_size=(2, 1, 1))
+    >>> options
+    ['--lattice', '8,0:1,0:0,0:0']
+    >>> print(text)  # doctest: +ELLIPSIS
+    synthetic deck: n_cells=2, fill_depth=0, ...
+    c converter-flags: --lattice 8,0:1,0:0,0:0
+    1 0 1 imp:n=0
+    2 1 -1.0 9 -10 11 -12 13 -14 imp:n=1
+    3 2 -1.0 6 -7 2 -3 4 -5 #2 imp:n=1
+    ...
+    '''
+    if n_cells < 1:
+        raise ValueError('at least one slab is required')
+    rng = random.Random(seed)
+    dims = _lattice_dims(lattice_size)
+    has_lattice = all(dims)
+    half_width = max(5., dims[1] / 2, dims[2] / 2) if has_lattice else 5.
+    x_min = -dims[0] - 2. if has_lattice else -1.
+    x_max = n_cells * PITCH + 1.
+
+    gen = DeckGenerator()
+    world = gen.surface('RPP', x_min, x_max, -half_width - 1.,
+                        half_width + 1., -half_width - 1., half_width + 1.)
+    gen.cell(None, str(world), importance=0)
+    y_low, y_high = gen.surface('PY', -5.), gen.surface('PY', 5.)
+    z_low, z_high = gen.surface('PZ', -5.), gen.surface('PZ', 5.)
+    slab_planes = [gen.surface('PX', i * PITCH) for i in range(n_cells + 1)]
+    universe = gen.add_universe_chain(fill_depth)
+
+    for i in range(n_cells):
+        x_center = (i + 0.5) * PITCH
+        if rng.random() < macrobody_fraction:
+            kind = rng.choice(MACROBODIES)
+        else:
+            kind = rng.choice(BASIC_OBJECTS)
+        inside, outside = gen.add_object(kind, x_center)
+        if universe is None:
+            obj = gen.cell(1, inside)
+        else:
+            obj = gen.cell(None, inside,
+                           fill='{} ({})'.format(universe,
+                                                 _fmt(x_center, 0., 0.)))
+        if rng.random() < complement_fraction:
+            outside = '#{}'.format(obj)
+        gen.cell(2, '{} {} {} {} {} {} {}'.format(
+            slab_planes[i], -slab_planes[i + 1], y_low, -y_high, z_low,
+            -z_high, outside))
+
+    void = '{} ({}:{}:{}:{}:{}:{})'.format(
+        -world, -slab_planes[0], slab_planes[-1], -y_low, y_high, -z_low,
+        z_high)
+    if has_lattice:
+        void += ' ' + gen.add_lattice(dims, fill_depth + 1, -1.)
+    gen.cell(None, void)
+
+    title = ('synthetic deck: n_cells={}, fill_depth={}, lattice_size={}, '
+             'macrobody_fraction={}, complement_fraction={}'
+             .format(n_cells, fill_depth, 'x'.join(map(str, dims)),
+                     macrobody_fraction, complement_fraction))
+    return gen.text(title), gen.options
+
+
+def write_deck(path, **params):
+    '''Write a synthetic deck (see :func:`generate_deck`) to `path`.
+
+    :returns: the list of the command-line options required to convert it.
+    '''
+    text, options = generate_deck(**params)
+    with open(str(path), 'w') as deck:
+        deck.write(text)
+    return options
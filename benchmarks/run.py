@@ -0,0 +1,238 @@
+'''Run the conversion benchmarks and store the timings as JSON.
+
+Each scenario generates a synthetic deck (see :mod:`~benchmarks.decks`),
+converts it a few times and records the time spent in each phase of the
+conversion (the shortest time over the repetitions is kept). The results of
+two runs (e.g. on two different commits) can be compared with the
+``--compare`` option::
+
+    python -m benchmarks.run -o before.json
+    git checkout my-branch
+    python -m benchmarks.run -o after.json --compare before.json
+'''
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+
+from t4_geom_convert import __version__
+from t4_geom_convert.main import conversion, parse_args
+from t4_geom_convert.Kernel.Instrumentation import STATS
+
+from .decks import write_deck
+
+
+#: The benchmark scenarios, as keyword arguments for
+#: :func:`~benchmarks.decks.generate_deck`.
+SCENARIOS = OrderedDict([
+    ('slabs', dict(n_cells=1000, macrobody_fraction=0.,
+                   complement_fraction=0.)),
+    ('macrobodies', dict(n_cells=500, macrobody_fraction=1.,
+                         complement_fraction=0.)),
+    ('complements', dict(n_cells=500, complement_fraction=1.)),
+    ('nested_fill', dict(n_cells=200, fill_depth=6)),
+    ('lattice', dict(n_cells=10, lattice_size=[20, 20, 10])),
+])
+
+#: Phases shorter than this (in seconds) are ignored by the comparison,
+#: because their timings are dominated by noise.
+MIN_COMPARED_TIME = 0.1
+
+
+def git_commit():
+    '''Return the hash of the current git commit, or `None`.'''
+    try:
+        output = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=str(Path(__file__).resolve().parent))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode().strip()
+
+
+def count_records(t4_path):
+    '''Count the VOLU and SURF records in a TRIPOLI-4 file.'''
+    counts = OrderedDict([('volumes', 0), ('surfaces', 0)])
+    with t4_path.open() as t4_file:
+        for line in t4_file:
+            if line.startswith('VOLU '):
+                counts['volumes'] += 1
+            elif line.startswith('SURF '):
+                counts['surfaces'] += 1
+    return counts
+
+
+def run_conversion(deck_path, options, output_path):
+    '''Convert a deck, silencing the progress output.
+
+    :returns: a pair containing an ordered dictionary associating each phase
+        to its duration (in seconds; the total duration is stored under the
+        ``'total'`` key) and the full measurements of the conversion (see
+        :meth:`~.Instrumentation.as_dict`).
+    '''
+    args = parse_args(['-o', str(output_path), str(deck_path)] + options)
+    start = perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        conversion(args)
+    timings = STATS.wall_times()
+    timings['total'] = perf_counter() - start
+    return timings, STATS.as_dict()
+
+
+def run_scenario(params, repeat, work_dir, extra_options=()):
+    '''Run one benchmark scenario.
+
+    :param dict params: the parameters of the synthetic deck
+    :param int repeat: the number of repetitions
+    :param work_dir: the directory where the deck and the output are written
+    :param extra_options: additional command-line options for the converter
+    :returns: a dictionary describing the results
+    '''
+    deck_path = work_dir / 'deck.imcnp'
+    output_path = work_dir / 'deck.t4'
+    options = write_deck(deck_path, **params) + list(extra_options)
+    runs = []
+    for _ in range(repeat):
+        timings, stats = run_conversion(deck_path, options, output_path)
+        runs.append(timings)
+    best = OrderedDict()
+    for run in runs:
+        for name, elapsed in run.items():
+            best[name] = min(best.get(name, elapsed), elapsed)
+    return OrderedDict([('params', params),
+                        ('options', options),
+                        ('output', count_records(output_path)),
+                        ('phases', best),
+                        ('runs', runs),
+                        ('stats', stats)])
+
+
+def run_benchmarks(names, repeat, extra_options=()):
+    '''Run the given scenarios and return the results as a dictionary.'''
+    results = OrderedDict()
+    results['metadata'] = OrderedDict([
+        ('commit', git_commit()),
+        ('version', __version__),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('date', datetime.now().isoformat()),
+        ('repeat', repeat),
+        ('extra_options', list(extra_options)),
+    ])
+    results['scenarios'] = OrderedDict()
+    for name in names:
+        print('running scenario {}...'.format(name), end='', flush=True)
+        with tempfile.TemporaryDirectory() as work_dir:
+            result = run_scenario(SCENARIOS[name], repeat, Path(work_dir),
+                                  extra_options)
+        results['scenarios'][name] = result
+        print(' {:.3f} s'.format(result['phases']['total']), flush=True)
+    return results
+
+
+def format_results(results):
+    '''Return a table of the phase timings of each scenario.'''
+    lines = []
+    for name, result in results['scenarios'].items():
+        lines.append('{} ({} volumes, {} surfaces)'
+                     .format(name, result['output']['volumes'],
+                             result['output']['surfaces']))
+        for phase, elapsed in result['phases'].items():
+            lines.append('  {:<14s} {:10.3f} s'.format(phase, elapsed))
+    return '\n'.join(lines)
+
+
+def compare_results(baseline, results, threshold):
+    '''Compare the phase timings with those of a baseline run.
+
+    :param float threshold: the relative slowdown above which a phase is
+        reported as a regression
+    :returns: a pair containing the comparison table and the list of the
+        regressions, as ``(scenario, phase, ratio)`` triples
+    '''
+    lines = []
+    regressions = []
+    for name, result in results['scenarios'].items():
+        base = baseline['scenarios'].get(name)
+        if base is None:
+            continue
+        if base['params'] != result['params']:
+            lines.append('{}: the deck parameters differ, skipping'
+                         .format(name))
+            continue
+        lines.append(name)
+        for phase, elapsed in result['phases'].items():
+            base_elapsed = base['phases'].get(phase)
+            if base_elapsed is None:
+                continue
+            if max(base_elapsed, elapsed) < MIN_COMPARED_TIME:
+                ratio_str = '(too short)'
+            else:
+                ratio = (elapsed / base_elapsed if base_elapsed
+                         else float('inf'))
+                ratio_str = '{:.2f}x'.format(ratio)
+                if ratio > 1. + threshold:
+                    ratio_str += '  REGRESSION'
+                    regressions.append((name, phase, ratio))
+            lines.append('  {:<14s} {:10.3f} s -> {:10.3f} s  {}'
+                         .format(phase, base_elapsed, elapsed, ratio_str))
+    return '\n'.join(lines), regressions
+
+
+def parse_bench_args(argv):
+    '''Parse the command-line arguments of the benchmark runner.'''
+    parser = argparse.ArgumentParser(
+        description='Benchmark the conversion of synthetic MCNP decks.')
+    parser.add_argument('-s', '--scenario', action='append',
+                        choices=list(SCENARIOS), default=None,
+                        help='run only the given scenario (may be given '
+                        'multiple times; default: all)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='number of repetitions of each conversion; the '
+                        'fastest one is kept (default: %(default)s)')
+    parser.add_argument('-o', '--output', metavar='JSON_FILE', default=None,
+                        help='write the results to JSON_FILE')
+    parser.add_argument('--compare', metavar='JSON_FILE', default=None,
+                        help='compare the results with a previous run')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='relative slowdown reported as a regression '
+                        '(default: %(default)s)')
+    parser.add_argument('--converter-option', metavar='OPTION',
+                        action='append', default=[],
+                        help='extra option to pass to the converter (may be '
+                        'given multiple times)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    '''Main entry point of the benchmark runner.'''
+    args = parse_bench_args(sys.argv[1:] if argv is None else argv)
+    names = args.scenario or list(SCENARIOS)
+    results = run_benchmarks(names, args.repeat, args.converter_option)
+    print(format_results(results))
+    if args.output is not None:
+        with open(args.output, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as json_file:
+            baseline = json.load(json_file)
+        table, regressions = compare_results(baseline, results,
+                                             args.threshold)
+        print('\ncomparison with {}:\n{}'.format(args.compare, table))
+        if regressions:
+            print('\n{} regression(s) detected'.format(len(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,166 @@
+'''Stress benchmark for the passes over the syntax trees of the cells.
+
+Each scenario builds the geometry of a cell with `n` operands, parses it,
+expands the cell complements (in all the cells of the scenario, like the
+converter does) and converts it into TRIPOLI-4 volumes (see
+:meth:`~.CellConversion.convert_cell`). The time per operand is reported for
+increasing values of `n`; it should stay roughly constant::
+
+    python -m benchmarks.stress -n 1000 -n 10000 -n 100000
+
+The scenarios are:
+
+``intersection``
+    a single intersection of `n` surfaces;
+``union``
+    a single union of `n` surfaces;
+``nested``
+    intersections and unions alternating at each level of parentheses,
+    ``1 (2 : (3 (4 : ...)))``, with a nesting depth of `n`;
+``complements``
+    a chain of `n` cells, each one defined as ``-k #(k+1)``.
+
+With ``--multipass``, the cell is also converted with the multi-pass
+reference implementation (see :meth:`~.CellConversion.convert_cell_multipass`)
+and the speedup of the single-pass conversion is reported.
+'''
+
+import argparse
+import sys
+from collections import OrderedDict
+from time import perf_counter
+
+from t4_geom_convert.Kernel.FileHandlers.Parser.ParseMCNPGeometry import (
+    parse_geometry)
+from t4_geom_convert.Kernel.Volume.CellConversion import CellConversion
+from t4_geom_convert.Kernel.Volume.CellMCNP import CellMCNP
+from t4_geom_convert.Kernel.Volume.DictVolumeT4 import DictVolumeT4
+
+
+def intersection_geometries(n_ops):
+    '''Return the geometries of the cells of the ``intersection`` scenario.'''
+    return {1: ' '.join(str(-k if k % 2 else k)
+                        for k in range(1, n_ops + 1))}
+
+
+def union_geometries(n_ops):
+    '''Return the geometries of the cells of the ``union`` scenario.'''
+    return {1: ' : '.join(str(-k if k % 2 else k)
+                          for k in range(1, n_ops + 1))}
+
+
+def nested_geometries(n_ops):
+    '''Return the geometries of the cells of the ``nested`` scenario.
+
+    >>> nested_geometries(4)
+    {1: '1 (2 : (3 (4)))'}
+    '''
+    words = []
+    for k in range(1, n_ops):
+        words.append('{} {}('.format(k, ': ' if k % 2 == 0 else ''))
+    words.append(str(n_ops))
+    return {1: ''.join(words) + ')' * (n_ops - 1)}
+
+
+def complements_geometries(n_ops):
+    '''Return the geometries of the cells of the ``complements`` scenario.
+
+    >>> complements_geometries(3)
+    {1: '-1 #2', 2: '-2 #3', 3: '-3'}
+    '''
+    geoms = {k: '{} #{}'.format(-k, k + 1) for k in range(1, n_ops)}
+    geoms[n_ops] = str(-n_ops)
+    return geoms
+
+
+#: The stress scenarios, as functions returning the geometries of the cells
+#: for a given number of operands; cell 1 is the converted one.
+SCENARIOS = OrderedDict([
+    ('intersection', intersection_geometries),
+    ('union', union_geometries),
+    ('nested', nested_geometries),
+    ('complements', complements_geometries),
+])
+
+
+def run_stress(geometries, n_ops, multipass=False):
+    '''Parse and convert cell 1 of `geometries`.
+
+    :param bool multipass: if true, also time the multi-pass conversion
+        (under the ``'multipass'`` key)
+    :returns: an ordered dictionary associating each step to its duration,
+        in seconds.
+    '''
+    timings = OrderedDict()
+    start = perf_counter()
+    cells = {key: CellMCNP(1, -1., parse_geometry(geom), 1., 0, None, None,
+                           False, [])
+             for key, geom in geometries.items()}
+    timings['parse'] = perf_counter() - start
+
+    conv = CellConversion(n_ops + 1, n_ops + 1, DictVolumeT4(), {}, {},
+                          cells)
+    start = perf_counter()
+    for cell in cells.values():
+        cell.geometry = conv.pot_complement(cell.geometry)
+    timings['complements'] = perf_counter() - start
+    geometry = cells[1].geometry
+
+    matching = {k: [k] for k in range(1, n_ops + 1)}
+    union_ids = n_ops + 1, n_ops + 2
+    start = perf_counter()
+    conv.convert_cell(1, geometry, [1], matching, union_ids)
+    timings['convert'] = perf_counter() - start
+
+    if multipass:
+        conv = CellConversion(n_ops + 1, n_ops + 1, DictVolumeT4(), {}, {},
+                              cells)
+        start = perf_counter()
+        conv.convert_cell_multipass(1, geometry, [1], matching, union_ids)
+        timings['multipass'] = perf_counter() - start
+    return timings
+
+
+def main(argv=None):
+    '''Main entry point of the stress benchmark.'''
+    parser = argparse.ArgumentParser(
+        description='Stress the passes over the syntax trees of the cells '
+        'with very large cell geometries.')
+    parser.add_argument('-s', '--scenario', action='append',
+                        choices=list(SCENARIOS), default=None,
+                        help='run only the given scenario (may be given '
+                        'multiple times; default: all)')
+    parser.add_argument('-n', '--operands', type=int, action='append',
+                        default=None,
+                        help='number of operands (may be given multiple '
+                        'times; default: 1000, 10000 and 100000)')
+    parser.add_argument('--multipass', action='store_true',
+                        help='also time the multi-pass conversion and report '
+                        'the speedup of the single-pass one')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    names = args.scenario or list(SCENARIOS)
+    sizes = args.operands or [10**3, 10**4, 10**5]
+    header = '{:<14s} {:>8s} {:>10s} {:>10s} {:>10s} {:>12s}'.format(
+        'scenario', 'operands', 'parse (s)', 'compl (s)', 'conv (s)',
+        'us/operand')
+    if args.multipass:
+        header += ' {:>10s} {:>8s}'.format('multi (s)', 'speedup')
+    print(header)
+    for name in names:
+        for n_ops in sizes:
+            timings = run_stress(SCENARIOS[name](n_ops), n_ops,
+                                 args.multipass)
+            multipass = timings.pop('multipass', None)
+            total = sum(timings.values())
+            line = '{:<14s} {:8d} {:10.3f} {:10.3f} {:10.3f} {:12.2f}'.format(
+                name, n_ops, timings['parse'], timings['complements'],
+                timings['convert'], 1e6 * total / n_ops)
+            if multipass is not None:
+                line += ' {:10.3f} {:7.2f}x'.format(
+                    multipass, multipass / max(timings['convert'], 1e-9))
+            print(line, flush=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -29,7 +29,7 @@ setup(name=name,
       long_description_content_type='text/markdown',
       packages=find_packages(exclude=['doc', 't4_geom_convert.UnitTests',
                                       't4_geom_convert.UnitTests.*',
-                                      'Oracle']),
+                                      'Oracle', 'benchmarks']),
       python_requires='>=3.5, <4',
       setup_requires=['pytest-runner', 'setuptools-scm'],
       classifiers=[
@@ -4,6 +4,8 @@
 import shlex
 import pytest
 from t4_geom_convert.main import conversion, parse_args
+from t4_geom_convert.Kernel.FileHandlers.Parser.ParseMCNPCell import (
+    ParseMCNPCellError)
 from ..conftest import foreach_data
 
 
@@ -97,3 +99,267 @@ def test_density_zeros(datadir, tmp_path):
     assert 'COMPOSITION\n3' in t4_text, t4_text
     assert 'm1_-2.7 ' in t4_text, t4_text
     assert 'm2_-1.0 ' in t4_text, t4_text
+
+
+@foreach_data(mcnp_i=lambda path: str(path).endswith('.imcnp'))
+def test_parallel_conversion(mcnp_i, tmp_path):
+    '''Test that converting cells with a process pool yields exactly the same
+    output as the serial conversion.'''
+    conv_opts, _, _ = get_options(mcnp_i)
+    serial_dir = tmp_path / 'serial'
+    serial_dir.mkdir()
+    parallel_dir = tmp_path / 'parallel'
+    parallel_dir.mkdir()
+    t4_serial = do_conversion(mcnp_i, serial_dir, conv_opts)
+    t4_parallel = do_conversion(mcnp_i, parallel_dir,
+                                conv_opts + ['--jobs', '2'])
+    assert t4_serial.read_text() == t4_parallel.read_text()
+
+
+@pytest.mark.parametrize('jobs', ['1', '2'])
+def test_parsing_errors(datadir, tmp_path, jobs):
+    '''Test that parsing errors are attributed to the first faulty card, both
+    in the serial and in the parallel parsing.'''
+    mcnp_i = datadir / 'lattice_fill.imcnp'
+    conv_opts, _, _ = get_options(mcnp_i)
+    conv_opts += ['--jobs', jobs]
+    mcnp_text = mcnp_i.read_text()
+    mcnp_i.write_text(mcnp_text.replace(' u=3 imp:n=1', ' u=3 lat=7 imp:n=1'))
+    with pytest.raises(ParseMCNPCellError, match=r'LAT=7\) \(in cell 3\)'):
+        do_conversion(mcnp_i, tmp_path, conv_opts)
+    mcnp_i.write_text(mcnp_text.replace('21 SO 0.4', '21 P 0 0 1')
+                      .replace('31 SO 0.1', '31 P 1'))
+    with pytest.raises(ValueError, match=r'\(in surface 21\)'):
+        do_conversion(mcnp_i, tmp_path, conv_opts)
+
+
+@foreach_data(mcnp_i=lambda path: str(path).endswith('.imcnp'))
+def test_geometry_parsers(mcnp_i, tmp_path):
+    '''Test that the fast geometry parser and the TatSu parser yield the same
+    cell geometries.'''
+    conv_opts, _, _ = get_options(mcnp_i)
+    do_conversion(mcnp_i, tmp_path, conv_opts + ['--geometry-parser', 'check'])
+
+
+@foreach_data(mcnp_i=lambda path: str(path).endswith('.imcnp'))
+def test_cache(mcnp_i, tmp_path):
+    '''Test that conversions using the disk cache yield the same output as
+    conversions without cache, both when the cache is cold and when it is
+    warm.'''
+    conv_opts, _, _ = get_options(mcnp_i)
+    cache_opts = ['--cache', '--cache-dir', str(tmp_path / 'cache')]
+    outputs = []
+    for run in ('nocache', 'cold', 'warm'):
+        run_dir = tmp_path / run
+        run_dir.mkdir()
+        opts = conv_opts if run == 'nocache' else conv_opts + cache_opts
+        outputs.append(do_conversion(mcnp_i, run_dir, opts).read_text())
+    assert outputs[0] == outputs[1]
+    assert outputs[0] == outputs[2]
+
+
+def test_cache_invalidation(datadir, tmp_path):
+    '''Test that the cache is invalidated when the input file changes.'''
+    mcnp_i = datadir / 'lattice_fill.imcnp'
+    conv_opts, _, _ = get_options(mcnp_i)
+    cache_opts = ['--cache', '--cache-dir', str(tmp_path / 'cache')]
+    t4_before = do_conversion(mcnp_i, tmp_path, conv_opts + cache_opts)
+    text_before = t4_before.read_text()
+    # modify the radius of a surface
+    mcnp_text = mcnp_i.read_text()
+    mcnp_text = mcnp_text.replace('10 SO 4', '10 SO 5')
+    assert '10 SO 5' in mcnp_text
+    mcnp_i.write_text(mcnp_text)
+    t4_after = do_conversion(mcnp_i, tmp_path, conv_opts + cache_opts)
+    text_after = t4_after.read_text()
+    assert text_before != text_after
+    assert 'SURF 10 SPHERE 0 0 0 5.0' in text_after
+
+
+@foreach_data(mcnp_i=lambda path: str(path).endswith('.imcnp'))
+def test_incremental(mcnp_i, tmp_path):
+    '''Test that incremental conversions yield the same output as full
+    conversions, both on the first run and when nothing changed.'''
+    conv_opts, _, _ = get_options(mcnp_i)
+    (tmp_path / 'full').mkdir()
+    t4_full = do_conversion(mcnp_i, tmp_path / 'full', conv_opts)
+    for _ in range(2):
+        t4_incr = do_conversion(mcnp_i, tmp_path,
+                                conv_opts + ['--incremental'])
+        assert t4_incr.read_text() == t4_full.read_text()
+
+
+def test_incremental_change(datadir, tmp_path):
+    '''Test that incremental conversions take input changes into account.'''
+    mcnp_i = datadir / 'lattice_fill.imcnp'
+    conv_opts, _, _ = get_options(mcnp_i)
+    do_conversion(mcnp_i, tmp_path, conv_opts + ['--incremental'])
+    # modify the radius of a surface
+    mcnp_text = mcnp_i.read_text()
+    mcnp_text = mcnp_text.replace('10 SO 4', '10 SO 5')
+    assert '10 SO 5' in mcnp_text
+    mcnp_i.write_text(mcnp_text)
+    t4_incr = do_conversion(mcnp_i, tmp_path, conv_opts + ['--incremental'])
+    (tmp_path / 'full').mkdir()
+    t4_full = do_conversion(mcnp_i, tmp_path / 'full', conv_opts)
+    assert 'SURF 10 SPHERE 0 0 0 5.0' in t4_incr.read_text()
+    assert t4_incr.read_text() == t4_full.read_text()
+
+
+@pytest.mark.parametrize('old,new,patched', [
+    ('5  PZ   1.5', '5  PZ   2.5', True),
+    ('-1    3   -4', '-1    3   -4 (-5:2)', True),
+    ('-1    3   -4', '-1    2   -4', True),
+    ('  vol=', ' (-5:2) vol=', True),
+    ('347 -2.7', '347 -2.8', False),
+    ('5  PZ   1.5', '5  PZ   0.5', False)])
+def test_incremental_patch(datadir, tmp_path, capsys, old, new, patched):
+    '''Test that incremental conversions patch the previous output when only
+    surfaces and plain cells are modified, and that the result is the same as
+    the output of a full conversion, also after reverting the modification.'''
+    mcnp_i = datadir / 'slab.imcnp'
+    conv_opts, _, _ = get_options(mcnp_i)
+    t4_orig = do_conversion(mcnp_i, tmp_path, conv_opts + ['--incremental'])
+    orig_text = t4_orig.read_text()
+    mcnp_text = mcnp_i.read_text()
+    assert old in mcnp_text
+    mcnp_i.write_text(mcnp_text.replace(old, new))
+    capsys.readouterr()
+    t4_incr = do_conversion(mcnp_i, tmp_path, conv_opts + ['--incremental'])
+    out = capsys.readouterr().out
+    assert ('converting the whole deck' not in out) == patched
+    (tmp_path / 'full').mkdir()
+    t4_full = do_conversion(mcnp_i, tmp_path / 'full', conv_opts)
+    assert t4_incr.read_text() == t4_full.read_text()
+    # revert the modification
+    mcnp_i.write_text(mcnp_text)
+    t4_incr = do_conversion(mcnp_i, tmp_path, conv_opts + ['--incremental'])
+    assert t4_incr.read_text() == orig_text
+
+
+def test_dedup_tolerance(datadir, tmp_path):
+    '''Test that the tolerant deduplication merges the surfaces that differ
+    only by rounding errors after the development of nested TRCLs.'''
+    mcnp_i = datadir / 'trcl_nested.imcnp'
+    conv_opts, _, _ = get_options(mcnp_i)
+    n_surfs = []
+    for tol in ('0', '1e-9'):
+        run_dir = tmp_path / tol
+        run_dir.mkdir()
+        t4_o = do_conversion(mcnp_i, run_dir,
+                             conv_opts + ['--dedup-tolerance', tol])
+        n_surfs.append(t4_o.read_text().count('\nSURF '))
+    assert n_surfs[1] < n_surfs[0]
+
+
+def test_transformed_surface_memo(datadir, tmp_path):
+    '''Test that a surface transformed in the same way several times is only
+    emitted once, even without deduplication.'''
+    mcnp_i = datadir / 'fill_2times.imcnp'
+    conv_opts, _, _ = get_options(mcnp_i)
+    t4_o = do_conversion(mcnp_i, tmp_path,
+                         conv_opts + ['--skip-deduplication'])
+    surfs = [line.split(None, 2)[2] for line in t4_o.read_text().splitlines()
+             if line.startswith('SURF ')]
+    assert len(surfs) == len(set(surfs))
+
+
+def test_volume_dedup(datadir, tmp_path):
+    '''Test that the identical fictive volumes are written only once, and that
+    all the other volumes are still written.'''
+    mcnp_i = datadir / 'long_intersection.imcnp'
+    conv_opts, _, _ = get_options(mcnp_i)
+    volus = []
+    for opts in ([], ['--skip-volume-deduplication']):
+        run_dir = tmp_path / str(len(opts))
+        run_dir.mkdir()
+        t4_o = do_conversion(mcnp_i, run_dir, conv_opts + opts)
+        volus.append([line for line in t4_o.read_text().splitlines()
+                      if line.startswith('VOLU ')])
+    shared, full = volus
+    assert len(shared) < len(full)
+    assert len({line.split(None, 2)[2] for line in shared}) == len(shared)
+    assert ([line.split()[1] for line in shared if 'FICTIVE' not in line]
+            == [line.split()[1] for line in full if 'FICTIVE' not in line])
+
+
+def test_lattice_culling(datadir, tmp_path, capsys):
+    '''Test that the lattice elements lying outside the filled cell are not
+    developed.'''
+    mcnp_i = datadir / 'trcl.imcnp'
+    conv_opts, _, _ = get_options(mcnp_i)
+    t4_o = do_conversion(mcnp_i, tmp_path, conv_opts)
+    assert 'skipped 90 lattice elements' in capsys.readouterr().out
+    assert t4_o.read_text().count('\nVOLU ') < 100
+
+
+def test_phase_stats(datadir, tmp_path):
+    '''Test that the measurements of each phase of the conversion are
+    written to the ``--stats-json`` file.'''
+    import json
+    mcnp_i = datadir / 'lattice_fill.imcnp'
+    conv_opts, _, _ = get_options(mcnp_i)
+    stats_path = tmp_path / 'stats.json'
+    t4_o = do_conversion(mcnp_i, tmp_path,
+                         conv_opts + ['--stats-json', str(stats_path)])
+    stats = json.loads(stats_path.read_text())
+    assert list(stats['phases']) == ['parse', 'surfaces', 'trcl',
+                                     'complements', 'lattice', 'fill',
+                                     'cells', 'dedup', 'write',
+                                     'compositions']
+    for phase in stats['phases'].values():
+        assert phase['wall'] >= 0.
+        assert phase['cpu'] >= 0.
+        assert phase['calls'] >= 1
+    counts = stats['counts']
+    assert counts['volumes_written'] == t4_o.read_text().count('\nVOLU ')
+    assert counts['surfaces_written'] == t4_o.read_text().count('\nSURF ')
+    assert counts['cells_created'] > 0
+    assert 0. <= stats['dedup_hit_rate'] <= 1.
+    assert counts['volume_dedup_checked'] == t4_o.read_text().count('FICTIVE')
+
+
+@foreach_data(mcnp_i=lambda path: str(path).endswith('.imcnp'))
+def test_simplify(mcnp_i, tmp_path, capsys):
+    '''Test the conversion with the simplification of the cell geometries.'''
+    conv_opts, _, _ = get_options(mcnp_i)
+    do_conversion(mcnp_i, tmp_path, conv_opts + ['--simplify',
+                                                 '--simplify-max-terms', '16'])
+    assert 'simplified the cell geometries' in capsys.readouterr().out
+
+
+@foreach_data(mcnp_i=lambda path: str(path).endswith('.imcnp'))
+def test_prune_planes(mcnp_i, tmp_path, capsys):
+    '''Test the conversion with the pruning of the redundant planes.'''
+    conv_opts, _, _ = get_options(mcnp_i)
+    do_conversion(mcnp_i, tmp_path, conv_opts + ['--prune-planes'])
+    assert 'redundant plane half-spaces' in capsys.readouterr().out
+
+
+@foreach_data(mcnp_i=lambda path: str(path).endswith('.imcnp'))
+def test_bounding_boxes(mcnp_i, tmp_path):
+    '''Test that the bounding boxes of the volumes are written as comments,
+    and that nothing else changes.'''
+    conv_opts, _, _ = get_options(mcnp_i)
+    outputs = []
+    for opts in ([], ['--bounding-boxes']):
+        run_dir = tmp_path / str(len(opts))
+        run_dir.mkdir()
+        t4_o = do_conversion(mcnp_i, run_dir, conv_opts + opts)
+        outputs.append(t4_o.read_text().splitlines())
+    plain, boxed = outputs
+    assert all(' // BBOX ' in line for line in boxed
+               if line.startswith('VOLU '))
+    assert [line.split(' // BBOX ')[0] for line in boxed] == plain
+
+
+@foreach_data(mcnp_i=lambda path: str(path).endswith('.imcnp'))
+def test_model_file(mcnp_i, tmp_path):
+    '''Test that the conversion of the model file written by --dump-model
+    yields the same output as the conversion of the MCNP input.'''
+    conv_opts, _, _ = get_options(mcnp_i)
+    model = tmp_path / (mcnp_i.name + '.model')
+    t4_o = do_conversion(mcnp_i, tmp_path,
+                         conv_opts + ['--dump-model', str(model)])
+    t4_model = do_conversion(model, tmp_path, conv_opts + ['--from-model'])
+    assert t4_model.read_text() == t4_o.read_text()
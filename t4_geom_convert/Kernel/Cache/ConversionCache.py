@@ -0,0 +1,228 @@
+'''Module containing the :class:`ConversionCache` class, a content-addressed
+disk cache for the intermediate results of the conversion.'''
+
+import os
+import copyreg
+import hashlib
+import pickle
+import tempfile
+from pathlib import Path
+
+from ..Volume.VolumeSpill import VolumeSpill
+
+
+class ConversionCache:
+    '''A content-addressed cache for the artifacts of the conversion stages.
+
+    Each artifact is stored in a file whose name is derived from a hash of:
+
+    * the normalized text of the MCNP cards (comments and redundant spaces are
+      stripped, so that cosmetic edits do not invalidate the cache);
+    * the version of the converter;
+    * the version of the cache format (:attr:`FORMAT_VERSION`);
+    * the name of the conversion stage;
+    * the command-line options that affect the stage.
+
+    The batches of the :class:`~.VolumeSpill` objects contained in an artifact
+    are not pickled with it: they are copied after the pickle, and copied back
+    into new spills when the artifact is loaded, so that the volumes are never
+    held in memory all at once.
+
+    Any change in the input, in the converter or in the relevant options
+    therefore results in a cache miss, never in a stale result.
+
+    The cache directory is versioned and its total size is kept below
+    `max_size` bytes by evicting the least recently used artifacts.
+
+    >>> import tempfile
+    >>> with tempfile.TemporaryDirectory() as tmpdir:
+    ...     cache = ConversionCache(tmpdir, 'some card text', version='1.0')
+    ...     cache.fetch('stage', lambda: [1, 2, 3], verbose=False)
+    ...     cache.fetch('stage', lambda: 'not called', verbose=False)
+    ...     cache.fetch('stage', lambda: 'other opts', {'lattice': 1},
+    ...                 verbose=False)
+    [1, 2, 3]
+    [1, 2, 3]
+    'other opts'
+    '''
+
+    #: Version of the on-disk format; bump it to invalidate old caches.
+    FORMAT_VERSION = 2
+
+    #: Default maximum size of the cache directory, in bytes.
+    DEFAULT_MAX_SIZE = 2 * 1024**3
+
+    def __init__(self, path, card_text, *, version,
+                 max_size=DEFAULT_MAX_SIZE):
+        '''Create a cache rooted at `path`.
+
+        :param path: the root cache directory
+        :type path: str or path-like object
+        :param str card_text: the normalized text of the MCNP cards
+        :param str version: the version of the converter
+        :param int max_size: the maximum size of the cache, in bytes
+        '''
+        self.path = Path(path) / 'v{}'.format(self.FORMAT_VERSION)
+        self.max_size = max_size
+        hasher = hashlib.sha256()
+        hasher.update(str(version).encode('utf-8'))
+        hasher.update(b'\0')
+        hasher.update(card_text.encode('utf-8'))
+        self.input_digest = hasher.hexdigest()
+
+    @classmethod
+    def from_parser(cls, path, mcnp_parser, **kwargs):
+        '''Create a cache for the input file read by `mcnp_parser`. The cache
+        key is computed from the content of all the cards in the input file.
+        '''
+        card_text = '\n'.join(card.content()
+                              for card in mcnp_parser.cards(blocks='csd',
+                                                            skipcomments=True))
+        return cls(path, card_text, **kwargs)
+
+    def key(self, stage, options=None):
+        '''Return the cache key for the given stage and options.
+
+        :param str stage: the name of the conversion stage
+        :param dict options: the options that affect the result of the stage;
+            the values must have a deterministic :func:`repr`.
+        '''
+        hasher = hashlib.sha256()
+        hasher.update(self.input_digest.encode('ascii'))
+        hasher.update(stage.encode('utf-8'))
+        for opt_key, opt_value in sorted((options or {}).items()):
+            hasher.update('\0{}={!r}'.format(opt_key, opt_value)
+                          .encode('utf-8'))
+        return '{}-{}'.format(stage, hasher.hexdigest())
+
+    def artifact_path(self, stage, options=None):
+        '''Return the path to the artifact for the given stage and options.'''
+        return self.path / (self.key(stage, options) + '.pickle')
+
+    def load(self, stage, options=None):
+        '''Load an artifact from the cache.
+
+        :returns: a pair consisting of a boolean (`True` if the artifact was
+            found) and of the artifact itself (`None` if it was not found).
+        '''
+        path = self.artifact_path(stage, options)
+        try:
+            with path.open('rb') as artifact:
+                unpickler = _ArtifactUnpickler(artifact)
+                value = unpickler.load()
+                for spill in unpickler.spills:
+                    spill.read_batches(artifact)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError,
+                ImportError):
+            # missing, truncated or incompatible artifact: treat as a miss
+            return False, None
+        # mark the artifact as recently used
+        os.utime(str(path), None)
+        return True, value
+
+    def store(self, stage, value, options=None):
+        '''Store an artifact in the cache and evict old artifacts if the
+        cache grew too large.'''
+        self.path.mkdir(parents=True, exist_ok=True)
+        path = self.artifact_path(stage, options)
+        # write atomically, so that concurrent runs never see a partial file
+        fd, tmp_name = tempfile.mkstemp(dir=str(self.path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as artifact:
+                pickler = _ArtifactPickler(artifact)
+                pickler.dump(value)
+                for spill in pickler.spills:
+                    spill.write_batches(artifact)
+            os.replace(tmp_name, str(path))
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+        self.evict(keep=path)
+
+    def fetch(self, stage, compute, options=None, *, verbose=True):
+        '''Return the artifact for the given stage, computing it with
+        `compute()` and storing it if it is not in the cache.'''
+        found, value = self.load(stage, options)
+        if found:
+            if verbose:
+                print('reading {} from cache {}'
+                      .format(stage, self.artifact_path(stage, options)),
+                      flush=True)
+            return value
+        value = compute()
+        self.store(stage, value, options)
+        return value
+
+    def evict(self, keep=None):
+        '''Remove the least recently used artifacts until the size of the
+        cache is below :attr:`max_size`. The `keep` artifact is never
+        removed.'''
+        entries = []
+        for path in self.path.glob('*.pickle'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total -= size
+
+
+def _restore_spill(header):
+    '''Placeholder for the spills in the pickles of the artifacts; it is
+    replaced by :meth:`_ArtifactUnpickler.restore_spill` when loading.'''
+    raise pickle.UnpicklingError('volume spills can only be restored from '
+                                 'a conversion cache artifact')
+
+
+class _ArtifactPickler(pickle.Pickler):
+    '''A pickler that records the :class:`~.VolumeSpill` objects and only
+    pickles their headers.'''
+
+    def __init__(self, file):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.spills = []
+        self.dispatch_table = copyreg.dispatch_table.copy()
+        self.dispatch_table[VolumeSpill] = self.reduce_spill
+
+    def reduce_spill(self, spill):
+        '''Pickle the header of `spill`, and record it.'''
+        self.spills.append(spill)
+        return _restore_spill, (spill.header(),)
+
+
+class _ArtifactUnpickler(pickle.Unpickler):
+    '''The unpickler for the pickles written by :class:`_ArtifactPickler`;
+    the spills are recreated empty, in the order in which they were
+    pickled.'''
+
+    def __init__(self, file):
+        super().__init__(file)
+        self.spills = []
+
+    def find_class(self, module, name):
+        if module == __name__ and name == '_restore_spill':
+            return self.restore_spill
+        return super().find_class(module, name)
+
+    def restore_spill(self, header):
+        '''Recreate a spill from its header, and record it.'''
+        spill = VolumeSpill.from_header(header)
+        self.spills.append(spill)
+        return spill
+
+
+def default_cache_dir():
+    '''Return the default cache directory, following the XDG conventions.'''
+    xdg_cache = os.environ.get('XDG_CACHE_HOME')
+    base = Path(xdg_cache) if xdg_cache else Path.home() / '.cache'
+    return base / 't4_geom_convert'
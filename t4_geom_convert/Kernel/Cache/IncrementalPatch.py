@@ -0,0 +1,525 @@
+'''Module containing :func:`patch_output`, which applies the modifications of
+the MCNP cards to the output of the previous run, using the index recorded in
+an :class:`~.IncrementalState`, instead of converting the whole deck again.'''
+
+import re
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from itertools import accumulate
+
+from MIP.geom.cells import get_cells
+from MIP.geom.main import extract_surfaces_list
+from MIP.geom.surfaces import get_surfaces
+
+from .IncrementalState import file_digest, surface_id, plain_cell
+from ..FileHandlers.Parser.ParseMCNPCell import ParseMCNPCell
+from ..FileHandlers.Parser.ParseMCNPSurface import parse_surface_item
+from ..FileHandlers.Writer.WriteT4Geometry import (GEOMETRY_HEADER,
+                                                   surface_record,
+                                                   volume_record)
+from ..Surface.CollectionDict import CollectionDict
+from ..Surface.ConversionSurfaceMCNPToT4 import convert_mcnp_surface
+from ..Surface.Duplicates import canonical_surface, dedup_renumbering
+from ..Transformation.Transformation import (get_mcnp_transforms,
+                                             transformation)
+from ..Volume.CellConversion import CellConversion, convert_new_surface
+from ..Volume.ConstructVolumeT4 import union_planes, remove_empty_cells
+from ..Volume.DictVolumeT4 import DictVolumeT4, renumbering_table
+from ..Volume.Duplicates import VolumeTable
+
+
+#: Matches the complements of cells in the geometry of a cell card.
+COMPLEMENT_RE = re.compile(r'#\s*(\d+)')
+
+
+class PatchError(Exception):
+    '''Raised when the modifications of the input cannot be applied to the
+    previous output; the whole deck must be converted again.'''
+
+
+def patch_output(state, mcnp_parser, path, changes, options, args,
+                 lattice_params):
+    '''Apply the modifications of the MCNP cards to the output file at `path`,
+    which must have been written by the previous run, and update the index of
+    `state` accordingly.
+
+    Only the modifications of surface cards and of cell cards are applied:
+
+    * a modified surface is converted again, along with its transformed
+      copies; the conversion must yield the same number of TRIPOLI-4
+      surfaces, with the same sides, the boundary condition must not change,
+      the surface must not be used by a lattice or a filled cell, and the
+      deduplication of the surfaces must not change;
+    * a modified cell is converted again, along with the cells that refer to
+      it (complements and ``LIKE n BUT``); all of them must be plain cells
+      (see :func:`~.plain_cell`) with unchanged attributes, and their
+      conversion must use the same volume IDs.
+
+    Only the affected SURF and VOLU records are rewritten.
+
+    :param changes: the pair of sets returned by
+        :meth:`~.IncrementalState.update_cards`
+    :param options: the fingerprint of the conversion options
+    :returns: a pair consisting of the numbers of rewritten SURF and VOLU
+        records
+    :raises PatchError: if the modifications cannot be applied; the index of
+        `state` must then be cleared
+    '''
+    modified, added_removed = changes
+    if state.output is None:
+        raise PatchError('no index of the previous output')
+    if state.options != options:
+        raise PatchError('the options changed')
+    if (args.dump_model is not None or args.prune_planes
+            or args.bounding_boxes):
+        raise PatchError('--dump-model, --prune-planes and --bounding-boxes '
+                         'require a full conversion')
+    if added_removed:
+        raise PatchError('cards were added or removed')
+    if any(ident[0] not in 'cs' or len(ident) != 2 for ident in modified):
+        raise PatchError('data cards or duplicate cards were modified')
+    if file_digest(path) != state.output:
+        raise PatchError('the output file was modified')
+    if not modified:
+        return 0, 0
+    try:
+        surf_keys = sorted(int(name) for block, name in modified
+                           if block == 's')
+        cell_keys = sorted(int(name) for block, name in modified
+                           if block == 'c')
+    except ValueError:
+        raise PatchError('unexpected card names') from None
+
+    with open(str(path)) as output:
+        records = GeometryRecords(output.read())
+    surfaces = SurfaceConverter(state, mcnp_parser)
+    new_t4 = _patch_surfaces(state, surfaces, surf_keys, records,
+                             args.dedup_tolerance)
+    n_volu = _patch_cells(state, mcnp_parser, surfaces, cell_keys, records,
+                          new_t4, args, lattice_params)
+    with open(str(path), 'w') as output:
+        output.write(records.text())
+    state.output = file_digest(path)
+    return records.n_surf_written, n_volu
+
+
+class GeometryRecords:
+    '''The records of the geometry section of an output file, as written by
+    :func:`~.writeT4Geometry`.'''
+
+    def __init__(self, text):
+        '''Split `text` into SURF records, VOLU records and the rest of the
+        file.'''
+        if not text.startswith(GEOMETRY_HEADER):
+            raise PatchError('unexpected format of the output file')
+        lines = text[len(GEOMETRY_HEADER):].splitlines(keepends=True)
+        #: TRIPOLI-4 surface ID -> SURF record
+        self.surfs = {}
+        #: the VOLU records, in order
+        self.volus = []
+        try:
+            i = 0
+            while lines[i] != '\n':
+                self.surfs[int(lines[i].split(None, 2)[1])] = lines[i]
+                i += 1
+            i += 1
+            while lines[i] != '\n':
+                self.volus.append(lines[i])
+                i += 1
+        except (IndexError, ValueError):
+            raise PatchError('unexpected format of the output file') from None
+        self.rest = lines[i:]
+        self.n_surf_written = 0
+
+    def volume_keys(self):
+        '''Return the IDs of the volumes, in order.'''
+        return [int(record.split(None, 2)[1]) for record in self.volus]
+
+    def write_surface(self, key, surf):
+        '''Rewrite the SURF record of surface `key` (`surf` may be `None` to
+        remove it).'''
+        if surf is None:
+            del self.surfs[key]
+        else:
+            self.surfs[key] = surface_record(key, surf)
+        self.n_surf_written += 1
+
+    def text(self):
+        '''Return the text of the geometry section.'''
+        return ''.join([GEOMETRY_HEADER]
+                       + [self.surfs[key] for key in sorted(self.surfs)]
+                       + ['\n'] + self.volus + self.rest)
+
+
+class SurfaceConverter:
+    '''Parse and convert the MCNP surfaces (and their transformed copies) of
+    the input on demand.'''
+
+    def __init__(self, state, mcnp_parser):
+        self.state = state
+        self.mcnp_parser = mcnp_parser
+        self._parsed = None
+        self._transforms = None
+        self._owners = None
+
+    def convert(self, keys):
+        '''Parse and convert the original MCNP surfaces `keys` and all their
+        transformed copies.
+
+        :returns: a pair of dictionaries associating the IDs of the converted
+            MCNP surfaces to their parts and to their
+            :class:`~.SurfaceCollection`
+        '''
+        if self._parsed is None:
+            self._parsed = get_surfaces(self.mcnp_parser, lim=None)
+            self._transforms = get_mcnp_transforms(self.mcnp_parser)
+        mcnp_surfs = CollectionDict()
+        t4_surfs = {}
+        for key in keys:
+            mcnp_surfs[key] = parse_surface_item((key, self._parsed[key]),
+                                                 self._transforms)
+            t4_surfs[key] = convert_mcnp_surface(key, mcnp_surfs[key])
+        # the transformed copies are numbered after the surfaces they are
+        # transformed from
+        derived_surfs = self.state.derived_surfs
+        for key in sorted(derived_surfs):
+            leaf, transf = derived_surfs[key]
+            if surface_id(leaf) not in mcnp_surfs:
+                continue
+            if transf is None:
+                raise PatchError('surface {} is translated by a lattice'
+                                 .format(surface_id(leaf)))
+            parts = [(transformation(transf, surf), side)
+                     for surf, side in mcnp_surfs[abs(leaf)]]
+            mcnp_surfs[key] = parts
+            t4_surfs[key] = convert_new_surface(leaf, parts)
+        return mcnp_surfs, t4_surfs
+
+    def t4_surface(self, t4_key):
+        '''Convert the TRIPOLI-4 surface `t4_key` again.'''
+        if self._owners is None:
+            self._owners = {abs(t4_id): (key, index)
+                            for key, ids in self.state.matching.items()
+                            for index, t4_id in enumerate(ids)}
+        try:
+            key, index = self._owners[t4_key]
+        except KeyError:
+            raise PatchError('unknown surface {}'.format(t4_key)) from None
+        _, t4_surfs = self.convert([self.state.original_surface(key)])
+        return t4_surfs[key].surfs[index][0]
+
+
+def _patch_surfaces(state, surfaces, keys, records, tolerance):
+    '''Convert the modified surfaces `keys` again and rewrite their SURF
+    records.
+
+    :returns: a dictionary associating the IDs of the TRIPOLI-4 surfaces that
+        were converted again to the new surfaces
+    '''
+    for key in keys:
+        if key not in state.matching or key in state.derived_surfs:
+            raise PatchError('surface {} was not converted'.format(key))
+        if key in state.fill_surfs:
+            raise PatchError('surface {} is used by a lattice or a filled '
+                             'cell'.format(key))
+    if not keys:
+        return {}
+    mcnp_surfs, t4_surfs = surfaces.convert(keys)
+    for key in keys:
+        bound_cond = mcnp_surfs[key][0][0].boundary_cond or None
+        if bound_cond != state.bound_conds.get(key):
+            raise PatchError('the boundary condition of surface {} changed'
+                             .format(key))
+
+    new_t4 = {}
+    for key, surf_coll in t4_surfs.items():
+        t4_ids = state.matching[key]
+        if len(surf_coll.surfs) != len(t4_ids) or any(
+                side * abs(t4_id) != t4_id
+                for (_, side), t4_id in zip(surf_coll.surfs, t4_ids)):
+            raise PatchError('the conversion of surface {} changed'
+                             .format(key))
+        for (surf, _), t4_id in zip(surf_coll.surfs, t4_ids):
+            new_t4[abs(t4_id)] = surf
+
+    if state.canonical is not None:
+        for t4_key, surf in new_t4.items():
+            state.canonical[t4_key] = canonical_surface(surf)
+        renumbering = dict(dedup_renumbering(sorted(state.canonical.items()),
+                                             tolerance))
+        if renumbering != state.renumbering:
+            raise PatchError('the duplicate surfaces changed')
+
+    for t4_key, surf in new_t4.items():
+        if t4_key in records.surfs:
+            records.write_surface(t4_key, surf)
+    return new_t4
+
+
+def _patch_cells(state, mcnp_parser, surfaces, keys, records, new_t4, args,
+                 lattice_params):
+    '''Convert the modified cells `keys` and the cells that refer to them
+    again, and rewrite their VOLU records, as well as the SURF records of the
+    surfaces that they start or stop using.
+
+    If the number of fictive volumes of a cell changes, the IDs of the
+    fictive volumes of the following cells are shifted accordingly.
+
+    :returns: the number of rewritten VOLU records, including the shifted
+        ones
+    '''
+    if not keys:
+        return 0
+    if args.simplify:
+        raise PatchError('cells cannot be patched with --simplify')
+    cards = get_cells(mcnp_parser, lim=None)
+    complemented = {}
+    referrers = defaultdict(set)
+    for key, (_, geometry, _) in cards.items():
+        geometry = geometry.lower()
+        complemented[key] = {int(ref)
+                             for ref in COMPLEMENT_RE.findall(geometry)}
+        liked = {int(float(ref))
+                 for ref in ParseMCNPCell.LIKE_RE.findall(geometry)}
+        for ref in complemented[key] | liked:
+            referrers[ref].add(key)
+
+    affected = _closure(keys, referrers)
+    needed = _closure(affected, complemented)
+    if not needed <= cards.keys():
+        raise PatchError('unknown cells are referred to')
+    parser = ParseMCNPCell(mcnp_parser, lattice_params, args.geometry_parser)
+    cells = parser.parse_some_cells(needed)
+    for key in needed:
+        if key in affected:
+            recorded = state.cells.get(key)
+            if recorded is None or plain_cell(cells[key]) != recorded[0]:
+                raise PatchError('cell {} is not a plain cell, or its '
+                                 'attributes changed'.format(key))
+        elif cells[key].trcl:
+            raise PatchError('cell {} is transformed'.format(key))
+
+    conv = CellConversion(0, 0, None, None, None, cells)
+    table = (renumbering_table(state.renumbering)
+             if state.renumbering is not None else None)
+    volumes = (VolumeTable(state.volume_ids, state.volume_aliases)
+               if state.volume_ids is not None else None)
+    positions = {vol_key: i
+                 for i, vol_key in enumerate(records.volume_keys())}
+    # the cells are processed in the order of the output, and the volume IDs
+    # are shifted as we go: `old_ranges` holds the ranges of the output file
+    old_ranges = {key: state.cells[key][1:] for key in affected}
+    blocks = []
+    shifts = []
+    used_before = Counter()
+    used_after = Counter()
+    for key in sorted(affected, key=lambda key: old_ranges[key]):
+        attributes, first_key, last_key = state.cells[key]
+        dic_volume = _convert_plain_cell(conv, cells[key], key, first_key,
+                                         state, table)
+        new_last_key = conv.new_cell_key
+        state.cells[key] = (attributes, first_key, new_last_key)
+
+        old_first, old_last = old_ranges[key]
+        old = sorted(positions[vol_key] for vol_key in positions
+                     if vol_key == key or old_first < vol_key <= old_last)
+        if not old or old[-1] - old[0] != len(old) - 1:
+            raise PatchError('the volumes of cell {} are not contiguous'
+                             .format(key))
+        for i in old:
+            used_before.update(_volume_surfaces(records.volus[i]))
+
+        if volumes is not None:
+            _unshare(volumes, key, first_key, last_key)
+        if new_last_key != last_key:
+            shifts.append((old_last, new_last_key - last_key))
+            _shift_state(state, volumes, key, last_key,
+                         new_last_key - last_key)
+        new_records = []
+        for vol_key, val in dic_volume.items():
+            if volumes is not None:
+                first = volumes.share(vol_key, val)
+                if first is not None:
+                    if first > new_last_key:
+                        raise PatchError('the volumes of cell {} are shared '
+                                         'with the following cells'
+                                         .format(key))
+                    continue
+            used_after.update(val.pluses)
+            used_after.update(val.minuses)
+            new_records.append(volume_record(vol_key, val, val.comment()))
+        blocks.append((old[0], old[-1] + 1, new_records))
+
+    n_shifted = _shift_records(records, blocks, shifts) if shifts else 0
+    # replace the VOLU records, from the last block to the first one, so that
+    # the positions of the blocks remain valid
+    for start, stop, new_records in sorted(blocks, reverse=True):
+        records.volus[start:stop] = new_records
+
+    surf_used = state.surf_used
+    surf_used.subtract(used_before)
+    surf_used.update(used_after)
+    unions = union_planes(state.union_ids)
+    for t4_key in sorted(used_before.keys() | used_after.keys()):
+        if surf_used[t4_key] <= 0:
+            del surf_used[t4_key]
+            if t4_key in records.surfs:
+                records.write_surface(t4_key, None)
+        elif t4_key not in records.surfs:
+            if t4_key in new_t4:
+                surf = new_t4[t4_key]
+            elif t4_key in unions:
+                surf = unions[t4_key]
+            else:
+                surf = surfaces.t4_surface(t4_key)
+            records.write_surface(t4_key, surf)
+    return n_shifted + sum(len(new_records) for _, _, new_records in blocks)
+
+
+def _convert_plain_cell(conv, cell, key, first_key, state, table):
+    '''Convert the plain cell `cell` like :func:`~.construct_volume_t4` and
+    :func:`~.write_volumes` do, allocating the IDs of its fictive volumes
+    after `first_key`.
+
+    :returns: the :class:`~.DictVolumeT4` of the volumes of the cell
+    '''
+    geometry = conv.pot_complement(cell.geometry)
+    for leaf in extract_surfaces_list(geometry):
+        if surface_id(leaf) not in state.matching:
+            raise PatchError('cell {} uses a new surface'.format(key))
+    conv.dic_vol_t4 = dic_volume = DictVolumeT4()
+    conv.new_cell_key = first_key
+    j = conv.convert_cell(key, geometry, cell.idorigin, state.matching,
+                          state.union_ids)
+    if j is None:
+        raise PatchError('cell {} is empty'.format(key))
+    dic_volume[j].fictive = False
+    if j != key:
+        dic_volume.replace_key(j, key)
+    if table is not None:
+        dic_volume.renumber_surfaces(table)
+    remove_empty_cells(dic_volume)
+    if key not in dic_volume:
+        raise PatchError('cell {} is empty'.format(key))
+    return dic_volume
+
+
+def _closure(keys, edges):
+    '''Return the set of the cells that can be reached from `keys` by
+    following `edges`, including `keys` themselves.'''
+    reached = set(keys)
+    to_visit = list(keys)
+    while to_visit:
+        for key in edges.get(to_visit.pop(), ()):
+            if key not in reached:
+                reached.add(key)
+                to_visit.append(key)
+    return reached
+
+
+def _unshare(volumes, key, first_key, last_key):
+    '''Remove the volumes of cell `key`, whose fictive volumes have the IDs
+    larger than `first_key` and not larger than `last_key`, from the
+    :class:`~.VolumeTable` `volumes`.'''
+    def owned(vol_key):
+        return vol_key == key or first_key < vol_key <= last_key
+
+    for alias, first in volumes.aliases.items():
+        if owned(first) and not owned(alias):
+            raise PatchError('the volumes of cell {} are shared with other '
+                             'cells'.format(key))
+    for alias in [alias for alias in volumes.aliases if owned(alias)]:
+        del volumes.aliases[alias]
+    for struct in [struct for struct, first in volumes.ids.items()
+                   if owned(first)]:
+        del volumes.ids[struct]
+
+
+def _shift_state(state, volumes, key, last_key, delta):
+    '''Add `delta` to the ranges of the cells following cell `key`, and to
+    the IDs of the fictive volumes larger than `last_key` in the
+    :class:`~.VolumeTable` `volumes` (if not `None`).'''
+    def shift(vol_key):
+        return vol_key + delta if vol_key > last_key else vol_key
+
+    cells = state.cells
+    following = False
+    for cell_key, (attributes, first_key, cell_last_key) in cells.items():
+        if following:
+            cells[cell_key] = (attributes, first_key + delta,
+                               cell_last_key + delta)
+        following = following or cell_key == key
+    if volumes is None:
+        return
+    new_ids = {}
+    for (pluses, minuses, ops), first in volumes.ids.items():
+        if ops is not None:
+            ops = (ops[0], tuple(map(shift, ops[1])))
+        new_ids[pluses, minuses, ops] = shift(first)
+    volumes.ids.clear()
+    volumes.ids.update(new_ids)
+    new_aliases = {shift(alias): shift(first)
+                   for alias, first in volumes.aliases.items()}
+    volumes.aliases.clear()
+    volumes.aliases.update(new_aliases)
+
+
+def _shift_records(records, blocks, shifts):
+    '''Shift the IDs of the fictive volumes in the VOLU records that are not
+    rewritten.
+
+    :param blocks: the ``(start, stop, new records)`` triples of the
+        rewritten records
+    :param shifts: ``(last ID, shift)`` pairs, sorted by ID, meaning that the
+        IDs larger than `last ID` in `records` must be shifted
+    :returns: the number of shifted records
+    '''
+    bounds = [last_key for last_key, _ in shifts]
+    offsets = list(accumulate(delta for _, delta in shifts))
+
+    def shift(token):
+        index = bisect_left(bounds, int(token))
+        return str(int(token) + offsets[index - 1]) if index else token
+
+    rewritten = set()
+    for start, stop, _ in blocks:
+        rewritten.update(range(start, stop))
+    volus = records.volus
+    n_shifted = 0
+    for i in range(min(blocks)[0], len(volus)):
+        if i in rewritten:
+            continue
+        n_shifted += 1
+        head, tail = volus[i].split(' ENDV', 1)
+        tokens = head.split()
+        tokens[1] = shift(tokens[1])
+        i_op = 3
+        for word in ('PLUS', 'MINUS'):
+            if tokens[i_op] == word:
+                i_op += 2 + int(tokens[i_op + 1])
+        if i_op < len(tokens) and tokens[i_op] != 'FICTIVE':
+            n_ops = int(tokens[i_op + 1])
+            tokens[i_op + 2:i_op + 2 + n_ops] = map(
+                shift, tokens[i_op + 2:i_op + 2 + n_ops])
+        volus[i] = ' '.join(tokens) + ' ENDV' + tail
+    return n_shifted
+
+
+def _volume_surfaces(record):
+    '''Return the IDs of the surfaces used by the VOLU record `record` (see
+    :meth:`~.VolumeT4.__str__`).
+
+    >>> _volume_surfaces('VOLU 5 EQUA PLUS 2 1 3 MINUS 1 2 INTE 2 6 7 ENDV')
+    [1, 3, 2]
+    >>> _volume_surfaces('VOLU 6 EQUA UNION 2 6 7 FICTIVE ENDV')
+    []
+    '''
+    tokens = record.split()
+    surfs = []
+    i = 3
+    for word in ('PLUS', 'MINUS'):
+        if tokens[i] == word:
+            n_surfs = int(tokens[i + 1])
+            surfs.extend(int(token) for token in tokens[i + 2:i + 2 + n_surfs])
+            i += 2 + n_surfs
+    return surfs
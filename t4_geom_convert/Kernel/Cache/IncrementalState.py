@@ -0,0 +1,275 @@
+'''Module containing the tools for incremental reconversion: a record of the
+cards of the previous run and an index of its output file, which allow the
+next run to patch the output instead of converting the whole deck again (see
+:mod:`~.IncrementalPatch`).'''
+
+import os
+import hashlib
+import pickle
+import tempfile
+from collections import OrderedDict, Counter, defaultdict
+
+from ..Surface.Duplicates import canonical_surface
+
+
+def fingerprint(*parts):
+    '''Return a digest of the :func:`repr` of `parts`. The arguments must have
+    a deterministic representation.
+
+    >>> fingerprint(1, 'a') == fingerprint(1, 'a')
+    True
+    >>> fingerprint(1, 'a') == fingerprint('a', 1)
+    False
+    '''
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def file_digest(path):
+    '''Return a digest of the contents of the file at `path`, or `None` if
+    the file cannot be read.'''
+    try:
+        with open(str(path), 'rb') as content:
+            return hashlib.sha1(content.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def card_name(block, content):
+    '''Return the name of a card, i.e. its first token, normalized.
+
+    >>> card_name('c', '10 1 -1.0 -2 1 imp:n=1')
+    '10'
+    >>> card_name('s', '*10 SO 4')
+    '10'
+    >>> card_name('d', 'IMP:N 1 1 0')
+    'imp:n'
+    '''
+    name = content.split(None, 1)[0].lower()
+    if block == 's':
+        name = name.lstrip('*+')
+    return name
+
+
+def card_digests(mcnp_parser):
+    '''Return an ordered dictionary associating the identity of each card (as
+    a ``(block, name)`` pair) to a digest of its normalized content. Cards that
+    appear several times with the same name are disambiguated by an occurrence
+    counter.'''
+    digests = OrderedDict()
+    seen = defaultdict(int)
+    for card in mcnp_parser.cards(blocks='csd', skipcomments=True):
+        content = card.content().strip()
+        if not content:
+            continue
+        ident = (card.type, card_name(card.type, content))
+        occurrence = seen[ident]
+        seen[ident] += 1
+        if occurrence:
+            ident = ident + (occurrence,)
+        digests[ident] = hashlib.sha1(content.encode('utf-8')).digest()
+    return digests
+
+
+def diff_cards(old, new):
+    '''Compare two card digest dictionaries, as returned by
+    :func:`card_digests`.
+
+    :returns: a pair consisting of the set of identities of the cards that
+        were modified and of the set of identities of the cards that were
+        added or removed.
+
+    >>> old = {('c', '1'): 'a', ('c', '2'): 'b', ('s', '1'): 'c'}
+    >>> new = {('c', '1'): 'a', ('c', '2'): 'x', ('s', '2'): 'c'}
+    >>> modified, added_removed = diff_cards(old, new)
+    >>> sorted(modified), sorted(added_removed)
+    ([('c', '2')], [('s', '1'), ('s', '2')])
+    '''
+    modified = {ident for ident in old.keys() & new.keys()
+                if old[ident] != new[ident]}
+    return modified, set(old.keys() ^ new.keys())
+
+
+def plain_cell(cell):
+    '''Return the attributes of `cell` other than its geometry, if it is a
+    plain cell; return `None` otherwise.
+
+    Plain cells are the cells of the real world (universe 0) that are neither
+    filled nor transformed, and that are not created by the development of
+    the fills and of the lattices. Their volumes only depend on their
+    geometry, and no other cell depends on their volumes.
+    '''
+    if (cell.universe != 0 or cell.fillid is not None or cell.lattice
+            or cell.trcl or cell.idorigin):
+        return None
+    return cell.materialID, cell.density, cell.importance
+
+
+def surface_id(leaf):
+    '''Return the (positive) ID of the surface of the leaf `leaf`.'''
+    return abs(getattr(leaf, 'surface', leaf))
+
+
+class IncrementalState:
+    '''The state of a conversion, as saved at the end of a run and reloaded
+    at the beginning of the next one.
+
+    Besides the digests of the cards, the state holds an index of the output
+    file of the previous run, which is recorded by a full conversion and kept
+    up to date when the output is patched:
+
+    * the digest of the output file and the options it was produced with;
+    * the matching between the MCNP surfaces and the TRIPOLI-4 surfaces, the
+      IDs of the auxiliary surfaces for unions and the origin of the
+      transformed surfaces;
+    * the surfaces whose parameters determine the development of the
+      lattices, and the boundary conditions;
+    * the canonical forms of all the TRIPOLI-4 surfaces and their
+      renumbering by the deduplication;
+    * the number of written volumes using each surface, and the table of the
+      shared fictive volumes;
+    * the range of volume IDs allocated to each plain cell (see
+      :func:`plain_cell`).
+    '''
+
+    #: Version of the on-disk format of the state file.
+    FORMAT_VERSION = 2
+
+    def __init__(self, version):
+        '''Create a new, empty state.
+
+        :param str version: the version of the converter
+        '''
+        self.version = version
+        self.cards = OrderedDict()
+        self.options = None
+        self.clear_index()
+
+    def clear_index(self):
+        '''Forget the index of the output file.'''
+        #: digest of the output file, `None` if there is no index
+        self.output = None
+        #: MCNP surface ID -> signed TRIPOLI-4 surface IDs
+        self.matching = {}
+        self.union_ids = None
+        #: transformed surface ID -> (surface, transformation or `None`)
+        self.derived_surfs = {}
+        #: IDs of the original surfaces used by lattices or filled cells
+        self.fill_surfs = set()
+        #: MCNP surface ID -> boundary condition, if any
+        self.bound_conds = {}
+        #: TRIPOLI-4 surface ID -> canonical form, `None` without dedup
+        self.canonical = None
+        self.renumbering = None
+        #: TRIPOLI-4 surface ID -> number of written volumes using it
+        self.surf_used = Counter()
+        #: the state of the :class:`~.VolumeTable`, `None` without sharing
+        self.volume_ids = None
+        self.volume_aliases = None
+        #: plain cell ID -> (attributes, first volume ID, last volume ID)
+        self.cells = {}
+        self.skipped_cells = []
+
+    @classmethod
+    def load(cls, path, version):
+        '''Load the state saved at `path` by a previous run. Return an empty
+        state if the file does not exist or if it was written by a different
+        version of the converter.'''
+        state = cls(version)
+        try:
+            with open(str(path), 'rb') as state_file:
+                saved = pickle.load(state_file)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError,
+                ImportError):
+            return state
+        if (saved.get('format') != cls.FORMAT_VERSION
+                or saved.get('version') != version):
+            return state
+        state.__dict__.update(saved['state'])
+        return state
+
+    def save(self, path):
+        '''Save the state to `path`, atomically.'''
+        saved = {'format': self.FORMAT_VERSION,
+                 'version': self.version,
+                 'state': self.__dict__}
+        dirname = os.path.dirname(os.path.abspath(str(path)))
+        fd, tmp_name = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as state_file:
+                pickle.dump(saved, state_file,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_name, str(path))
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+
+    def update_cards(self, mcnp_parser):
+        '''Compare the cards read by `mcnp_parser` with the ones of the
+        previous run and record the new ones.
+
+        :returns: the pair of sets returned by :func:`diff_cards`.
+        '''
+        new_cards = card_digests(mcnp_parser)
+        changes = diff_cards(self.cards, new_cards)
+        self.cards = new_cards
+        return changes
+
+    def record_surfaces(self, dic_surface_mcnp, matching, union_ids,
+                        derived_surfs, fill_surfs):
+        '''Record the numbering of the TRIPOLI-4 surfaces.
+
+        :param dic_surface_mcnp: the MCNP surfaces, including the transformed
+            ones
+        :param matching: the MCNP-to-TRIPOLI-4 surface ID matching
+        :param union_ids: the IDs of the auxiliary surfaces for unions
+        :param derived_surfs: the origin of the transformed surfaces, see
+            :attr:`~.CellConversion.derived_surfs`
+        :param fill_surfs: the IDs of the surfaces used by lattices and
+            filled cells (possibly transformed surfaces)
+        '''
+        self.matching = matching
+        self.union_ids = union_ids
+        self.derived_surfs = dict(derived_surfs)
+        self.fill_surfs = {self.original_surface(key) for key in fill_surfs}
+        self.bound_conds = {key: parts[0][0].boundary_cond
+                            for key, parts in dic_surface_mcnp.items()
+                            if key not in derived_surfs
+                            and parts[0][0].boundary_cond}
+
+    def original_surface(self, key):
+        '''Return the ID of the original MCNP surface that the surface `key`
+        was transformed from.'''
+        while key in self.derived_surfs:
+            key = surface_id(self.derived_surfs[key][0])
+        return key
+
+    def record_cell(self, key, cell, first_key, last_key):
+        '''Record the range of volume IDs allocated to the conversion of
+        `cell`, if it is a plain cell (see :func:`plain_cell`). The volume IDs
+        are larger than `first_key` and not larger than `last_key`.'''
+        attributes = plain_cell(cell)
+        if attributes is not None:
+            self.cells[key] = (attributes, first_key, last_key)
+
+    def record_dedup(self, surfaces):
+        '''Record the canonical forms of the TRIPOLI-4 `surfaces`, before
+        their deduplication.'''
+        self.canonical = {key: canonical_surface(surf)
+                          for key, surf in surfaces.items()}
+
+    def record_written(self, renumbering, surf_used, volumes):
+        '''Record the renumbering of the surfaces, the number of written
+        volumes using each surface and the table of the shared volumes (or
+        `None`).'''
+        self.renumbering = renumbering
+        self.surf_used = surf_used
+        if volumes is not None:
+            self.volume_ids = volumes.ids
+            self.volume_aliases = volumes.aliases
+
+    def record_output(self, path, options, skipped_cells):
+        '''Record the digest of the output file at `path`, the options it was
+        produced with and the cells that were omitted from it.'''
+        self.output = file_digest(path)
+        self.options = options
+        self.skipped_cells = skipped_cells
@@ -17,11 +17,11 @@ class CDictCompositionMCNP(MutableMapping):
      material composition from MCNP
     '''
 
-    def __init__(self, mcnpParser):
+    def __init__(self, mcnpParser, materials=None):
         '''
         Constructor
         '''
-        self.d_compositionMCNP = parseMCNPComposition(mcnpParser)
+        self.d_compositionMCNP = parseMCNPComposition(mcnpParser, materials)
 
     def __getitem__(self, key):
         return self.d_compositionMCNP[key]
@@ -12,13 +12,14 @@ from .EIsotopeNameElementT4 import EIsotopeNameElement
 from .Abundances import Abundances
 
 
-def compositionConversionMCNPToT4(mcnp_parser):
+def compositionConversionMCNPToT4(mcnp_parser, materials=None):
     '''
     :brief: method recuperate the dictionary of the composition from MCNP
     and return a dictionary of the composition for T4
     '''
     d_composition_t4 = OrderedDict()
-    dict_compo_mcnp = CDictCompositionMCNP(mcnp_parser).d_compositionMCNP
+    dict_compo_mcnp = CDictCompositionMCNP(mcnp_parser,
+                                           materials).d_compositionMCNP
     for key, val in dict_compo_mcnp.items():
         atom_fracs = None
         l_composition_t4 = []
@@ -12,13 +12,14 @@ from .CCompositionT4 import CCompositionT4
 from .CompositionConversionMCNPToT4 import compositionConversionMCNPToT4
 
 
-def constructCompositionT4(mcnp_parser, dic_cell_mcnp):
+def constructCompositionT4(mcnp_parser, dic_cell_mcnp, materials=None):
     '''
     :brief: method changing the tuple from compositionConversionMCNPToT4
     in instance of the VolumeT4 Class
     '''
     dic_new_composition = OrderedDict()
-    for key, val in compositionConversionMCNPToT4(mcnp_parser).items():
+    compositions = compositionConversionMCNPToT4(mcnp_parser, materials)
+    for key, val in compositions.items():
         fractions = extract_isotopes_fractions(val.isotopes)
         densities = set()
         for cell_id, cell in dic_cell_mcnp.items():
@@ -0,0 +1,592 @@
+'''Module containing the reader and the writer of the binary model files.
+
+A model file holds the MCNP model as it is right after parsing: the parsed
+surfaces, the parsed cells and the material compositions. It is written by
+the ``--dump-model`` option and read by ``--from-model``; a conversion that
+starts from a model file does not read the MCNP input at all.
+
+The format is made of flat typed arrays, which are mapped in memory when the
+file is read. All the numbers are little-endian. The file starts with a
+header::
+
+    magic       8 bytes     b'T4GMODEL'
+    version     uint32      FORMAT_VERSION
+    n_sections  uint32
+
+followed by `n_sections` directory entries::
+
+    name        16 bytes    ASCII, NUL-padded
+    dtype       4 bytes     NumPy type string ('<i8', '<f8', '|u1', '|i1')
+    (padding)   4 bytes
+    offset      uint64      position of the data in the file
+    count       uint64      number of elements
+
+and by the data of the sections, each of them aligned on 8 bytes.
+
+The strings (names of the surface types, material IDs, densities...) are
+stored once: ``str.data`` holds their UTF-8 encoding, one after the other,
+and ``str.offsets`` the `n + 1` boundaries. A string is referred to by its
+index in the table.
+
+The small nested values (parameters of the surfaces, transformations, origin
+of the surfaces and cells) are stored in *value streams* of three sections:
+``<prefix>.kinds`` holds one code per item, ``<prefix>.floats`` and
+``<prefix>.ints`` the payloads of the numbers. The codes are ``f`` (float),
+``i`` (int), ``s`` (string, the index is in the ints), ``n`` (None), ``(``
+and ``)`` (beginning and end of a tuple), ``[`` and ``]`` (beginning and end
+of a list).
+
+The surfaces (stage ``mcnp_surfaces``) are stored in the ``surf.*`` sections:
+
+* ``surf.key``, ``surf.n``: the ID of each surface and its number of
+  subsurfaces;
+* ``surf.side``, ``surf.type``, ``surf.bc``: for each subsurface, its side,
+  the name of its type (a string) and its boundary condition (a string);
+* ``surf`` value stream: for each subsurface, its parameters, its
+  complementary parameters and its origin.
+
+The cells (stage ``mcnp_cells``) are stored in the ``cell.*``, ``geom.*`` and
+``lat.*`` sections:
+
+* ``cell.key``, ``cell.mat``, ``cell.dens`` (-1 for no density),
+  ``cell.imp`` (NaN for no importance), ``cell.univ``, ``cell.lat`` (0 for no
+  lattice): one element per cell;
+* ``cell.fillkind`` (0: no fill, 1: universe, 2: lattice) and ``cell.fill``
+  (the universe, or the index of the lattice in the ``lat.*`` sections);
+* ``cell.geom``: the number of instructions of the geometry of each cell;
+* ``geom.ops``, ``geom.args``: the geometries, as postfix bytecode. ``S``
+  pushes the (signed) surface `arg`, ``F`` sets the facet of the surface on
+  top of the stack to `arg`, ``C`` pushes the cell whose name is the string
+  `arg`; ``*``, ``:`` and ``^`` pop `arg` operands and push the
+  corresponding node;
+* ``lat.ndim``, ``lat.bounds``, ``lat.spec``: the number of dimensions, the
+  range bounds and the universes of each lattice;
+* ``cell`` value stream: for each cell, its fill transformation, its list of
+  TRCL transformations and its origin;
+* ``cell.skipped``: the cells with zero importance.
+
+The material compositions (stage ``mcnp_materials``) are stored in
+``mat.key``, ``mat.n`` (the number of parameters of each material) and
+``mat.params`` (the parameters, as strings).
+'''
+
+import math
+import mmap
+import os
+import struct
+import tempfile
+from array import array
+from collections import OrderedDict
+
+import numpy as np
+
+from MIP.geom.semantics import Cell, GeomExpression, Surface
+from ..Surface.CollectionDict import CollectionDict
+from ..Surface.ESurfaceTypeMCNP import ESurfaceTypeMCNP
+from ..Surface.SurfaceMCNP import SurfaceMCNP
+from ..Volume.CellMCNP import CellMCNP
+from ..Volume.Lattice import LatticeBounds, LatticeSpec
+from ..Instrumentation import phase, count
+
+
+MAGIC = b'T4GMODEL'
+
+#: Version of the model file format.
+FORMAT_VERSION = 1
+
+#: The stages of the conversion stored in a model file.
+STAGES = ('mcnp_materials', 'mcnp_surfaces', 'mcnp_cells')
+
+_HEADER = struct.Struct('<8sII')
+_ENTRY = struct.Struct('<16s4s4xQQ')
+
+_I8, _F8, _U1, _I1 = '<i8', '<f8', '|u1', '|i1'
+
+_FILL_NONE, _FILL_UNIVERSE, _FILL_LATTICE = 0, 1, 2
+
+
+class ModelWriter:
+    '''Record the results of the parsing stages and write them to a model
+    file.
+
+    The stages are passed to :meth:`fetch` as they are parsed; each stage is
+    encoded immediately, so that the later modifications of the parsed
+    objects by the conversion do not show in the file. The file is written
+    as soon as all the :data:`STAGES` have been recorded.
+
+    >>> import tempfile
+    >>> from pathlib import Path
+    >>> from collections import OrderedDict
+    >>> with tempfile.TemporaryDirectory() as tmpdir:
+    ...     path = Path(tmpdir) / 'model'
+    ...     writer = ModelWriter(path)
+    ...     materials = writer.fetch('mcnp_materials',
+    ...                              lambda: {1: ['1001', '0.5']})
+    ...     surfaces = writer.fetch('mcnp_surfaces', CollectionDict)
+    ...     cells = writer.fetch('mcnp_cells', lambda: (OrderedDict(), [5]))
+    ...     reader = ModelReader(path)
+    ...     dict(reader.fetch('mcnp_materials', None))
+    ...     reader.fetch('mcnp_cells', None)[1]
+    wrote the parsed model to ...
+    {1: ['1001', '0.5']}
+    [5]
+    '''
+
+    def __init__(self, path):
+        '''Create a writer for the model file `path`.'''
+        self.path = path
+        self.sections = OrderedDict()
+        self.strings = OrderedDict()
+        self.stages = set()
+
+    def fetch(self, stage, compute):
+        '''Compute the parsed `stage` with `compute()`, record it and return
+        it.'''
+        value = compute()
+        getattr(self, '_encode_' + stage[len('mcnp_'):])(value)
+        self.stages.add(stage)
+        if self.stages.issuperset(STAGES):
+            self.write()
+        return value
+
+    def add_section(self, name, dtype, data):
+        '''Add the section `name`, converting `data` to `dtype`.'''
+        self.sections[name] = np.array(data, dtype=dtype)
+
+    def _string(self, string):
+        return self.strings.setdefault(string, len(self.strings))
+
+    def _encode_materials(self, materials):
+        keys, lens, params = array('q'), array('q'), array('q')
+        for key, values in materials.items():
+            keys.append(key)
+            lens.append(len(values))
+            params.extend(self._string(value) for value in values)
+        self.add_section('mat.key', _I8, keys)
+        self.add_section('mat.n', _I8, lens)
+        self.add_section('mat.params', _I8, params)
+
+    def _encode_surfaces(self, surfaces):
+        keys, lens = array('q'), array('q')
+        sides, types, bconds = array('b'), array('q'), array('q')
+        stream = _ValueStream(self._string)
+        for key, subsurfaces in surfaces.items():
+            keys.append(key)
+            lens.append(len(subsurfaces))
+            for surf, side in subsurfaces:
+                sides.append(side)
+                types.append(self._string(surf.type_surface.name))
+                bconds.append(self._string(surf.boundary_cond))
+                stream.add(surf.param_surface)
+                stream.add(surf.compl_param)
+                stream.add(surf.idorigin)
+        self.add_section('surf.key', _I8, keys)
+        self.add_section('surf.n', _I8, lens)
+        self.add_section('surf.side', _I1, sides)
+        self.add_section('surf.type', _I8, types)
+        self.add_section('surf.bc', _I8, bconds)
+        stream.store(self, 'surf')
+
+    def _encode_cells(self, cells_and_skipped):
+        cells, skipped = cells_and_skipped
+        keys, mats, denss = array('q'), array('q'), array('q')
+        imps, univs, lats = array('d'), array('q'), array('b')
+        fillkinds, fills, geom_lens = bytearray(), array('q'), array('q')
+        ops, args = bytearray(), array('q')
+        lat_ndims, lat_bounds, lat_specs = array('q'), array('q'), array('q')
+        stream = _ValueStream(self._string)
+        for key, cell in cells.items():
+            keys.append(key)
+            mats.append(self._string(cell.materialID))
+            denss.append(-1 if cell.density is None
+                         else self._string(cell.density))
+            imps.append(float('nan') if cell.importance is None
+                        else cell.importance)
+            univs.append(cell.universe)
+            lats.append(cell.lattice or 0)
+            fillid = cell.fillid
+            if fillid is None:
+                fillkinds.append(_FILL_NONE)
+                fills.append(0)
+            elif isinstance(fillid, LatticeSpec):
+                fillkinds.append(_FILL_LATTICE)
+                fills.append(len(lat_ndims))
+                lat_ndims.append(len(fillid.bounds))
+                for bound in fillid.bounds:
+                    lat_bounds.extend(bound)
+                lat_specs.frombytes(
+                    np.asarray(fillid.spec, dtype=np.int64).tobytes())
+            else:
+                fillkinds.append(_FILL_UNIVERSE)
+                fills.append(fillid)
+            n_ops = len(ops)
+            _encode_geometry(cell.geometry, ops, args, self._string)
+            geom_lens.append(len(ops) - n_ops)
+            stream.add(cell.filltr)
+            stream.add(cell.trcl)
+            stream.add(cell.idorigin)
+        self.add_section('cell.key', _I8, keys)
+        self.add_section('cell.mat', _I8, mats)
+        self.add_section('cell.dens', _I8, denss)
+        self.add_section('cell.imp', _F8, imps)
+        self.add_section('cell.univ', _I8, univs)
+        self.add_section('cell.lat', _I1, lats)
+        self.add_section('cell.fillkind', _U1, fillkinds)
+        self.add_section('cell.fill', _I8, fills)
+        self.add_section('cell.geom', _I8, geom_lens)
+        self.add_section('cell.skipped', _I8, skipped)
+        self.add_section('geom.ops', _U1, ops)
+        self.add_section('geom.args', _I8, args)
+        self.add_section('lat.ndim', _I8, lat_ndims)
+        self.add_section('lat.bounds', _I8, lat_bounds)
+        self.add_section('lat.spec', _I8, lat_specs)
+        stream.store(self, 'cell')
+
+    def write(self):
+        '''Write the model file.'''
+        data = [string.encode('utf-8') for string in self.strings]
+        offsets = np.zeros(len(data) + 1, dtype=_I8)
+        np.cumsum([len(datum) for datum in data], out=offsets[1:])
+        self.add_section('str.offsets', _I8, offsets)
+        self.add_section('str.data', _U1, bytearray(b''.join(data)))
+        sections = list(self.sections.items())
+        offset = _HEADER.size + len(sections) * _ENTRY.size
+        entries, blobs = [], []
+        for name, section in sections:
+            offset = _align(offset)
+            entries.append(_ENTRY.pack(name.encode('ascii'),
+                                       section.dtype.str.encode('ascii'),
+                                       offset, len(section)))
+            blobs.append((offset, section.tobytes()))
+            offset += section.nbytes
+        directory = os.path.dirname(os.path.abspath(str(self.path)))
+        # write atomically, so that a failed run never leaves a partial file
+        fd, tmp_name = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as model_file:
+                model_file.write(_HEADER.pack(MAGIC, FORMAT_VERSION,
+                                              len(sections)))
+                model_file.write(b''.join(entries))
+                for offset, blob in blobs:
+                    model_file.write(b'\0' * (offset - model_file.tell()))
+                    model_file.write(blob)
+            # mkstemp creates the file with mode 0600
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_name, 0o666 & ~umask)
+            os.replace(tmp_name, str(self.path))
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+        print('wrote the parsed model to {}'.format(self.path), flush=True)
+
+
+class ModelReader:
+    '''Read the parsed stages from a model file written by
+    :class:`ModelWriter`.
+
+    The file is mapped in memory and its sections are NumPy arrays on the
+    map; the parsed objects are rebuilt by :meth:`fetch`.
+    '''
+
+    def __init__(self, path):
+        '''Open the model file `path`.
+
+        :raises ValueError: if the file is not a model file, or if it was
+            written in another version of the format.
+        '''
+        self.path = path
+        with open(str(path), 'rb') as model_file:
+            try:
+                self.data = mmap.mmap(model_file.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty file
+                self.data = b''
+        if len(self.data) < _HEADER.size:
+            raise ValueError('{} is not a model file'.format(path))
+        magic, version, n_sections = _HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise ValueError('{} is not a model file'.format(path))
+        if version != FORMAT_VERSION:
+            raise ValueError('{} was written in version {} of the model '
+                             'format, expected version {}'
+                             .format(path, version, FORMAT_VERSION))
+        self.sections = {}
+        for i in range(n_sections):
+            name, dtype, offset, n_elems = _ENTRY.unpack_from(
+                self.data, _HEADER.size + i * _ENTRY.size)
+            self.sections[name.rstrip(b'\0').decode('ascii')] = np.frombuffer(
+                self.data, dtype=dtype.rstrip(b'\0').decode('ascii'),
+                count=n_elems, offset=offset)
+        data = self.sections['str.data'].tobytes()
+        bounds = self.sections['str.offsets'].tolist()
+        self.strings = [data[start:end].decode('utf-8')
+                        for start, end in zip(bounds, bounds[1:])]
+
+    def fetch(self, stage, compute):
+        '''Return the parsed `stage`, read from the model file; `compute` is
+        ignored.'''
+        with phase('parse'):
+            return getattr(self, '_decode_' + stage[len('mcnp_'):])()
+
+    def section(self, name):
+        '''Return the content of section `name`, as a list.'''
+        try:
+            return self.sections[name].tolist()
+        except KeyError:
+            raise ValueError('{} has no {!r} section'
+                             .format(self.path, name)) from None
+
+    def _decode_materials(self):
+        strings = self.strings
+        params = iter(self.section('mat.params'))
+        return OrderedDict(
+            (key, [strings[next(params)] for _ in range(n_params)])
+            for key, n_params in zip(self.section('mat.key'),
+                                     self.section('mat.n')))
+
+    def _decode_surfaces(self):
+        strings = self.strings
+        surfaces = CollectionDict()
+        sides = iter(self.section('surf.side'))
+        types = iter(self.section('surf.type'))
+        bconds = iter(self.section('surf.bc'))
+        values = _decode_stream(self, 'surf')
+        for key, n_subs in zip(self.section('surf.key'),
+                               self.section('surf.n')):
+            subsurfaces = []
+            for _ in range(n_subs):
+                surf = SurfaceMCNP(strings[next(bconds)],
+                                   ESurfaceTypeMCNP[strings[next(types)]],
+                                   next(values), next(values), next(values))
+                subsurfaces.append((surf, next(sides)))
+            surfaces[key] = subsurfaces
+        count('mcnp_surfaces', len(surfaces))
+        return surfaces
+
+    def _decode_cells(self):
+        strings = self.strings
+        lattices = self._decode_lattices()
+        ops = self.sections['geom.ops'].tobytes()
+        args = self.section('geom.args')
+        values = _decode_stream(self, 'cell')
+        cells = OrderedDict()
+        pos = 0
+        for (key, mat, dens, imp, univ, lat, fillkind, fill,
+             geom_len) in zip(*(self.section('cell.' + name)
+                                for name in ('key', 'mat', 'dens', 'imp',
+                                             'univ', 'lat', 'fillkind', 'fill',
+                                             'geom'))):
+            geometry = _decode_geometry(ops, args, pos, pos + geom_len,
+                                        strings)
+            pos += geom_len
+            if fillkind == _FILL_NONE:
+                fillid = None
+            elif fillkind == _FILL_LATTICE:
+                fillid = lattices[fill]
+            else:
+                fillid = fill
+            filltr, trcl, idorigin = next(values), next(values), next(values)
+            cells[key] = CellMCNP(strings[mat],
+                                  None if dens < 0 else strings[dens],
+                                  geometry, None if math.isnan(imp) else imp,
+                                  univ, fillid, filltr, lat or None, trcl,
+                                  idorigin)
+        count('mcnp_cells', len(cells))
+        return cells, self.section('cell.skipped')
+
+    def _decode_lattices(self):
+        lattices = []
+        bounds = iter(self.section('lat.bounds'))
+        specs = self.sections['lat.spec'].astype(np.int64)
+        start = 0
+        for ndim in self.section('lat.ndim'):
+            lat_bounds = LatticeBounds([(next(bounds), next(bounds))
+                                        for _ in range(ndim)])
+            end = start + lat_bounds.size()
+            lattices.append(LatticeSpec(lat_bounds, specs[start:end]))
+            start = end
+        return lattices
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+_FLOAT, _INT, _STR, _NONE = b'f'[0], b'i'[0], b's'[0], b'n'[0]
+_OPEN = {tuple: b'('[0], list: b'['[0]}
+_CLOSE = {tuple: b')'[0], list: b']'[0]}
+_SEQUENCES = {code: kind for kind, code in _CLOSE.items()}
+
+
+class _ValueStream:
+    '''A value stream being encoded (see the module documentation).'''
+
+    def __init__(self, string):
+        self.string = string
+        self.kinds = bytearray()
+        self.floats = array('d')
+        self.ints = array('q')
+
+    def add(self, value):
+        '''Append `value` to the stream.'''
+        if value is None:
+            self.kinds.append(_NONE)
+        elif isinstance(value, (float, np.floating)):
+            self.kinds.append(_FLOAT)
+            self.floats.append(value)
+        elif (isinstance(value, (int, np.integer))
+              and not isinstance(value, bool)):
+            self.kinds.append(_INT)
+            self.ints.append(value)
+        elif isinstance(value, str):
+            self.kinds.append(_STR)
+            self.ints.append(self.string(value))
+        elif isinstance(value, (tuple, list)):
+            kind = list if isinstance(value, list) else tuple
+            self.kinds.append(_OPEN[kind])
+            for item in value:
+                self.add(item)
+            self.kinds.append(_CLOSE[kind])
+        else:
+            raise TypeError('cannot store a {} in a model file'
+                            .format(type(value).__name__))
+
+    def store(self, writer, prefix):
+        '''Add the sections of the stream to `writer`.'''
+        writer.add_section(prefix + '.kinds', _U1, self.kinds)
+        writer.add_section(prefix + '.floats', _F8, self.floats)
+        writer.add_section(prefix + '.ints', _I8, self.ints)
+
+
+def _decode_stream(reader, prefix):
+    '''Generate the values of a value stream of `reader`.
+
+    The values that have the same shape (the same sequence of codes) are
+    built by the same function, see :func:`_builder`.
+    '''
+    kinds = reader.sections[prefix + '.kinds']
+    # boundaries of the values, and offsets of their payloads
+    depth = np.cumsum(np.isin(kinds, list(_OPEN.values())), dtype=np.int64)
+    depth -= np.cumsum(np.isin(kinds, list(_CLOSE.values())), dtype=np.int64)
+    ends = np.flatnonzero(depth == 0) + 1
+    starts = np.concatenate(([0], ends[:-1]))
+    n_floats = np.concatenate(([0], np.cumsum(kinds == _FLOAT)))[starts]
+    n_ints = np.concatenate(([0], np.cumsum((kinds == _INT)
+                                            | (kinds == _STR))))[starts]
+    codes = kinds.tobytes()
+    floats = reader.section(prefix + '.floats')
+    ints = reader.section(prefix + '.ints')
+    strings = reader.strings
+    builders = {}
+    for start, end, i_float, i_int in zip(starts.tolist(), ends.tolist(),
+                                          n_floats.tolist(), n_ints.tolist()):
+        shape = codes[start:end]
+        build = builders.get(shape)
+        if build is None:
+            build = builders[shape] = _builder(shape)
+        yield build(floats, i_float, ints, i_int, strings)
+
+
+def _builder(shape):
+    '''Return a function that builds a value of the given `shape` from the
+    payloads of a value stream, starting at the given offsets.'''
+    pos = n_floats = n_ints = 0
+
+    def parse():
+        nonlocal pos, n_floats, n_ints
+        kind = shape[pos]
+        pos += 1
+        if kind == _FLOAT:
+            n_floats += 1
+            return _FLOAT, n_floats - 1
+        if kind in (_INT, _STR):
+            n_ints += 1
+            return kind, n_ints - 1
+        if kind == _NONE:
+            return _NONE, None
+        sequence = _SEQUENCES[_CLOSE[list] if kind == _OPEN[list]
+                              else _CLOSE[tuple]]
+        items = []
+        while shape[pos] not in _SEQUENCES:
+            items.append(parse())
+        pos += 1
+        return sequence, items
+
+    return _build_function(parse())
+
+
+def _build_function(plan):
+    '''Turn a plan made by :func:`_builder` into a function.'''
+    kind, arg = plan
+    if kind == _FLOAT:
+        return lambda floats, i_f, ints, i_i, strings: floats[i_f + arg]
+    if kind == _INT:
+        return lambda floats, i_f, ints, i_i, strings: ints[i_i + arg]
+    if kind == _STR:
+        return lambda floats, i_f, ints, i_i, strings: strings[ints[i_i + arg]]
+    if kind == _NONE:
+        return lambda floats, i_f, ints, i_i, strings: None
+    sequence = kind
+    if all(item_kind == _FLOAT for item_kind, _ in arg):
+        # the floats of the sequence are consecutive: slice the payload
+        first = arg[0][1] if arg else 0
+        last = first + len(arg)
+        return (lambda floats, i_f, ints, i_i, strings:
+                sequence(floats[i_f + first:i_f + last]))
+    items = [_build_function(item) for item in arg]
+    return (lambda floats, i_f, ints, i_i, strings:
+            sequence([item(floats, i_f, ints, i_i, strings)
+                      for item in items]))
+
+
+_SURF, _FACET, _CELL = b'S'[0], b'F'[0], b'C'[0]
+_OPERATORS = {'*': b'*'[0], ':': b':'[0], '^': b'^'[0]}
+_NODES = {code: operator for operator, code in _OPERATORS.items()}
+
+
+def _encode_geometry(geometry, ops, args, string):
+    '''Append the postfix bytecode of `geometry` to `ops` and `args`.'''
+    # explicit stack instead of recursion, for deeply nested expressions
+    stack = [(geometry, False)]
+    while stack:
+        node, done = stack.pop()
+        if isinstance(node, Surface):
+            ops.append(_SURF)
+            args.append(node.surface)
+            if node.sub is not None:
+                ops.append(_FACET)
+                args.append(node.sub)
+        elif isinstance(node, Cell):
+            ops.append(_CELL)
+            args.append(string(node))
+        elif isinstance(node, GeomExpression) and node[0] in _OPERATORS:
+            if done:
+                ops.append(_OPERATORS[node[0]])
+                args.append(len(node) - 1)
+            else:
+                stack.append((node, True))
+                stack.extend((arg, False) for arg in reversed(node[1:]))
+        else:
+            raise TypeError('cannot store a {} in a model file'
+                            .format(type(node).__name__))
+
+
+def _decode_geometry(ops, args, start, end, strings):
+    '''Rebuild the geometry from the instructions ``start:end`` of the
+    bytecode.'''
+    stack = []
+    for pos in range(start, end):
+        op, arg = ops[pos], args[pos]
+        if op == _SURF:
+            stack.append(Surface(arg))
+        elif op == _FACET:
+            stack[-1] = Surface(stack[-1].surface, arg)
+        elif op == _CELL:
+            stack.append(Cell(strings[arg]))
+        else:
+            node = GeomExpression([_NODES[op]] + stack[len(stack) - arg:])
+            del stack[len(stack) - arg:]
+            stack.append(node)
+    return stack[0]
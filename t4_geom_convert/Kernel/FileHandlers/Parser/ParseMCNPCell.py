@@ -6,18 +6,20 @@ Created on 5 févr. 2019
 :data : 05 february 2019
 '''
 import re
-import pickle
 from collections import OrderedDict, defaultdict
+from multiprocessing import Pool
 
+import numpy as np
 import tatsu.exceptions
 
 from MIP.geom.cells import get_cells, get_cell_importances
-from MIP.geom.parsegeom import get_ast
 from MIP.geom.transforms import to_cos
-from MIP.mip.datacard import expand_data_card
+from MIP.mip.datacard import expand_data_array
 from ...Volume.CellMCNP import CellMCNP
 from ...Volume.Lattice import parse_ranges, LatticeSpec
 from ...Transformation.Transformation import get_mcnp_transforms
+from ...Instrumentation import count
+from .ParseMCNPGeometry import geometry_parser, GeometryParseError
 
 
 class ParseMCNPCellError(Exception):
@@ -35,13 +37,19 @@ class ParseMCNPCell:
 
     LIKE_RE = re.compile(r'like\s+(\d+)\s+but')
 
-    def __init__(self, mcnp_parser, cell_cache_path, lattice_params):
+    def __init__(self, mcnp_parser, lattice_params,
+                 geometry_parser_name='fast', jobs=1):
         '''
         Constructor
         :param: f_inputMCNP : input file of MCNP
+        :param geometry_parser_name: the name of the parser for the cell
+            geometries (see :func:`~.ParseMCNPGeometry.geometry_parser`)
+        :param jobs: if larger than 1, the cell cards are parsed by a pool of
+            `jobs` worker processes
         '''
         self.mcnp_parser = mcnp_parser
-        self.cell_cache_path = cell_cache_path
+        self.jobs = jobs
+        self.parse_geometry = geometry_parser(geometry_parser_name)
         self.lattice_params = lattice_params.copy()
         self.importances = self.parse_importance_cards()
         self.transforms = get_mcnp_transforms(self.mcnp_parser)
@@ -54,14 +62,14 @@ class ParseMCNPCell:
         '''Parse any importance cards and return the minimum importance value
         for each cell.
 
-        :returns: the minimum importances.
+        :returns: the minimum importances (`None` for the jumped entries).
         :rtype: list(float)
         '''
         importance_cards = get_cell_importances(self.mcnp_parser)
         if not importance_cards:
             return []
         # here all the lists, dicts, etc. have at least one element
-        importances = [expand_data_card(card)[0]
+        importances = [expand_data_array(card)[0]
                        for card in importance_cards.values()]
         lens = [len(importance) for importance in importances]
         if any(len_ != lens[0] for len_ in lens):
@@ -70,10 +78,11 @@ class ParseMCNPCell:
             msg = ('All the importance cards (`IMP:*\') must have the same '
                    'number of elements.\n{}'.format(diagn))
             raise ParseMCNPCellError(msg)
-        if len(lens) == 1:
-            return importances[0]
-        min_importances = [min(*values) for values in zip(*importances)]
-        return min_importances
+        min_importances = np.minimum.reduce(importances)
+        result = min_importances.tolist()
+        for index in np.flatnonzero(np.isnan(min_importances)).tolist():
+            result[index] = None
+        return result
 
     def parse(self):
         '''
@@ -82,26 +91,17 @@ class ParseMCNPCell:
         :return: dictionary which contains the ID of the cells as a key
         and as a value, a object from the :class:`~.CellMCNP` class.
         '''
-        if self.cell_cache_path is None:
-            dict_cell, skipped_cells = self.parse_all_cells()
-        else:
-            try:
-                with self.cell_cache_path.open('rb') as dicfile:
-                    print('reading MCNP cells from file {}...'
-                          .format(self.cell_cache_path.resolve()), end='')
-                    dict_cell, skipped_cells = pickle.load(dicfile)
-                    print(' done')
-            except IOError:
-                dict_cell, skipped_cells = self.parse_all_cells()
-                with self.cell_cache_path.open('wb') as dicfile:
-                    print('writing MCNP cells to file {}...'
-                          .format(self.cell_cache_path.resolve()), end='')
-                    pickle.dump((dict_cell, skipped_cells), dicfile)
-                    print(' done')
-        return dict_cell, skipped_cells
+        return self.parse_all_cells()
 
     def parse_all_cells(self):
-        '''Actually parse the cells.'''
+        '''Actually parse the cells.
+
+        The ``LIKE n BUT`` cards are first resolved. The resulting cards are
+        independent from each other: they are parsed in the current process
+        or, if :attr:`jobs` is larger than 1, by a pool of worker processes.
+        In both cases the cells are returned in the order of the input file,
+        and the errors are reported for the first faulty card.
+        '''
         dict_cell = OrderedDict()
         skipped_cells = []
         parsed_cells = get_cells(self.mcnp_parser, lim=None)
@@ -110,40 +110,93 @@ class ParseMCNPCell:
                       '{{:3d}}%)'
                       .format(len(str(max(parsed_cells))),
                               len(str(lencell))))
-        for rank, (key, parsed_cell) in enumerate(parsed_cells.items()):
+        items = [(rank, key, self.lattice_params.get(key, None),
+                  self.resolve_like(parsed_cells, parsed_cell))
+                 for rank, (key, parsed_cell)
+                 in enumerate(parsed_cells.items())]
+        results = self.parse_items(items)
+        for rank, (key, cell) in enumerate(zip(parsed_cells, results)):
             percent = int(100.0*rank/(lencell-1)) if lencell > 1 else 100
             print(fmt_string.format(key, rank+1, lencell, percent),
                   end='', flush=True)
-            lat_opt = self.lattice_params.get(key, None)
-            try:
-                cell = self.parse_one_cell(parsed_cells, rank, lat_opt,
-                                           parsed_cell)
-            except ParseMCNPCellError as err:
-                msg = '{} (in cell {})'.format(err, key)
-                raise ParseMCNPCellError(msg) from None
-            except MissingLatticeOptError as err:
-                msg = '{} for cell {}'.format(err, key)
-                raise MissingLatticeOptError(msg) from None
-            except tatsu.exceptions.ParseException:
-                msg = ('TatSu parsing failed for cell {}. Check the syntax of '
-                       'this cell.'.format(key))
-                raise ParseMCNPCellError(msg)
             if cell.importance == 0:
                 skipped_cells.append(key)
             dict_cell[key] = cell
         print('... done', flush=True)
+        count('mcnp_cells', lencell)
         return dict_cell, skipped_cells
 
-    def parse_one_cell(self, parsed_cells, rank, lat_opt, parsed_cell):
-        '''Handle the ``LIKE n BUT`` syntax, delegate the real parsing to
-        :meth:`parse_one_cell_worker`.'''
+    def parse_some_cells(self, keys):
+        '''Parse only the cells whose IDs are in `keys`, in the current
+        process.
+
+        :returns: an ordered dictionary associating the IDs of the cells (in
+            the order of the input file) to :class:`~.CellMCNP` objects.
+        '''
+        parsed_cells = get_cells(self.mcnp_parser, lim=None)
+        dict_cell = OrderedDict()
+        for rank, (key, parsed_cell) in enumerate(parsed_cells.items()):
+            if key in keys:
+                lat_opt = self.lattice_params.get(key, None)
+                dict_cell[key] = self.parse_item(
+                    (rank, key, lat_opt,
+                     self.resolve_like(parsed_cells, parsed_cell)))
+        return dict_cell
+
+    def parse_items(self, items):
+        '''Parse the given cards (see :meth:`parse_item`), using a pool of
+        worker processes if :attr:`jobs` is larger than 1. Yield the cells in
+        order.'''
+        if self.jobs <= 1 or len(items) <= 1:
+            yield from map(self.parse_item, items)
+            return
+        chunksize = max(1, len(items) // (4 * self.jobs))
+        with Pool(self.jobs, initializer=_init_worker,
+                  initargs=(self,)) as pool:
+            yield from pool.imap(_parse_item_worker, items, chunksize)
+
+    def parse_item(self, item):
+        '''Parse one cell card whose ``LIKE n BUT`` references have been
+        resolved, and attribute any parsing error to the cell.
+
+        :param item: a tuple consisting of the rank of the cell in the input
+            file, its ID, its ``--lattice`` option and the resolved card
+        :returns: a :class:`~.CellMCNP`
+        '''
+        rank, key, lat_opt, parsed_cell = item
+        try:
+            return self.parse_one_cell_worker(rank, lat_opt, parsed_cell)
+        except ParseMCNPCellError as err:
+            msg = '{} (in cell {})'.format(err, key)
+            raise ParseMCNPCellError(msg) from None
+        except MissingLatticeOptError as err:
+            msg = '{} for cell {}'.format(err, key)
+            raise MissingLatticeOptError(msg) from None
+        except tatsu.exceptions.ParseException:
+            msg = ('TatSu parsing failed for cell {}. Check the syntax of '
+                   'this cell.'.format(key))
+            raise ParseMCNPCellError(msg) from None
+        except GeometryParseError as err:
+            msg = ('parsing failed for cell {}: {}. Check the syntax of '
+                   'this cell.'.format(key, err))
+            raise ParseMCNPCellError(msg) from None
+
+    def __getstate__(self):
+        # the worker processes only need what parse_one_cell_worker uses
+        state = self.__dict__.copy()
+        state['mcnp_parser'] = None
+        return state
+
+    def resolve_like(self, parsed_cells, parsed_cell):
+        '''Resolve the ``LIKE n BUT`` syntax: return the card of the cell that
+        `parsed_cell` refers to, extended with the ``BUT`` options.'''
         match_like = self.LIKE_RE.search(parsed_cell[1].lower())
         while match_like:
             like_id = int(float(match_like.group(1)))
             like_cell = parsed_cells[like_id]
             parsed_cell = self.apply_but(like_cell, parsed_cell[2])
             match_like = self.LIKE_RE.search(parsed_cell[1].lower())
-        return self.parse_one_cell_worker(rank, lat_opt, parsed_cell)
+        return parsed_cell
 
     def parse_one_cell_worker(self, rank, lat_opt, parsed_cell):
         '''Parse one cell, return new :class:`~.CellMCNP` object.'''
@@ -151,7 +204,7 @@ class ParseMCNPCell:
 
         material_id, density = self.parse_material(material)
 
-        ast_mcnp = get_ast(geometry)
+        ast_mcnp = self.parse_geometry(geometry)
 
         kw_list = list(reversed(option.lower().replace('(', ' ')
                                 .replace(')', ' ').replace('=', ' ').split()))
@@ -208,7 +261,8 @@ class ParseMCNPCell:
                     msg = 'no --lattice option provided'
                     raise MissingLatticeOptError(msg) from None
                 kws['f_bounds'] = lat_opt
-                kws['f_univs'] = [f_univs_arg]*lat_opt.size()
+                kws['f_univs'] = np.full(lat_opt.size(), f_univs_arg,
+                                         dtype=np.int64)
             return LatticeSpec(kws['f_bounds'], kws['f_univs'])
 
         # case of FILL=n without LAT=1
@@ -258,9 +312,8 @@ class ParseMCNPCell:
                 str_bounds.append(kw_list.pop())
             bounds = parse_ranges(str_bounds)
             try:
-                fillid_u, consumed = expand_data_card(list(reversed(kw_list)),
-                                                      expected=bounds.size(),
-                                                      dtype='int')
+                fillid_u, consumed = expand_data_array(
+                    kw_list[::-1], expected=bounds.size(), dtype='int')
             except ValueError:
                 msg = ('expected {} universe specifications after FILL '
                        'keyword'.format(bounds.size()))
@@ -348,3 +401,19 @@ def normalize_density(density):
     if norm[-1] == '.':
         norm += '0'
     return norm
+
+
+# pylint: disable=invalid-name,global-statement
+_worker_parser = None
+
+
+def _init_worker(parser):
+    '''Store the :class:`ParseMCNPCell` object in the worker process.'''
+    global _worker_parser
+    _worker_parser = parser
+
+
+def _parse_item_worker(item):
+    '''Parse one cell card in a worker process, see
+    :meth:`ParseMCNPCell.parse_item`.'''
+    return _worker_parser.parse_item(item)
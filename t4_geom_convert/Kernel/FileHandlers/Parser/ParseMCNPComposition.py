@@ -11,14 +11,19 @@ from MIP.geom.composition import get_material_composition
 from ...Composition.CCompositionMCNP import CCompositionMCNP
 
 
-def parseMCNPComposition(mcnpParser):
+def parseMCNPComposition(mcnpParser, materials=None):
     '''
     :brief method which permit to recover the information of each line
     of the block SURFACE
+    :param materials: if not `None`, the result of
+        :func:`~MIP.geom.composition.get_material_composition`, which is then
+        not called
     :return: dictionary which contains the ID of the materials as a key
     and as a value, a object from the class CCompositionMCNP
     '''
-    compositionParser = get_material_composition(mcnpParser)
+    if materials is None:
+        materials = get_material_composition(mcnpParser)
+    compositionParser = materials
     dictComposition = OrderedDict()
     for k, v in list(compositionParser.items()):
         l_materialCompositionParameters = v
@@ -0,0 +1,249 @@
+'''Module containing a fast parser for the geometry of MCNP cells.
+
+The parser is a tokenizer followed by an iterative operator-precedence parser
+that keeps one frame per level of parentheses. It produces the same AST as
+:func:`MIP.geom.parsegeom.get_ast` (which normalizes the geometry with
+regular expressions and parses it with a TatSu grammar), at a fraction of the
+cost:
+
+- the union (``:``) and the intersection (juxtaposition) are n-ary
+  :class:`~MIP.geom.semantics.GeomExpression` nodes, the intersection binds
+  tighter than the union, and the operands of a union (intersection) are
+  never unions (intersections) themselves;
+- surfaces (``-12``) and facets of macrobodies (``12.3``) are
+  :class:`~MIP.geom.semantics.Surface` objects;
+- the complement of a cell (``#5``) is a ``('^', Cell('5'))`` node;
+- the complement of an expression (``#(...)``) is applied immediately, by
+  inverting the expression.
+'''
+
+import re
+
+from MIP.geom.parsegeom import get_ast
+from MIP.geom.semantics import Surface, Cell, GeomExpression
+
+
+#: The names of the available geometry parsers (see :func:`geometry_parser`).
+GEOMETRY_PARSERS = ('fast', 'tatsu', 'check')
+
+
+class GeometryParseError(ValueError):
+    '''An exception class for syntax errors in cell geometries.'''
+
+
+TOKEN_RE = re.compile(r'''\s*(?:
+    (?P<surface>[-+]?\d+(?:\.\d+)?)  # a (signed) surface or facet
+    |\#\s*(?P<cell>\d+)             # the complement of a cell
+    |(?P<compl>\#\s*\()             # the start of a complemented expression
+    |(?P<op>[():])                  # parentheses and union
+    )''', re.VERBOSE)
+
+TRAILING_SPACE_RE = re.compile(r'\s*$')
+
+
+#: Binding power of the binary operators.
+PRECEDENCE = {':': 1, '*': 2}
+
+
+def tokenize(geom):
+    '''Split a geometry string into tokens.
+
+    Each token is a pair consisting of a kind and a value. The kind is
+    ``'operand'`` for surfaces and complemented cells (the value is the
+    corresponding AST leaf), or one of ``'('``, ``'#('``, ``')'`` and
+    ``':'`` (the value is `None`). The intersection operator, which MCNP
+    denotes by juxtaposition, is not emitted by the tokenizer.
+
+    >>> tokenize('1 -2.3 : #4')
+    [('operand', Surface(1, None)), ('operand', Surface(-2, 3)), \
+(':', None), ('operand', ('^', '4'))]
+    >>> tokenize('#(1 2)')
+    [('#(', None), ('operand', Surface(1, None)), ('operand', Surface(2, \
+None)), (')', None)]
+    >>> tokenize('1 & 2')
+    Traceback (most recent call last):
+        ...
+    t4_geom_convert.Kernel.FileHandlers.Parser.ParseMCNPGeometry.\
+GeometryParseError: unexpected character '&' at position 2 in '1 & 2'
+    '''
+    tokens = []
+    pos, end = 0, len(geom)
+    match = TOKEN_RE.match
+    while pos < end:
+        found = match(geom, pos)
+        if found is None:
+            if TRAILING_SPACE_RE.match(geom, pos):
+                break
+            bad = pos + len(geom[pos:]) - len(geom[pos:].lstrip())
+            raise GeometryParseError('unexpected character {!r} at position '
+                                     '{} in {!r}'.format(geom[bad], bad, geom))
+        pos = found.end()
+        kind = found.lastgroup
+        if kind == 'surface':
+            text = found.group('surface')
+            if '.' in text:
+                surface, sub = text.split('.')
+                tokens.append(('operand', Surface(surface, sub)))
+            else:
+                tokens.append(('operand', Surface(text)))
+        elif kind == 'cell':
+            tokens.append(('operand',
+                           GeomExpression(('^', Cell(found.group('cell'))))))
+        elif kind == 'compl':
+            tokens.append(('#(', None))
+        else:
+            tokens.append((found.group('op'), None))
+    return tokens
+
+
+class _Frame:
+    '''The operands collected at one level of parentheses.'''
+
+    __slots__ = ('union', 'isect', 'complement')
+
+    def __init__(self, complement):
+        self.union = []
+        self.isect = []
+        self.complement = complement
+
+    def close_isect(self):
+        '''Add the pending intersection to the operands of the union.'''
+        self.union.append(_join('*', self.isect))
+        self.isect = []
+
+    def close(self):
+        '''Return the expression described by the frame.'''
+        self.close_isect()
+        return _join(':', self.union)
+
+
+def _join(operator, operands):
+    '''Return the node applying `operator` to `operands`, or the only operand
+    if there is just one.'''
+    if len(operands) == 1:
+        return operands[0]
+    return GeomExpression.join(operator, operands)
+
+
+def parse_geometry(geom):
+    '''Parse the geometry of an MCNP cell.
+
+    :param str geom: the geometry specification
+    :returns: the AST, in the same format as
+        :func:`MIP.geom.parsegeom.get_ast`
+    :raises GeometryParseError: if the syntax is invalid
+
+    >>> parse_geometry('-1')
+    Surface(-1, None)
+    >>> parse_geometry('1 -2 3 : 4')
+    (':', ('*', Surface(1, None), Surface(-2, None), Surface(3, None)), \
+Surface(4, None))
+    >>> parse_geometry('1 (2 : 3.1) (4 5) #6')
+    ('*', Surface(1, None), (':', Surface(2, None), Surface(3, 1)), \
+Surface(4, None), Surface(5, None), ('^', '6'))
+    >>> parse_geometry('#(1 -2)')
+    (':', Surface(-1, None), Surface(2, None))
+    >>> parse_geometry('1 : (2')
+    Traceback (most recent call last):
+        ...
+    t4_geom_convert.Kernel.FileHandlers.Parser.ParseMCNPGeometry.\
+GeometryParseError: unbalanced parentheses in '1 : (2'
+    '''
+    if 'like' in geom.lower():
+        return geom.split()[1]
+    frames = [_Frame(False)]
+    frame = frames[0]
+    expect_operand = True
+    for kind, value in tokenize(geom):
+        if kind == 'operand':
+            frame.isect.append(value)
+            expect_operand = False
+        elif kind == '(' or kind == '#(':
+            frame = _Frame(kind == '#(')
+            frames.append(frame)
+            expect_operand = True
+        elif expect_operand:
+            raise GeometryParseError('unexpected {!r} in {!r}'
+                                     .format(kind, geom))
+        elif kind == ':':
+            frame.close_isect()
+            expect_operand = True
+        else:  # kind == ')'
+            if len(frames) == 1:
+                raise GeometryParseError('unbalanced parentheses in {!r}'
+                                         .format(geom))
+            node = frames.pop().close()
+            if frame.complement:
+                node = _inverse(node, geom)
+            frame = frames[-1]
+            frame.isect.append(node)
+    if expect_operand:
+        raise GeometryParseError('unexpected end of geometry in {!r}'
+                                 .format(geom))
+    if len(frames) > 1:
+        raise GeometryParseError('unbalanced parentheses in {!r}'
+                                 .format(geom))
+    return frame.close()
+
+
+def _inverse(ast, geom):
+    '''Return the complement of `ast`.'''
+    try:
+        return ast.inverse()
+    except AttributeError:
+        raise GeometryParseError('cannot complement a cell complement in {!r}'
+                                 .format(geom)) from None
+
+
+def same_ast(first, second):
+    '''Return `True` if the two ASTs are identical, including the types of
+    their nodes.
+
+    >>> same_ast(parse_geometry('1 2 : 3'), get_ast('1 2 : 3'))
+    True
+    >>> same_ast(parse_geometry('1 2'), parse_geometry('1 -2'))
+    False
+    '''
+    to_compare = [(first, second)]
+    while to_compare:
+        node1, node2 = to_compare.pop()
+        if type(node1) is not type(node2):
+            return False
+        if isinstance(node1, tuple):
+            if len(node1) != len(node2):
+                return False
+            to_compare.extend(zip(node1, node2))
+        elif node1 != node2:
+            return False
+    return True
+
+
+def check_geometry(geom):
+    '''Parse the geometry with both :func:`parse_geometry` and the TatSu
+    parser, and check that the results are identical.
+
+    :raises GeometryParseError: if the ASTs differ
+    '''
+    ast = parse_geometry(geom)
+    ref_ast = get_ast(geom)
+    if not same_ast(ast, ref_ast):
+        raise GeometryParseError('the geometry parsers disagree on {!r}:\n'
+                                 '  fast:  {!r}\n  TatSu: {!r}'
+                                 .format(geom, ast, ref_ast))
+    return ast
+
+
+def geometry_parser(name):
+    '''Return the geometry parsing function called `name`.
+
+    ``'fast'`` is :func:`parse_geometry`, ``'tatsu'`` is
+    :func:`MIP.geom.parsegeom.get_ast` and ``'check'`` is
+    :func:`check_geometry`.
+    '''
+    parsers = {'fast': parse_geometry, 'tatsu': get_ast,
+               'check': check_geometry}
+    try:
+        return parsers[name]
+    except KeyError:
+        raise ValueError('unknown geometry parser {!r}; choose among {}'
+                         .format(name, ', '.join(GEOMETRY_PARSERS))) from None
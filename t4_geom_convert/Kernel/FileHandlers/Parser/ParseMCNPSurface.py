@@ -7,6 +7,7 @@ Created on 6 févr. 2019
 '''
 
 from collections import OrderedDict
+from multiprocessing import Pool
 from MIP.geom.forcad import mcnp2cad
 from MIP.geom.surfaces import get_surfaces
 from MIP.geom.semantics import Surface
@@ -16,14 +17,18 @@ from ...Surface.ESurfaceTypeMCNP import ESurfaceTypeMCNP as MS
 from ...Surface.ESurfaceTypeMCNP import string_to_enum, mcnp_to_mip
 from ...Transformation.Transformation import (get_mcnp_transforms,
                                               transformation)
+from ...Transformation.TransformationError import TransformationError
 from ...VectUtils import planeParamsFromPoints
 from ...Surface import MacroBodies as MB
+from ...Instrumentation import count
 
 
-def parseMCNPSurface(mcnp_parser):
+def parseMCNPSurface(mcnp_parser, jobs=1):
     '''
     :brief method which permit to recover the information of each line of the
         block SURFACE
+    :param jobs: if larger than 1, the surface cards are parsed by a pool of
+        `jobs` worker processes; the result does not change.
     :return: dictionary with keys given by the ID of the surfaces, as a
         :class:`~MIP.geom.semantics.Surface`, and value given by lists of
         `(:class:`SurfaceMCNP`, int)` pairs. The integer represents the side of
@@ -37,17 +42,63 @@ def parseMCNPSurface(mcnp_parser):
                   '{{:3d}}%)'
                   .format(len(str(max(surface_parsed))),
                           len(str(n_surf))))
-    for i, (key, surface) in enumerate(surface_parsed.items()):
+    results = _parse_surfaces(list(surface_parsed.items()), transform_parsed,
+                              jobs)
+    for i, (key, mcnp_surfs) in enumerate(zip(surface_parsed, results)):
         percent = int(100.0*i/(n_surf-1)) if n_surf > 1 else 100
         print(fmt_string.format(key, i+1, n_surf, percent), end='', flush=True)
-        mcnp_surfs = to_surfaces_mcnp(key, surface, transform_parsed)
         dict_surface[key] = mcnp_surfs
 
     print('... done', flush=True)
+    count('mcnp_surfaces', n_surf)
 
     return dict_surface
 
 
+def _parse_surfaces(items, transform_parsed, jobs):
+    '''Parse the given `(key, card)` pairs (see :func:`parse_surface_item`),
+    using a pool of `jobs` worker processes if `jobs` is larger than 1. Yield
+    the results in order.'''
+    if jobs <= 1 or len(items) <= 1:
+        for item in items:
+            yield parse_surface_item(item, transform_parsed)
+        return
+    chunksize = max(1, len(items) // (4 * jobs))
+    with Pool(jobs, initializer=_init_worker,
+              initargs=(transform_parsed,)) as pool:
+        yield from pool.imap(_parse_surface_worker, items, chunksize)
+
+
+def parse_surface_item(item, transform_parsed):
+    '''Convert one parsed surface card (see :func:`to_surfaces_mcnp`), and
+    attribute any error to the surface.
+
+    :param item: a pair consisting of the surface ID and of the parsed card
+    '''
+    key, surface = item
+    try:
+        return to_surfaces_mcnp(key, surface, transform_parsed)
+    except (ValueError, NotImplementedError, MB.MacroBodyError,
+            TransformationError) as err:
+        raise type(err)('{} (in surface {})'.format(err, key)) from None
+
+
+# pylint: disable=invalid-name,global-statement
+_worker_transforms = None
+
+
+def _init_worker(transform_parsed):
+    '''Store the transformations in the worker process.'''
+    global _worker_transforms
+    _worker_transforms = transform_parsed
+
+
+def _parse_surface_worker(item):
+    '''Parse one surface card in a worker process, see
+    :func:`parse_surface_item`.'''
+    return parse_surface_item(item, _worker_transforms)
+
+
 def normalize_surface(typ, params):
     '''Put the surface parametrization in a canonical form. For instance,
     planes defined by three points are transformed into the equivalent
@@ -10,13 +10,17 @@ from ...Composition.ConstructCompositionT4 import constructCompositionT4
 from ...Composition.CompositionConversionMCNPToT4 import str_fabs
 
 
-def writeT4Composition(mcnp_parser, mcnp_new_dict, ofile):
+def writeT4Composition(mcnp_parser, mcnp_new_dict, ofile, materials=None):
     '''
     :brief: method writing composition of the T4 input file
+    :param materials: if not `None`, the parsed material cards (see
+        :func:`~MIP.geom.composition.get_material_composition`), which are
+        then not read from `mcnp_parser`
     '''
     ofile.write("\nCOMPOSITION\n")
     temperature = 300
-    dic_composition = constructCompositionT4(mcnp_parser, mcnp_new_dict)
+    dic_composition = constructCompositionT4(mcnp_parser, mcnp_new_dict,
+                                             materials)
     n_compos = 0
     for mats in dic_composition.values():
         n_compos += len(mats)
@@ -8,12 +8,12 @@ Created on 6 févr. 2019
 from ...GeomComp.ConstructGeomCompT4 import constructGeomCompT4
 
 
-def writeT4GeomComp(dic_vol, mcnp_new_dict, ofile):
+def writeT4GeomComp(vol_origins, mcnp_new_dict, ofile):
     '''
     :brief: method writing GeomComp of the T4 input file
     '''
     ofile.write("\nGEOMCOMP\n")
-    dic_geomComp = constructGeomCompT4(dic_vol, mcnp_new_dict)
+    dic_geomComp = constructGeomCompT4(vol_origins, mcnp_new_dict)
     for k in dic_geomComp.keys():
         p_materialName = str(k)
         p_numberOfCell = str(dic_geomComp[k].volumeNumberMaterial)
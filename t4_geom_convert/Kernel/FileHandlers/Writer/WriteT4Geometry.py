@@ -5,90 +5,205 @@ Created on 6 févr. 2019
 :author: Sogeti
 :data : 06 february 2019
 '''
-import pickle
-from pathlib import Path
+import shutil
+import tempfile
+from collections import OrderedDict, Counter
 
 from ...Surface.ConstructSurfaceT4 import construct_surface_t4
-from ...Surface.Duplicates import remove_duplicate_surfaces, renumber_surfaces
-from ...Volume.ConstructVolumeT4 import (construct_volume_t4,
-                                         remove_empty_cells,
-                                         extract_used_surfaces)
+from ...Surface.Duplicates import remove_duplicate_surfaces
+from ...Volume.ConstructVolumeT4 import construct_volume_t4, remove_empty_cells
+from ...Volume.BoundingBox import VolumeBoxes
+from ...Volume.DictVolumeT4 import renumbering_table
+from ...Volume.Duplicates import VolumeTable
+from ...Volume.Simplification import Simplifier
+from ...Instrumentation import phase, count
 
 
-def writeT4Geometry(mcnpParser, lattice_params, args, ofile):
+#: The beginning of the geometry section of the output files.
+GEOMETRY_HEADER = 'GEOMETRY\n\nTITLE title\n\nHASH_TABLE\n\n'
+
+
+def writeT4Geometry(mcnpParser, lattice_params, args, ofile, cache=None,
+                    state=None, model=None):
     '''
     :brief: method separated in two part,
     the first for the surface and the second for the volume
     This method fills a file of the geometry for the input file of T4
+
+    If `cache` is not `None`, it must be a :class:`~.ConversionCache`; the
+    intermediate results of the conversion are read from it if possible, and
+    stored into it otherwise.
+
+    If `state` is not `None`, it must be an :class:`~.IncrementalState`; the
+    index of the output that allows the next run to patch it is recorded into
+    it.
+
+    If `model` is not `None`, it must be a :class:`~.ModelReader` or a
+    :class:`~.ModelWriter`; the parsed MCNP surfaces and cells are read from
+    it or recorded into it.
     '''
-    ofile.write("GEOMETRY\n\nTITLE title\n\nHASH_TABLE\n\n")
-    input_file = Path(args.input)
-    t4_vol_cache_path = input_file.with_suffix('.volumes.cache')
-    t4_surf_cache_path = input_file.with_suffix('.surfaces.cache')
-    if args.cache:
-        mcnp_cell_cache_path = input_file.with_suffix('.mcnp.cache')
-    else:
-        mcnp_cell_cache_path = None
+    ofile.write(GEOMETRY_HEADER)
+
+    def convert_surfaces_and_volumes():
+        dic_surface_t4, dic_surface_mcnp = construct_surface_t4(
+            mcnpParser, cache, jobs=args.jobs, model=model)
+        simplifier = (Simplifier(args.simplify_max_terms) if args.simplify
+                      else None)
+        vol_conv = construct_volume_t4(mcnpParser, lattice_params, cache,
+                                       dic_surface_t4, dic_surface_mcnp,
+                                       jobs=args.jobs, state=state,
+                                       geometry_parser=args.geometry_parser,
+                                       simplifier=simplifier,
+                                       prune_planes=args.prune_planes,
+                                       verbose=args.verbose, model=model)
+        # construct_volume_t4 adds the transformed surfaces to
+        # dic_surface_mcnp, so we need to keep it along with the volumes
+        return vol_conv, dic_surface_mcnp
 
-    if not args.cache:
-        surf_conv = construct_surface_t4(mcnpParser)
+    if cache is None:
+        vol_conv, dic_surface_mcnp = convert_surfaces_and_volumes()
     else:
-        try:
-            with t4_surf_cache_path.open('rb') as dicfile:
-                print('reading surfaces from file {}...'
-                      .format(t4_surf_cache_path.resolve()), end='', flush=True)
-                surf_conv = pickle.load(dicfile)
-                print(' done', flush=True)
-        except:
-            surf_conv = constructSurfaceT4(mcnpParser)
-            with t4_surf_cache_path.open('wb') as dicfile:
-                print('writing surfaces to file {}...'
-                      .format(t4_surf_cache_path.resolve()), end='', flush=True)
-                pickle.dump(surf_conv, dicfile)
-                print(' done', flush=True)
-    dic_surface_t4, dic_surface_mcnp = surf_conv
-
-    if not args.cache:
-        vol_conv = construct_volume_t4(mcnpParser, lattice_params,
-                                       mcnp_cell_cache_path,
-                                       dic_surface_t4,
-                                       dic_surface_mcnp)
+        options = {'lattice': sorted(lattice_params.items()),
+                   'simplify': (args.simplify, args.simplify_max_terms),
+                   'prune_planes': args.prune_planes}
+        vol_conv, dic_surface_mcnp = cache.fetch(
+            't4_volumes', convert_surfaces_and_volumes, options)
+
+    spill, mcnp_new_dict, dic_surface_t4, skipped_cells = vol_conv
+    if args.skip_deduplication:
+        renumber = None
     else:
-        try:
-            with t4_vol_cache_path.open('rb') as dicfile:
-                print('reading TRIPOLI-4 volumes from file {}...'
-                      .format(t4_vol_cache_path.resolve()), end='', flush=True)
-                vol_conv = pickle.load(dicfile)
-                print(' done', flush=True)
-        except:
-            vol_conv = construct_volume_t4(mcnpParser, lattice_params,
-                                           mcnp_cell_cache_path,
-                                           dic_surface_t4,
-                                           dic_surface_mcnp)
-            with t4_vol_cache_path.open('wb') as dicfile:
-                print('writing cells to file {}...'
-                      .format(t4_vol_cache_path.resolve()), end='', flush=True)
-                pickle.dump(vol_conv, dicfile)
-                print(' done', flush=True)
-
-    dic_volume, mcnp_new_dict, dic_surface_t4, skipped_cells = vol_conv
-    if not args.skip_deduplication:
-        dic_surface_t4, renumber = remove_duplicate_surfaces(dic_surface_t4)
-        dic_volume = renumber_surfaces(dic_volume, renumber)
-
-    remove_empty_cells(dic_volume)
-    surf_used = extract_used_surfaces(dic_volume.values())
-
-    for key in sorted(surf_used):
-        surf = dic_surface_t4[key]
-        ofile.write("SURF {} {}{}\n".format(key, surf, surf.comment()))
-    ofile.write("\n")
+        with phase('dedup'):
+            if state is not None:
+                state.record_dedup(dic_surface_t4)
+            dic_surface_t4, renumber = remove_duplicate_surfaces(
+                dic_surface_t4, args.dedup_tolerance)
+
+    # The SURF records must precede the VOLU records, but we only know which
+    # surfaces are used once all the volumes have been processed; the VOLU
+    # records are therefore streamed to a temporary file first.
+    volumes = None if args.skip_volume_deduplication else VolumeTable()
+    with phase('write'), tempfile.TemporaryFile('w+') as volu_file:
+        surfaces = dic_surface_t4 if args.bounding_boxes else None
+        surf_used, vol_origins = write_volumes(spill, renumber, skipped_cells,
+                                               volu_file, volumes, surfaces)
+        spill.close()
 
-    for key, val in dic_volume.items():
-        if key in skipped_cells:
-            continue
-        ofile.write('VOLU {} {} ENDV{}\n'.format(key, val, val.comment()))
+        for key in sorted(surf_used):
+            ofile.write(surface_record(key, dic_surface_t4[key]))
+        ofile.write("\n")
+        count('surfaces_written', len(surf_used))
+        if state is not None:
+            state.record_written(renumber, surf_used, volumes)
+
+        volu_file.seek(0)
+        shutil.copyfileobj(volu_file, ofile)
     ofile.write("\n")
     ofile.write("ENDG")
     ofile.write("\n")
-    return dic_surface_mcnp, dic_volume, mcnp_new_dict, skipped_cells
+    return dic_surface_mcnp, vol_origins, mcnp_new_dict, skipped_cells
+
+
+def write_volumes(spill, renumber, skipped_cells, volu_file,
+                  volumes=None, surfaces=None):
+    '''Post-process the converted volumes, one batch of cells at a time, and
+    write the VOLU records to `volu_file`.
+
+    If `volumes` is not `None`, it must be a :class:`~.VolumeTable`; the
+    identical fictive volumes are written only once, and shared by all the
+    volumes that refer to them.
+
+    If `surfaces` is not `None`, a conservative bounding box is computed for
+    each volume and written as a comment.
+
+    :param spill: the converted cells, as a :class:`~.VolumeSpill`
+    :param renumber: the surface renumbering returned by
+        :func:`~.remove_duplicate_surfaces`, or `None`
+    :param skipped_cells: the cells that must not be written
+    :param volu_file: the file to write to
+    :param volumes: the table of the written fictive volumes, or `None`
+    :param surfaces: the dictionary of the (deduplicated) TRIPOLI-4 surfaces,
+        or `None`
+    :returns: a pair consisting of a :class:`~collections.Counter` of the IDs
+        of the surfaces used by the written volumes (the shared and skipped
+        volumes do not count) and of an ordered dictionary associating the
+        IDs of the non-fictive volumes to the ID of the MCNP cell they
+        originate from.
+    '''
+    surf_used = Counter()
+    vol_origins = OrderedDict()
+    n_cells = len(spill)
+    if not n_cells:
+        return surf_used, vol_origins
+    table = renumbering_table(renumber) if renumber is not None else None
+    fmt_string = ('\rwriting volumes for cell {{:{0}d}} '
+                  '({{:{1}d}}/{{:{1}d}}, {{:3d}}%)'
+                  .format(len(str(max(spill.keys))), len(str(n_cells))))
+    i = n_written = n_bounded = 0
+    boxes = VolumeBoxes(surfaces) if surfaces is not None else None
+    for cell_keys, dic_volume in spill:
+        i += len(cell_keys)
+        percent = int(100.0*(i-1)/(n_cells-1)) if n_cells > 1 else 100
+        print(fmt_string.format(cell_keys[-1], i, n_cells, percent),
+              end='', flush=True)
+        if table is not None:
+            dic_volume.renumber_surfaces(table)
+        remove_empty_cells(dic_volume)
+        for key, val in dic_volume.items():
+            if key in skipped_cells:
+                continue
+            if volumes is not None and volumes.share(key, val) is not None:
+                continue
+            surf_used.update(val.pluses)
+            surf_used.update(val.minuses)
+            if not val.fictive:
+                idorigin = val.idorigin
+                vol_origins[key] = idorigin[0][0] if idorigin else key
+            comment = val.comment()
+            if boxes is not None:
+                box = boxes.add(key, val)
+                comment += ' // ' + box_comment(box)
+                n_bounded += box.is_bounded()
+            volu_file.write(volume_record(key, val, comment))
+            n_written += 1
+    print('... done', flush=True)
+    count('volumes_written', n_written)
+    if volumes is not None:
+        n_shared = len(volumes.aliases)
+        print('shared {} duplicate fictive volumes out of {} ({:.1f}%)'
+              .format(n_shared, volumes.n_checked,
+                      100. * n_shared / max(volumes.n_checked, 1)))
+        count('volume_dedup_checked', volumes.n_checked)
+        count('volume_dedup_merged', n_shared)
+    if boxes is not None:
+        print('computed bounding boxes: {} of {} volumes are bounded'
+              .format(n_bounded, n_written))
+        count('volumes_bounded', n_bounded)
+    return surf_used, vol_origins
+
+
+def surface_record(key, surf):
+    '''Return the SURF record of the TRIPOLI-4 surface `surf`.'''
+    return 'SURF {} {}{}\n'.format(key, surf, surf.comment())
+
+
+def volume_record(key, volume, comment):
+    '''Return the VOLU record of the TRIPOLI-4 volume `volume`, followed by
+    `comment`.'''
+    return 'VOLU {} {} ENDV{}\n'.format(key, volume, comment)
+
+
+def box_comment(box):
+    '''Return the description of a bounding box written in the comments of
+    the VOLU records.
+
+    >>> from ...Volume.BoundingBox import BoundingBox, INF
+    >>> box_comment(BoundingBox((0, -1.5, -INF), (1, 2, INF)))
+    'BBOX 0 1 -1.5 2 -inf inf'
+    >>> box_comment(BoundingBox.empty())
+    'BBOX EMPTY'
+    '''
+    if box.is_empty():
+        return 'BBOX EMPTY'
+    return 'BBOX ' + ' '.join('{} {}'.format(low, high)
+                              for low, high in zip(box.lows, box.highs))
@@ -11,21 +11,17 @@ from .CDictGeomCompT4 import CDictGeomCompT4
 from .CGeomCompT4 import CGeomCompT4
 from collections import defaultdict, OrderedDict
 
-def constructGeomCompT4(dicVol, dic_cellMCNP):
+def constructGeomCompT4(vol_origins, dic_cellMCNP):
     '''
     :brief: method constructing a dictionary with the id of the
     material as a key and the instance of CGeomCompT4 as a value
+    :param vol_origins: a dictionary associating the IDs of the non-fictive
+        volumes to the ID of the MCNP cell they originate from
     '''
     dic_geomCompT4 = OrderedDict()
     dic_partialGeomComp = OrderedDict()
     obj_T4 = CDictGeomCompT4(dic_geomCompT4)
-    for key, val in dicVol.items():
-        if val.fictive:
-            continue
-        if val.idorigin:
-            volID = val.idorigin[0][0]
-        else:
-            volID = key
+    for key, volID in vol_origins.items():
         density = dic_cellMCNP[volID].density
         if density is None:
             materialName = dic_cellMCNP[volID].materialID
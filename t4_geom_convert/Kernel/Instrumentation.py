@@ -0,0 +1,184 @@
+'''Module containing a lightweight instrumentation layer for the phases of
+the conversion.
+
+Each phase of the conversion is wrapped in a :func:`phase` context manager,
+which measures its wall-clock time, its CPU time and the peak resident set
+size of the process at its end. The phases can also report item counts with
+:func:`count` (e.g. the number of surfaces or volumes they created).
+'''
+
+import os
+import sys
+from collections import OrderedDict
+from contextlib import contextmanager
+from time import perf_counter, process_time
+
+
+def peak_memory():
+    '''Return the peak resident set size of the process and of its largest
+    child process, in MiB, or `None` if the information is not available on
+    this platform.'''
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is expressed in bytes on macOS and in KiB elsewhere
+    scale = 1024**2 if sys.platform == 'darwin' else 1024
+    return tuple(resource.getrusage(who).ru_maxrss / scale
+                 for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+
+
+def _children_cpu_time():
+    '''Return the CPU time consumed by the terminated child processes.'''
+    times = os.times()
+    return times.children_user + times.children_system
+
+
+class PhaseStats:
+    '''The measurements for one phase of the conversion.'''
+
+    __slots__ = ('wall', 'cpu', 'children_cpu', 'peak_rss', 'calls',
+                 'counts')
+
+    def __init__(self):
+        self.wall = 0.
+        self.cpu = 0.
+        self.children_cpu = 0.
+        self.peak_rss = None
+        self.calls = 0
+        self.counts = OrderedDict()
+
+    def as_dict(self):
+        '''Return the measurements as a JSON-serializable dictionary.'''
+        return OrderedDict([('wall', self.wall),
+                            ('cpu', self.cpu),
+                            ('children_cpu', self.children_cpu),
+                            ('peak_rss', self.peak_rss),
+                            ('calls', self.calls),
+                            ('counts', OrderedDict(self.counts))])
+
+
+class Instrumentation:
+    '''Accumulate the measurements for the phases of the conversion.
+
+    The measurements of a phase that is entered several times are summed.
+    The phases are listed in the order in which they were first entered.
+    Counts are attributed to the innermost active phase, and summed over all
+    the phases in :attr:`counts`.
+
+    >>> stats = Instrumentation()
+    >>> with stats.phase('parse'):
+    ...     stats.count('cells', 3)
+    >>> with stats.phase('write'):
+    ...     stats.count('cells', 2)
+    ...     stats.count('volumes')
+    >>> list(stats.phases)
+    ['parse', 'write']
+    >>> dict(stats.phases['write'].counts)
+    {'cells': 2, 'volumes': 1}
+    >>> dict(stats.counts)
+    {'cells': 5, 'volumes': 1}
+    >>> stats.reset()
+    >>> stats.wall_times()
+    OrderedDict()
+    '''
+
+    def __init__(self):
+        self.phases = OrderedDict()
+        self.counts = OrderedDict()
+        self.active = []
+        self.start = perf_counter(), process_time()
+
+    @contextmanager
+    def phase(self, name):
+        '''Return a context manager measuring the phase called `name`.'''
+        stats = self.phases.get(name)
+        if stats is None:
+            stats = self.phases[name] = PhaseStats()
+        self.active.append(stats)
+        wall, cpu = perf_counter(), process_time()
+        children_cpu = _children_cpu_time()
+        try:
+            yield stats
+        finally:
+            stats.wall += perf_counter() - wall
+            stats.cpu += process_time() - cpu
+            stats.children_cpu += _children_cpu_time() - children_cpu
+            stats.calls += 1
+            peak = peak_memory()
+            if peak is not None:
+                stats.peak_rss = peak[0]
+            self.active.pop()
+
+    def count(self, name, value=1):
+        '''Add `value` to the counter called `name`.'''
+        if self.active:
+            counts = self.active[-1].counts
+            counts[name] = counts.get(name, 0) + value
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def reset(self):
+        '''Forget all the measurements.'''
+        self.phases.clear()
+        self.counts.clear()
+        del self.active[:]
+        self.start = perf_counter(), process_time()
+
+    def wall_times(self):
+        '''Return an ordered dictionary associating the name of each phase to
+        the wall-clock time spent in it, in seconds.'''
+        return OrderedDict((name, stats.wall)
+                           for name, stats in self.phases.items())
+
+    def as_dict(self):
+        '''Return all the measurements as a JSON-serializable dictionary.
+
+        The total wall-clock and CPU times are measured since the creation of
+        the object or since the last call to :meth:`reset`.'''
+        result = OrderedDict()
+        result['wall'] = perf_counter() - self.start[0]
+        result['cpu'] = process_time() - self.start[1]
+        result['phases'] = OrderedDict((name, stats.as_dict())
+                                       for name, stats in self.phases.items())
+        result['counts'] = OrderedDict(self.counts)
+        for prefix in ('', 'volume_'):
+            checked = self.counts.get(prefix + 'dedup_checked', 0)
+            if checked:
+                result[prefix + 'dedup_hit_rate'] = (
+                    self.counts.get(prefix + 'dedup_merged', 0) / checked)
+        peak = peak_memory()
+        if peak is not None:
+            result['peak_rss'] = peak[0]
+            result['peak_rss_children'] = peak[1]
+        return result
+
+    def format_table(self):
+        '''Return a human-readable table of the measurements.'''
+        lines = ['{:<14s} {:>10s} {:>10s} {:>12s}  {}'
+                 .format('phase', 'wall (s)', 'cpu (s)', 'rss (MiB)',
+                         'counts')]
+        for name, stats in self.phases.items():
+            rss = ('{:12.1f}'.format(stats.peak_rss)
+                   if stats.peak_rss is not None else '{:>12s}'.format('-'))
+            counts = ', '.join('{}={}'.format(key, value)
+                               for key, value in stats.counts.items())
+            lines.append('{:<14s} {:10.3f} {:10.3f} {}  {}'
+                         .format(name, stats.wall,
+                                 stats.cpu + stats.children_cpu, rss,
+                                 counts))
+        return '\n'.join(lines)
+
+
+#: The measurements of the current conversion.
+STATS = Instrumentation()
+
+
+def phase(name):
+    '''Measure the phase called `name`, see :meth:`Instrumentation.phase`.'''
+    return STATS.phase(name)
+
+
+def count(name, value=1):
+    '''Add `value` to the counter called `name`, see
+    :meth:`Instrumentation.count`.'''
+    STATS.count(name, value)
@@ -7,14 +7,38 @@ Created on 6 févr. 2019
 '''
 from .ConversionSurfaceMCNPToT4 import convert_mcnp_surfaces
 from ..FileHandlers.Parser.ParseMCNPSurface import parseMCNPSurface
+from ..Instrumentation import phase
 
 
-def construct_surface_t4(mcnp_parser):
+def construct_surface_t4(mcnp_parser, cache=None, jobs=1, model=None):
     '''
     :brief: method constructing a dictionary with the id
     of the surface as a key and the instance of SurfaceT4 as a value
+
+    If `cache` is not `None`, the MCNP and TRIPOLI-4 surfaces are read from
+    the :class:`~.ConversionCache`, if available. If `jobs` is larger than 1,
+    the surface cards are parsed by a pool of `jobs` worker processes. If
+    `model` is not `None`, it must be a :class:`~.ModelReader` (the parsed
+    MCNP surfaces are read from it) or a :class:`~.ModelWriter` (they are
+    recorded into it).
     '''
-    dic_surface_mcnp = parseMCNPSurface(mcnp_parser)
-    dic_surface_t4 = convert_mcnp_surfaces(dic_surface_mcnp)
+
+    def parse_surfaces():
+        with phase('parse'):
+            return parseMCNPSurface(mcnp_parser, jobs)
+
+    def convert_surfaces():
+        with phase('surfaces'):
+            return convert_mcnp_surfaces(dic_surface_mcnp)
+
+    if model is not None:
+        dic_surface_mcnp = model.fetch('mcnp_surfaces', parse_surfaces)
+        dic_surface_t4 = convert_surfaces()
+    elif cache is None:
+        dic_surface_mcnp = parse_surfaces()
+        dic_surface_t4 = convert_surfaces()
+    else:
+        dic_surface_mcnp = cache.fetch('mcnp_surfaces', parse_surfaces)
+        dic_surface_t4 = cache.fetch('t4_surfaces', convert_surfaces)
 
     return dic_surface_t4, dic_surface_mcnp
@@ -11,6 +11,7 @@ from .ESurfaceTypeT4 import ESurfaceTypeT4 as T4S
 from .SurfaceT4 import SurfaceT4
 from .SurfaceCollection import SurfaceCollection
 from .SurfaceConversionError import SurfaceConversionError
+from ..Instrumentation import count
 
 
 def convert_mcnp_surfaces(dic_surface_mcnp):
@@ -35,6 +36,7 @@ def convert_mcnp_surfaces(dic_surface_mcnp):
         dic_surface_t4[key] = t4_surfs
 
     print('... done', flush=True)
+    count('t4_surfaces', n_surfaces)
     return dic_surface_t4
 
 
@@ -1,49 +1,215 @@
 '''This module contains utilities to simplify surface dictionaries.'''
 
+from collections import defaultdict
+from itertools import product
+from math import floor, sqrt
+
 from .CollectionDict import CollectionDict
+from .ESurfaceTypeT4 import ESurfaceTypeT4 as T4S
+from ..Instrumentation import count
+
+
+#: Default tolerance for the detection of duplicate surfaces.
+DEFAULT_TOLERANCE = 1e-9
+
+#: Axis-aligned planes, and the index of their normal axis.
+AXIS_PLANES = {T4S.PLANEX: 0, T4S.PLANEY: 1, T4S.PLANEZ: 2}
+
+#: Fraction of the norm above which a component of the normal vector of a
+#: plane can fix the sign of its canonical form (a vector always has a
+#: component larger than 1/sqrt(3) times its norm).
+PIVOT_THRESHOLD = 0.5 / sqrt(3.)
+
+
+def _pivot_sign(coeffs, threshold):
+    '''Return the sign of the first coefficient whose absolute value is at
+    least `threshold`.'''
+    for coeff in coeffs:
+        if abs(coeff) >= threshold:
+            return 1 if coeff > 0 else -1
+    return 1
+
+
+def canonical_surface(surf):
+    '''Return a canonical form of a TRIPOLI-4 surface, for the purpose of
+    detecting duplicates.
+
+    Planes (including axis-aligned planes) are represented by a unit normal
+    vector and an offset; quadrics are scaled so that their largest
+    coefficient is 1 in absolute value. The sign of planes and quadrics is
+    chosen so that the first significant coefficient is positive; flipping the
+    sign swaps the two sides of the surface.
+
+    :returns: a triple consisting of a hashable kind, a tuple of floats and
+        the side of `surf` with respect to the canonical surface (1 or -1).
+
+    >>> from .SurfaceT4 import SurfaceT4
+    >>> canonical_surface(SurfaceT4(T4S.PLANEX, [2.0]))
+    ('plane', (1.0, 0.0, 0.0, -2.0), 1)
+    >>> canonical_surface(SurfaceT4(T4S.PLANE, [-2.0, 0.0, 0.0, 4.0]))
+    ('plane', (1.0, -0.0, -0.0, -2.0), -1)
+    >>> canonical_surface(SurfaceT4(T4S.SPHERE, [0, 0, 0, 5]))
+    (<ESurfaceTypeT4.SPHERE: 5>, (0.0, 0.0, 0.0, 5.0), 1)
+    '''
+    params = tuple(float(param) for param in surf.param_surface)
+    if surf.type_surface in AXIS_PLANES:
+        normal = [0.0, 0.0, 0.0]
+        normal[AXIS_PLANES[surf.type_surface]] = 1.0
+        return 'plane', tuple(normal) + (-params[0],), 1
+    if surf.type_surface == T4S.PLANE:
+        norm = sqrt(sum(coeff*coeff for coeff in params[:3]))
+        side = _pivot_sign(params[:3], PIVOT_THRESHOLD * norm)
+        scale = side / norm
+        return 'plane', tuple(coeff * scale for coeff in params), side
+    if surf.type_surface == T4S.QUAD:
+        largest = max(abs(coeff) for coeff in params)
+        if largest == 0.:
+            return surf.type_surface, params, 1
+        side = _pivot_sign(params, 0.5 * largest)
+        scale = side / largest
+        return (surf.type_surface, tuple(coeff * scale for coeff in params),
+                side)
+    return surf.type_surface, params, 1
+
+
+class SurfaceIndex:
+    '''A spatial-hash index of canonical surfaces, for finding the surfaces
+    that lie within a given tolerance of a query surface.
+
+    The parameters of each surface are quantized on a grid whose step is much
+    larger than the tolerance, and the surface is stored in the bucket of its
+    grid cell. A query only needs to visit the neighbouring cells along the
+    (rare) dimensions where the query point lies within the tolerance of a
+    cell boundary, so lookups take constant expected time.
+
+    Two surfaces match if they have the same kind and the same number of
+    parameters, and if all their parameters differ by at most `tolerance`.
+    With a zero tolerance, the parameters must be exactly equal.
+
+    >>> index = SurfaceIndex(1e-6)
+    >>> index.add('plane', (1.0, 0.0, 0.0, 2.0), 10)
+    >>> index.find('plane', (1.0, 0.0, 0.0, 2.0 + 1e-9))
+    10
+    >>> index.find('plane', (1.0, 0.0, 0.0, 2.1)) is None
+    True
+    '''
+
+    #: Ratio between the grid step and the tolerance.
+    GRID_RATIO = 64
+
+    def __init__(self, tolerance):
+        self.tolerance = tolerance
+        self.step = tolerance * self.GRID_RATIO
+        self.buckets = defaultdict(list)
 
+    def _cell(self, params):
+        return tuple(floor(param / self.step) for param in params)
 
-def remove_duplicate_surfaces(surfs):
+    def add(self, kind, params, key):
+        '''Add a surface to the index.'''
+        if not self.tolerance:
+            self.buckets.setdefault((kind, params), [(params, key)])
+            return
+        self.buckets[kind, self._cell(params)].append((params, key))
+
+    def find(self, kind, params):
+        '''Return the key of the matching surface with the smallest key, or
+        `None` if no surface in the index matches.'''
+        if not self.tolerance:
+            bucket = self.buckets.get((kind, params))
+            return bucket[0][1] if bucket else None
+        tol, step = self.tolerance, self.step
+        choices = []
+        for param, cell in zip(params, self._cell(params)):
+            offset = param - cell * step
+            choice = [cell]
+            if offset <= tol:
+                choice.append(cell - 1)
+            if step - offset <= tol:
+                choice.append(cell + 1)
+            choices.append(choice)
+        found = None
+        for cell in product(*choices):
+            for other, key in self.buckets.get((kind, cell), ()):
+                if found is not None and key > found:
+                    continue
+                if len(other) == len(params) and all(
+                        abs(a - b) <= tol for a, b in zip(params, other)):
+                    found = key
+        return found
+
+
+def dedup_renumbering(canonical_forms, tolerance=DEFAULT_TOLERANCE):
+    '''Detect the duplicate surfaces, given their canonical forms (see
+    :func:`canonical_surface`).
+
+    The surfaces are processed in the given order, which should be the order
+    of their IDs: each surface is replaced by the first surface that matches
+    it within `tolerance`, if any.
+
+    :param canonical_forms: an iterable of ``(ID, canonical form)`` pairs
+    :returns: an iterator over ``(ID, new ID)`` pairs, in the same order; the
+        new ID is the ID of the surface itself if it is kept, and the signed
+        ID of the replacing surface otherwise.
+
+    >>> forms = [(1, ('plane', (1.0, 0.0, 0.0, -2.0), 1)),
+    ...          (2, ('plane', (1.0, 0.0, 0.0, -2.0), -1)),
+    ...          (3, ('plane', (0.0, 1.0, 0.0, -2.0), 1))]
+    >>> list(dedup_renumbering(forms))
+    [(1, 1), (2, -1), (3, 3)]
+    '''
+    index = SurfaceIndex(tolerance)
+    sides = {}
+    for key, (kind, params, side) in canonical_forms:
+        found = index.find(kind, params)
+        if found is not None:
+            yield key, side * sides[found] * found
+        else:
+            sides[key] = side
+            index.add(kind, params, key)
+            yield key, key
+
+
+def remove_duplicate_surfaces(surfs, tolerance=DEFAULT_TOLERANCE):
     '''This function that detects duplicate surfaces from a surface dictionary,
     removes them and provides a dictionary where the IDs of the deleted
-    surfaces are associated with the ID of the surface that replaced them.'''
+    surfaces are associated with the ID of the surface that replaced them.
+
+    Surfaces are considered as duplicates if their canonical forms (see
+    :func:`canonical_surface`) differ by at most `tolerance`. A surface may
+    be replaced by a surface with the opposite orientation; in this case, its
+    ID is associated to the opposite of the ID of the replacing surface.
+
+    >>> from .SurfaceT4 import SurfaceT4
+    >>> surfs = {1: SurfaceT4(T4S.PLANEX, [2.0]),
+    ...          2: SurfaceT4(T4S.PLANE, [-1.0, 0.0, 0.0, 2.0]),
+    ...          3: SurfaceT4(T4S.PLANE, [0.5, 0.0, 0.0, -1.0 + 1e-12]),
+    ...          4: SurfaceT4(T4S.SPHERE, [0.0, 0.0, 0.0, 1.0])}
+    >>> import io, contextlib
+    >>> with contextlib.redirect_stdout(io.StringIO()):
+    ...     new_surfs, renumbering = remove_duplicate_surfaces(surfs)
+    >>> sorted(new_surfs), renumbering
+    ([1, 4], {1: 1, 2: -1, 3: 1, 4: 4})
+    '''
     renumbering = {}
     new_surfs = CollectionDict()
-    surf_to_id = {}
 
     n_surfs = len(surfs)
     fmt_string = ('\rdetecting duplicates for surface {{:{0}d}} '
                   '({{:{1}d}}/{{:{1}d}}, {{:3d}}%)'
                   .format(len(str(max(surfs))), len(str(n_surfs))))
-    for i, (key, surf) in enumerate(sorted(surfs.items())):
+    items = sorted(surfs.items())
+    forms = ((key, canonical_surface(surf)) for key, surf in items)
+    for i, ((key, surf), (_, new_key)) in enumerate(
+            zip(items, dedup_renumbering(forms, tolerance))):
         percent = int(100.0*i/(n_surfs-1)) if n_surfs > 1 else 100
         print(fmt_string.format(key, i+1, n_surfs, percent),
               end='', flush=True)
-        if surf in surf_to_id:
-            renumbering[key] = surf_to_id[surf]
-        else:
+        renumbering[key] = new_key
+        if new_key == key:
             new_surfs[key] = surf
-            renumbering[key] = key
-            surf_to_id[surf] = key
     print('... done', flush=True)
+    count('dedup_checked', n_surfs)
+    count('dedup_merged', n_surfs - len(new_surfs))
 
     return new_surfs, renumbering
-
-
-def renumber_surfaces(volus, renumbering):
-    volus = volus.copy()
-
-    n_volus = len(volus)
-    fmt_string = ('\rrenumbering surfaces in cell {{:{0}d}} '
-                  '({{:{1}d}}/{{:{1}d}}, {{:3d}}%)'
-                  .format(len(str(max(volus))), len(str(n_volus))))
-    for i, (key, volu) in enumerate(volus.items()):
-        percent = int(100.0*i/(n_volus-1)) if n_volus > 1 else 100
-        print(fmt_string.format(key, i+1, n_volus, percent),
-              end='', flush=True)
-        new_pluses = set(renumbering[s] for s in volu.pluses)
-        new_minuses = set(renumbering[s] for s in volu.minuses)
-        volu.pluses = new_pluses
-        volu.minuses = new_minuses
-    print('... done', flush=True)
-    return volus
@@ -0,0 +1,77 @@
+'''Module containing functions to translate MCNP surfaces by many
+displacement vectors at once, as needed for the development of lattices.'''
+
+import numpy as np
+
+from ..Surface.SurfaceMCNP import SurfaceMCNP
+from ..Surface.ESurfaceTypeMCNP import ESurfaceTypeMCNP as MS
+from .Transformation import transformation
+
+
+def translation(vec):
+    '''Return the 12-parameter MCNP transformation for a translation by
+    `vec`.
+
+    >>> translation((1.0, 2.0, 3.0))
+    [1.0, 2.0, 3.0, 1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0]
+    '''
+    return list(vec) + [1., 0., 0., 0., 1., 0., 0., 0., 1.]
+
+
+def lattice_vectors(base_vecs, indices):
+    '''Compute the displacement vectors for an array of lattice indices.
+
+    This is the vectorized version of :func:`~.latticeVector`; the floating
+    point operations are performed in the same order, so the results are
+    identical.
+
+    :param base_vecs: the base vectors of the lattice
+    :param indices: an integer array of shape ``(n, d)``, with ``d`` at least
+        as large as the number of base vectors; the extra indices are
+        ignored
+    :returns: an array of shape ``(n, 3)``
+
+    >>> from ..Volume.Lattice import latticeVector
+    >>> base_vecs = [(1, 0, 0), (0.1, 0, 2)]
+    >>> indices = np.array([(0, 0), (3, 2), (-1, -1)])
+    >>> lattice_vectors(base_vecs, indices).tolist()
+    [[0.0, 0.0, 0.0], [3.2, 0.0, 4.0], [-1.1, 0.0, -2.0]]
+    >>> [latticeVector(base_vecs, index) for index in indices.tolist()]
+    [(0.0, 0.0, 0.0), (3.2, 0.0, 4.0), (-1.1, 0.0, -2.0)]
+    '''
+    vectors = np.zeros((len(indices), 3))
+    for i, vec in zip(range(indices.shape[1]), base_vecs):
+        vectors += (indices[:, i:i+1].astype(float)
+                    * np.asarray(vec, dtype=float))
+    return vectors
+
+
+def translate_surface(surf, vectors):
+    '''Translate an MCNP surface by each of the given displacement vectors.
+
+    The frame of the surface is transformed once; the translated origins of
+    the frames are then computed for all the vectors in a single vectorized
+    operation. Quadrics (which have no frame) are translated one at a time.
+
+    :param SurfaceMCNP surf: the surface to translate
+    :param vectors: an array of shape ``(n, 3)``
+    :returns: a list of `n` :class:`~.SurfaceMCNP` objects
+
+    >>> surf = SurfaceMCNP('', MS.S, ((1.0, 0.0, 0.0), (0, 0, 1)), (2.0,))
+    >>> translate_surface(surf, np.array([[0.0, 0.0, 0.0], [0.5, 1.0, 0.0]]))
+    [SurfaceMCNP('', <ESurfaceTypeMCNP.S: 6>, ((1.0, 0.0, 0.0), \
+(0.0, 0.0, 1.0)), (2.0,), ()), SurfaceMCNP('', <ESurfaceTypeMCNP.S: 6>, \
+((1.5, 1.0, 0.0), (0.0, 0.0, 1.0)), (2.0,), ())]
+    '''
+    if surf.type_surface in (MS.SQ, MS.GQ):
+        return [transformation(translation(vec), surf)
+                for vec in vectors.tolist()]
+    # the template is the surface rotated by the identity, i.e. with the same
+    # rounding of the frame as any translation
+    template = transformation(translation((0., 0., 0.)), surf)
+    point, direction = template.param_surface
+    points = (vectors + np.asarray(point, dtype=float)).tolist()
+    return [SurfaceMCNP(template.boundary_cond, template.type_surface,
+                        (tuple(new_point), direction), template.compl_param,
+                        template.idorigin)
+            for new_point in points]
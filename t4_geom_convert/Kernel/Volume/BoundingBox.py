@@ -0,0 +1,533 @@
+'''Module containing the :class:`BoundingBox` class and functions that compute
+conservative axis-aligned bounding boxes for the geometry of MCNP cells and of
+TRIPOLI-4 volumes.
+
+The bounding boxes computed here are never smaller than the cells they
+enclose, but they may be larger (or even infinite) if the cell is bounded by
+surfaces whose extent is not easy to compute (cones, tori, quadrics...).
+'''
+
+from itertools import combinations
+
+import numpy as np
+
+from MIP.geom.semantics import Surface
+
+from ..Surface.ESurfaceTypeMCNP import ESurfaceTypeMCNP as MS
+from ..Surface.ESurfaceTypeT4 import ESurfaceTypeT4 as T4S
+from ..VectUtils import scal, renorm, mixed, vect, rescale, vsum, mag2
+
+INF = float('inf')
+
+#: Coordinates larger than this are considered as infinite during the
+#: enumeration of the vertices of polytopes.
+BIG = 1e10
+
+#: Maximum number of oblique planes for which :func:`polytope_bbox` tries to
+#: refine a bounding box.
+MAX_POLYTOPE_PLANES = 40
+
+#: Components of direction vectors smaller than this are neglected; the boxes
+#: are padded accordingly, assuming that the geometry is contained in a cube of
+#: side `BIG`.
+EPS = 1e-12
+
+# axes of the TRIPOLI-4 surfaces that are aligned with one of them
+_T4_PLANES = {T4S.PLANEX: 0, T4S.PLANEY: 1, T4S.PLANEZ: 2}
+_T4_CYLINDERS = {T4S.CYLX: 0, T4S.CYLY: 1, T4S.CYLZ: 2}
+_T4_TORI = {T4S.TORUSX: 0, T4S.TORUSY: 1, T4S.TORUSZ: 2}
+
+
+class BoundingBox:
+    '''An axis-aligned box, possibly infinite in some directions, possibly
+    empty.
+
+    >>> box = BoundingBox((0, 0, 0), (1, 2, INF))
+    >>> box
+    BoundingBox((0, 0, 0), (1, 2, inf))
+    >>> box & BoundingBox((0.5, -1, -1), (3, 3, 3))
+    BoundingBox((0.5, 0, 0), (1, 2, 3))
+    >>> box | BoundingBox((0.5, -1, -1), (3, 3, 3))
+    BoundingBox((0, -1, -1), (3, 3, inf))
+    >>> box.overlaps(BoundingBox((2, 0, 0), (3, 1, 1)))
+    False
+    >>> box.translated((2, 0, 0)).overlaps(BoundingBox((2, 0, 0), (3, 1, 1)))
+    True
+    >>> (box & BoundingBox((2, 0, 0), (3, 1, 1))).is_empty()
+    True
+    '''
+
+    __slots__ = ('lows', 'highs')
+
+    def __init__(self, lows=(-INF, -INF, -INF), highs=(INF, INF, INF)):
+        self.lows = tuple(lows)
+        self.highs = tuple(highs)
+
+    @classmethod
+    def empty(cls):
+        '''Return an empty box.'''
+        return cls((INF, INF, INF), (-INF, -INF, -INF))
+
+    def is_empty(self):
+        '''Return `True` if the box is empty.'''
+        return any(low > high for low, high in zip(self.lows, self.highs))
+
+    def is_infinite(self):
+        '''Return `True` if the box is unbounded along all the axes.'''
+        return (all(low == -INF for low in self.lows)
+                and all(high == INF for high in self.highs))
+
+    def is_bounded(self):
+        '''Return `True` if the box is bounded along all the axes.'''
+        return (all(low > -INF for low in self.lows)
+                and all(high < INF for high in self.highs))
+
+    def __and__(self, other):
+        return BoundingBox(map(max, self.lows, other.lows),
+                           map(min, self.highs, other.highs))
+
+    def __or__(self, other):
+        if self.is_empty():
+            return other
+        if other.is_empty():
+            return self
+        return BoundingBox(map(min, self.lows, other.lows),
+                           map(max, self.highs, other.highs))
+
+    def __eq__(self, other):
+        if not isinstance(other, BoundingBox):
+            return NotImplemented
+        return self.lows == other.lows and self.highs == other.highs
+
+    def __repr__(self):
+        return 'BoundingBox({}, {})'.format(self.lows, self.highs)
+
+    def overlaps(self, other):
+        '''Return `True` if the boxes overlap (or touch).'''
+        return all(low1 <= high2 and low2 <= high1
+                   for low1, high1, low2, high2
+                   in zip(self.lows, self.highs, other.lows, other.highs))
+
+    def translated(self, vec):
+        '''Return a copy of the box, translated by `vec`.'''
+        return BoundingBox(map(sum, zip(self.lows, vec)),
+                           map(sum, zip(self.highs, vec)))
+
+    def overlaps_translated(self, vectors, other):
+        '''Return a boolean array telling whether the copies of the box
+        translated by `vectors` (an array of shape ``(n, 3)``) overlap
+        `other`.
+
+        >>> box = BoundingBox((0, 0, 0), (1, 2, INF))
+        >>> other = BoundingBox((2, 0, 0), (3, 1, 1))
+        >>> box.overlaps_translated(np.array([[0, 0, 0], [2, 0, 0]]), other)
+        array([False,  True])
+        '''
+        lows = np.asarray(self.lows, dtype=float) + vectors
+        highs = np.asarray(self.highs, dtype=float) + vectors
+        return ((lows <= np.asarray(other.highs, dtype=float)).all(axis=1)
+                & (np.asarray(other.lows, dtype=float) <= highs).all(axis=1))
+
+    def transformed(self, trpl):
+        '''Return the bounding box of the image of this box under the MCNP
+        transformation `trpl` (12 parameters: the displacement vector and the
+        rotation matrix, as in :func:`MIP.geom.transforms.transform_point`).
+
+        >>> box = BoundingBox((0, 0, 0), (1, 2, INF))
+        >>> box.transformed((1, 0, 0, 0, 1, 0, -1, 0, 0, 0, 0, 1))
+        BoundingBox((-1.0, 0.0, 0.0), (1.0, 1.0, inf))
+        '''
+        if not trpl or self.is_empty():
+            return self
+        rows = [(trpl[3+i], trpl[6+i], trpl[9+i]) for i in range(3)]
+        return self._affine(rows, trpl[:3], (0., 0., 0.))
+
+    def inverse_transformed(self, trpl):
+        '''Return the bounding box of the preimage of this box under the MCNP
+        transformation `trpl`.
+
+        >>> trpl = (1, 0, 0, 0, 1, 0, -1, 0, 0, 0, 0, 1)
+        >>> box = BoundingBox((0, 0, 0), (1, 2, INF))
+        >>> box.transformed(trpl).inverse_transformed(trpl)
+        BoundingBox((0.0, 0.0, 0.0), (1.0, 2.0, inf))
+        '''
+        if not trpl or self.is_empty():
+            return self
+        rows = [tuple(trpl[3+3*i:6+3*i]) for i in range(3)]
+        return self._affine(rows, (0., 0., 0.), trpl[:3])
+
+    def _affine(self, rows, shift_after, shift_before):
+        '''Interval arithmetic for ``rows @ (x - shift_before) + shift_after``.
+        '''
+        lows = [low - shift for low, shift in zip(self.lows, shift_before)]
+        highs = [high - shift for high, shift in zip(self.highs, shift_before)]
+        new_lows, new_highs = [], []
+        for row, shift in zip(rows, shift_after):
+            new_low = new_high = float(shift)
+            for coeff, low, high in zip(row, lows, highs):
+                if abs(coeff) < EPS:
+                    continue
+                if coeff > 0:
+                    new_low += coeff * low
+                    new_high += coeff * high
+                else:
+                    new_low += coeff * high
+                    new_high += coeff * low
+            new_lows.append(new_low)
+            new_highs.append(new_high)
+        return BoundingBox(new_lows, new_highs)
+
+
+def _axis(vec):
+    '''Return the index of the axis parallel to `vec`, or `None`.'''
+    for axis in range(3):
+        if all(abs(vec[i]) < EPS for i in range(3) if i != axis):
+            return axis
+    return None
+
+
+def half_space(surf, side):
+    '''Return a bounding box for one side of an MCNP surface, and a list of
+    oblique half-spaces (in the form ``(normal, offset)``, representing the
+    points `x` such that ``scal(normal, x) <= offset``) that also contain it.
+
+    :param SurfaceMCNP surf: the surface
+    :param int side: the side of the surface (±1)
+
+    >>> from ..Surface.SurfaceMCNP import SurfaceMCNP
+    >>> sphere = SurfaceMCNP('', MS.S, ((1, 0, 0), (0, 0, 1)), (2,))
+    >>> half_space(sphere, -1)
+    (BoundingBox((-1, -2, -2), (3, 2, 2)), [])
+    >>> half_space(sphere, 1)
+    (BoundingBox((-inf, -inf, -inf), (inf, inf, inf)), [])
+    >>> plane = SurfaceMCNP('', MS.P, ((0, 0, 3), (0, 0, 1)), ())
+    >>> half_space(plane, -1)
+    (BoundingBox((-inf, -inf, -inf), (inf, inf, 3.0)), [])
+    '''
+    params = surf.param_surface
+    if surf.type_surface == MS.P:
+        point, normal = params
+        return _plane_half_space(point, normal, side)
+    if side > 0:
+        return BoundingBox(), []
+    if surf.type_surface == MS.S:
+        center, _ = params
+        return _sphere_bbox(center, surf.compl_param[0]), []
+    if surf.type_surface == MS.C:
+        point, direction = params
+        return _cylinder_bbox(point, direction, surf.compl_param[0]), []
+    return BoundingBox(), []
+
+
+def _plane_half_space(point, normal, side):
+    '''Return a bounding box and a list of oblique half-spaces for one side
+    of the plane through `point` with the given `normal`.'''
+    normal = renorm(normal)
+    axis = _axis(normal)
+    if axis is None:
+        normal = rescale(-side, normal)
+        return BoundingBox(), [(normal, scal(normal, point))]
+    pad = sum(abs(normal[i]) * (BIG + abs(point[i]))
+              for i in range(3) if i != axis) / abs(normal[axis])
+    if normal[axis] * side > 0:
+        lows = [-INF, -INF, -INF]
+        lows[axis] = point[axis] - pad
+        return BoundingBox(lows=lows), []
+    highs = [INF, INF, INF]
+    highs[axis] = point[axis] + pad
+    return BoundingBox(highs=highs), []
+
+
+def _sphere_bbox(center, radius):
+    '''Return the bounding box of the inside of a sphere.'''
+    return BoundingBox((coord - radius for coord in center),
+                       (coord + radius for coord in center))
+
+
+def _cylinder_bbox(point, direction, radius):
+    '''Return a bounding box for the inside of an infinite cylinder.'''
+    direction = renorm(direction)
+    lows, highs = [-INF, -INF, -INF], [INF, INF, INF]
+    for axis in range(3):
+        if abs(direction[axis]) < EPS:
+            pad = radius + abs(direction[axis]) * BIG
+            lows[axis] = point[axis] - pad
+            highs[axis] = point[axis] + pad
+    return BoundingBox(lows, highs)
+
+
+def t4_half_space(surf, side):
+    '''Return a bounding box for one side of a TRIPOLI-4 surface, and a list
+    of oblique half-spaces that also contain it (see :func:`half_space`).
+
+    :param SurfaceT4 surf: the surface
+    :param int side: the side of the surface (1 for ``PLUS``, -1 for
+        ``MINUS``)
+
+    >>> from ..Surface.SurfaceT4 import SurfaceT4
+    >>> t4_half_space(SurfaceT4(T4S.CYLZ, (1, 0, 2)), -1)
+    (BoundingBox((-1.0, -2.0, -inf), (3.0, 2.0, inf)), [])
+    >>> t4_half_space(SurfaceT4(T4S.PLANEY, (3,)), 1)
+    (BoundingBox((-inf, 3.0, -inf), (inf, inf, inf)), [])
+    >>> t4_half_space(SurfaceT4(T4S.PLANE, (0, 0, 2, -4)), -1)
+    (BoundingBox((-inf, -inf, -inf), (inf, inf, 2.0)), [])
+    >>> t4_half_space(SurfaceT4(T4S.TORUSZ, (0, 0, 1, 5, 1, 2)), -1)
+    (BoundingBox((-7, -7, 0), (7, 7, 2)), [])
+    '''
+    typ, params = surf.type_surface, surf.param_surface
+    axis = _T4_PLANES.get(typ)
+    if axis is not None:
+        point, normal = [0., 0., 0.], [0., 0., 0.]
+        point[axis], normal[axis] = params[0], 1.
+        return _plane_half_space(point, normal, side)
+    if typ == T4S.PLANE:
+        normal = params[:3]
+        point = rescale(-params[3] / mag2(normal), normal)
+        return _plane_half_space(point, normal, side)
+    if side > 0:
+        return BoundingBox(), []
+    if typ == T4S.SPHERE:
+        return _sphere_bbox(params[:3], params[3]), []
+    axis = _T4_CYLINDERS.get(typ)
+    if axis is not None:
+        point = list(params[:2])
+        point.insert(axis, 0.)
+        direction = [0., 0., 0.]
+        direction[axis] = 1.
+        return _cylinder_bbox(point, direction, params[2]), []
+    if typ == T4S.CYL:
+        return _cylinder_bbox(params[:3], params[4:7], params[3]), []
+    axis = _T4_TORI.get(typ)
+    if axis is not None:
+        center = params[:3]
+        major, axial, radial = params[3:6]
+        pads = [abs(major) + radial] * 3
+        pads[axis] = axial
+        lows = (coord - pad for coord, pad in zip(center, pads))
+        highs = (coord + pad for coord, pad in zip(center, pads))
+        return BoundingBox(lows, highs), []
+    return BoundingBox(), []
+
+
+def _solve(planes):
+    '''Return the intersection point of three planes, or `None` if they do not
+    intersect in a single point.'''
+    (n_1, d_1), (n_2, d_2), (n_3, d_3) = planes
+    det = mixed(n_1, n_2, n_3)
+    if abs(det) < EPS:
+        return None
+    return rescale(1. / det, vsum(rescale(d_1, vect(n_2, n_3)),
+                                  rescale(d_2, vect(n_3, n_1)),
+                                  rescale(d_3, vect(n_1, n_2))))
+
+
+def polytope_bbox(planes, box):
+    '''Refine a bounding box by intersecting it with the oblique half-spaces
+    `planes` (see :func:`half_space`). The vertices of the resulting polytope
+    are enumerated; the directions in which the polytope is not bounded stay
+    infinite.
+
+    >>> from math import sqrt
+    >>> diag = (1 / sqrt(2), 1 / sqrt(2), 0.)
+    >>> box = BoundingBox((0, 0, 0), (INF, INF, 1))
+    >>> refined = polytope_bbox([(diag, 1 / sqrt(2))], box)
+    >>> [round(x, 6) for x in refined.lows + refined.highs]
+    [0, 0, 0, 1.0, 1.0, 1]
+    >>> polytope_bbox([(diag, 1 / sqrt(2))], BoundingBox()).is_infinite()
+    True
+    '''
+    if not planes or len(planes) > MAX_POLYTOPE_PLANES or box.is_empty():
+        return box
+    constraints = list(planes)
+    for axis in range(3):
+        unit = [0., 0., 0.]
+        unit[axis] = 1.
+        constraints.append((tuple(unit), min(box.highs[axis], BIG)))
+        unit[axis] = -1.
+        constraints.append((tuple(unit), -max(box.lows[axis], -BIG)))
+    lows, highs = [INF, INF, INF], [-INF, -INF, -INF]
+    for triple in combinations(constraints, 3):
+        vertex = _solve(triple)
+        if vertex is None:
+            continue
+        if any(scal(normal, vertex) - offset
+               > 1e-9 * (1. + abs(offset) + sum(map(abs, vertex)))
+               for normal, offset in constraints):
+            continue
+        lows = list(map(min, lows, vertex))
+        highs = list(map(max, highs, vertex))
+    if lows[0] == INF:
+        # no vertices, probably because of round-off errors; give up
+        return box
+    pad = [1e-7 * (1. + abs(low) + abs(high))
+           for low, high in zip(lows, highs)]
+    lows = [-INF if low < -0.5 * BIG else low - eps
+            for low, eps in zip(lows, pad)]
+    highs = [INF if high > 0.5 * BIG else high + eps
+             for high, eps in zip(highs, pad)]
+    return box & BoundingBox(lows, highs)
+
+
+def _leaf_bbox(leaf, dic_surf_mcnp):
+    '''Return the bounding box and the oblique half-spaces of one side of an
+    MCNP surface (possibly a macrobody, or a facet of a macrobody).'''
+    sign = leaf.surface if isinstance(leaf, Surface) else leaf
+    sign = 1 if sign > 0 else -1
+    parts = dic_surf_mcnp[abs(leaf)]
+    if sign < 0 or len(parts) == 1:
+        # intersection of the sides of the parts
+        box, planes = BoundingBox(), []
+        for surf, side in parts:
+            part_box, part_planes = half_space(surf, sign * side)
+            box &= part_box
+            planes.extend(part_planes)
+        return box, planes
+    # union of the outer sides of the parts
+    box = BoundingBox.empty()
+    for surf, side in parts:
+        part_box, part_planes = half_space(surf, side)
+        box |= polytope_bbox(part_planes, part_box)
+    return box, []
+
+
+def _node_bbox(tree, dic_surf_mcnp):
+    if not isinstance(tree, (list, tuple)):
+        return _leaf_bbox(tree, dic_surf_mcnp)
+    operator, *args = tree
+    if operator == '*':
+        box, planes = BoundingBox(), []
+        for arg in args:
+            arg_box, arg_planes = _node_bbox(arg, dic_surf_mcnp)
+            box &= arg_box
+            planes.extend(arg_planes)
+        return box, planes
+    if operator == ':':
+        box = BoundingBox.empty()
+        for arg in args:
+            box |= polytope_bbox(*reversed(_node_bbox(arg, dic_surf_mcnp)))
+        return box, []
+    # complements or anything else
+    return BoundingBox(), []
+
+
+def cell_bbox(geometry, dic_surf_mcnp):
+    '''Return a conservative bounding box for the region described by the
+    MCNP cell AST `geometry`, in the form ``(operator, arg1, arg2, ...)``.
+
+    Axis-aligned planes, spheres and cylinders parallel to the axes provide
+    bounds directly; oblique planes are accounted for by :func:`polytope_bbox`.
+    Other surfaces are conservatively assumed to be unbounded.
+
+    >>> from ..Surface.SurfaceMCNP import SurfaceMCNP
+    >>> def plane(point, normal):
+    ...     return [(SurfaceMCNP('', MS.P, (point, normal), ()), 1)]
+    >>> surfs = {1: plane((0, 0, 0), (1, 0, 0)),
+    ...          2: plane((2, 0, 0), (1, 0, 0)),
+    ...          3: [(SurfaceMCNP('', MS.C, ((0, 0, 0), (0, 0, 1)), (1,)), 1)]}
+    >>> cell_bbox(('*', 1, -2, -3), surfs)
+    BoundingBox((0.0, -1.0, -inf), (1.0, 1.0, inf))
+    >>> cell_bbox((':', ('*', 1, -2), -3), surfs)
+    BoundingBox((-1.0, -inf, -inf), (2.0, inf, inf))
+    '''
+    box, planes = _node_bbox(geometry, dic_surf_mcnp)
+    return polytope_bbox(planes, box)
+
+
+def volume_bbox(volume, surfaces, boxes):
+    '''Return a conservative bounding box for a TRIPOLI-4 volume.
+
+    The volume is the intersection of the sides of its surfaces, combined
+    with its operands (if any) by an intersection (``INTE``) or by a union
+    (``UNION``).
+
+    :param volume: the volume, as a :class:`~.VolumeT4` (or a view)
+    :param surfaces: a dictionary associating surface IDs to
+        :class:`~.SurfaceT4` objects
+    :param boxes: a dictionary associating the IDs of the operands of
+        `volume` to their bounding boxes; missing operands are assumed to be
+        unbounded
+
+    >>> from ..Surface.SurfaceT4 import SurfaceT4
+    >>> from .VolumeT4 import VolumeT4
+    >>> surfs = {1: SurfaceT4(T4S.PLANEX, (1,)),
+    ...          2: SurfaceT4(T4S.PLANEX, (-1,)),
+    ...          3: SurfaceT4(T4S.SPHERE, (0, 0, 0, 2)),
+    ...          4: SurfaceT4(T4S.SPHERE, (5, 0, 0, 1))}
+    >>> boxes = {10: volume_bbox(VolumeT4([], [3]), surfs, {}),
+    ...          11: volume_bbox(VolumeT4([], [4]), surfs, {})}
+    >>> volume_bbox(VolumeT4([1], [2], ops=('UNION', (10, 11))), surfs, boxes)
+    BoundingBox((-2, -2, -2), (6, 2, 2))
+    >>> volume_bbox(VolumeT4([1], [], ops=('INTE', (10,))), surfs, boxes)
+    BoundingBox((1.0, -2, -2), (2, 2, 2))
+    '''
+    return _volume_bbox(volume, lambda surf_id, side:
+                        t4_half_space(surfaces[surf_id], side), boxes)
+
+
+def _volume_bbox(volume, half_space, boxes):
+    '''Implementation of :func:`volume_bbox`; the half-spaces of the
+    surfaces are computed by the callable ``half_space(surf_id, side)``.'''
+    box, planes = BoundingBox(), []
+    for surf_ids, side in ((volume.pluses, 1), (volume.minuses, -1)):
+        for surf_id in surf_ids:
+            surf_box, surf_planes = half_space(surf_id, side)
+            box &= surf_box
+            planes.extend(surf_planes)
+    box = polytope_bbox(planes, box)
+    ops = volume.ops
+    if ops is None:
+        return box
+    operator, args = ops
+    unbounded = BoundingBox()
+    if operator == 'INTE':
+        for arg in args:
+            box &= boxes.get(arg, unbounded)
+        return box
+    if box.is_infinite():
+        return box
+    for arg in args:
+        box |= boxes.get(arg, unbounded)
+    return box
+
+
+class VolumeBoxes:
+    '''Compute and store the bounding boxes of TRIPOLI-4 volumes.
+
+    The volumes must be presented to :meth:`add` after their operands. The
+    bounding boxes of the sides of the surfaces are memoized.
+
+    >>> from ..Surface.SurfaceT4 import SurfaceT4
+    >>> from .VolumeT4 import VolumeT4
+    >>> boxes = VolumeBoxes({1: SurfaceT4(T4S.SPHERE, (0, 0, 0, 2)),
+    ...                      2: SurfaceT4(T4S.PLANEZ, (1,))})
+    >>> boxes.add(10, VolumeT4([], [1]))
+    BoundingBox((-2, -2, -2), (2, 2, 2))
+    >>> boxes.add(11, VolumeT4([2], [], ops=('INTE', (10,))))
+    BoundingBox((-2, -2, 1.0), (2, 2, 2))
+    >>> sorted(boxes.half_spaces)
+    [(1, -1), (2, 1)]
+    '''
+
+    def __init__(self, surfaces):
+        self.surfaces = surfaces
+        # volume ID -> bounding box
+        self.boxes = {}
+        # (surface ID, side) -> result of t4_half_space
+        self.half_spaces = {}
+
+    def half_space(self, surf_id, side):
+        '''Return the (memoized) result of :func:`t4_half_space` for the
+        surface with ID `surf_id`.'''
+        memo_key = surf_id, side
+        result = self.half_spaces.get(memo_key)
+        if result is None:
+            result = self.half_spaces[memo_key] = t4_half_space(
+                self.surfaces[surf_id], side)
+        return result
+
+    def add(self, key, volume):
+        '''Compute, store and return the bounding box of `volume`, whose ID
+        is `key`.'''
+        box = self.boxes[key] = _volume_bbox(volume, self.half_space,
+                                             self.boxes)
+        return box
@@ -7,15 +7,20 @@ Created on 5 févr. 2019
 :file : CellConversion.py
 '''
 
-from MIP.geom.semantics import GeomExpression, Surface
+import numpy as np
+
+from MIP.geom.semantics import GeomExpression, Surface, FLIP
 from MIP.geom.main import extract_surfaces_list
 
 from .TreeFunctions import (isLeaf, isIntersection, isUnion,
-                            largestPureIntersectionNode)
+                            largestPureIntersectionNode, fold_tree)
 from .VolumeT4 import VolumeT4
-from .Lattice import (LatticeSpec, latticeVector, LatticeError,
-                      squareLatticeBaseVectors, hexLatticeBaseVectors)
+from .Lattice import (LatticeSpec, LatticeError, squareLatticeBaseVectors,
+                      hexLatticeBaseVectors)
+from .BoundingBox import BoundingBox, cell_bbox
 from ..Transformation.Transformation import transformation
+from ..Transformation.Translation import (translation, lattice_vectors,
+                                          translate_surface)
 from ..Surface.ConversionSurfaceMCNPToT4 import conversion_surface_params
 from ..Surface.SurfaceCollection import SurfaceCollection
 from .CellConversionError import CellConversionError
@@ -38,6 +43,17 @@ class CellConversion:
         self.dic_surf_t4 = d_dictSurfaceT4
         self.dic_surf_mcnp = d_dicSurfaceMCNP
         self.dic_cell_mcnp = d_dicCellMCNP
+        # (surface ID, facet, transformation) -> transformed surface ID
+        self.transformed_surfs = {}
+        # transformed surface ID -> (surface, transformation), with `None`
+        # in place of the transformation for the lattice translations
+        self.derived_surfs = {}
+        # number of lattice elements lying outside the cells they fill
+        self.skipped_lattice_elements = 0
+        # cell ID -> (expanded geometry, inverse of the expanded geometry)
+        self.complements = {}
+        # id of a cached geometry -> cached inverse (see pot_complement)
+        self.cached_inverses = {}
 
     @staticmethod
     def conv_equa(list_surface):
@@ -117,131 +133,417 @@ class CellConversion:
         :brief: method which take a tree and return a tuple of tuple with flag
         to decorate each tree in the tree
         '''
-        if isLeaf(p_tree):
-            return p_tree
-        operator, *args = p_tree
-        new_args = [self.pot_flag(node) for node in args]
-        self.new_cell_key += 1
-        new_tree = [self.new_cell_key, operator]
-        new_tree.extend(new_args)
-        return new_tree
+        def combine(node, new_args):
+            if isLeaf(node):
+                return node
+            self.new_cell_key += 1
+            new_tree = [self.new_cell_key, node[0]]
+            new_tree.extend(new_args)
+            return new_tree
+
+        return fold_tree(p_tree, _operands, combine)
 
     def pot_transform(self, p_tree, p_transf):
         if not p_transf:
             return p_tree
 
-        if not isLeaf(p_tree):
-            operator, *args = p_tree
-            if operator == '^':
-                # complements stay complements at this stage (they will be
-                # handled later)
-                return p_tree
-
-            # recursively apply the transformation to the arguments of the
-            # operator
-            new_args = [self.pot_transform(node, p_transf) for node in args]
-            new_tree = [operator]
-            new_tree.extend(new_args)
-            return tuple(new_tree)
-
-        surfs = self.dic_surf_mcnp[abs(p_tree)]
-
-        surf_colls = []
-        mcnp_surfs = []
-        for surface_object, side in surfs:
-            new_mcnp_surf = transformation(p_transf, surface_object)
-            mcnp_surfs.append((new_mcnp_surf, side))
-            surf_coll = conversion_surface_params(p_tree, new_mcnp_surf)
-            surf_colls.append((surf_coll, side))
-
-        surf_coll = SurfaceCollection.join(surf_colls)
-        for surf, _ in surf_coll.surfs[1:]:
-            surf.idorigin = tuple(list(surf.idorigin) + ['aux surf'])
+        def children(node):
+            # complements stay complements at this stage (they will be
+            # handled later)
+            if isLeaf(node) or node[0] == '^':
+                return ()
+            return node[1:]
+
+        def combine(node, new_args):
+            if isLeaf(node):
+                return self.transform_leaf(node, p_transf)
+            if node[0] == '^':
+                return node
+            return (node[0],) + tuple(new_args)
+
+        return fold_tree(p_tree, children, combine)
+
+    def transform_leaf(self, p_tree, p_transf):
+        '''Apply the transformation `p_transf` to the surface `p_tree` and
+        return the transformed surface.'''
+        # the same surface may be transformed in the same way many times
+        # (e.g. in all the instances of a repeated universe)
+        memo_key = leaf_key(p_tree) + (tuple(float(param)
+                                             for param in p_transf),)
+        new_key = self.transformed_surfs.get(memo_key)
+        if new_key is None:
+            new_key = self.new_transformed_surface(p_tree, p_transf)
+            self.transformed_surfs[memo_key] = new_key
+        return Surface(new_key) if p_tree >= 0 else Surface(-new_key)
 
+    def new_transformed_surface(self, p_tree, p_transf):
+        '''Apply the transformation `p_transf` to each MCNP part of the
+        surface `p_tree`; the storage of the transformed surface and the
+        allocation of its key are delegated to :meth:`new_surface`.'''
+        mcnp_surfs = [(transformation(p_transf, surface_object), side)
+                      for surface_object, side
+                      in self.dic_surf_mcnp[abs(p_tree)]]
+        new_key = self.new_surface(p_tree, mcnp_surfs)
+        self.derived_surfs[new_key] = (p_tree, p_transf)
+        return new_key
+
+    def new_surface(self, p_tree, mcnp_surfs):
+        '''Convert the MCNP surfaces `mcnp_surfs` (the parts of the
+        transformed surface `p_tree`), store them in the MCNP and TRIPOLI-4
+        surface dictionaries under a new key and return the key.'''
         self.new_surf_key += 1
         new_key = self.new_surf_key
-        self.dic_surf_t4[new_key] = surf_coll
+        self.dic_surf_t4[new_key] = convert_new_surface(p_tree, mcnp_surfs)
         self.dic_surf_mcnp[new_key] = mcnp_surfs
-
-        return Surface(new_key) if p_tree >= 0 else Surface(-new_key)
+        return new_key
 
     def pot_convert(self, p_tree, idorigin, union_ids):
         '''
         :brief: method which take the tree create by m_postOrderTraversalFlag
         and filled a dictionary (of VolumeT4 instance)
         '''
-        if isLeaf(p_tree):
-            self.new_cell_key += 1
-            p_id = self.new_cell_key
-            pluses, minuses = self.conv_equa([p_tree])
-            self.dic_vol_t4[p_id] = VolumeT4(pluses=pluses, minuses=minuses,
-                                             idorigin=idorigin)
-            return p_id
+        def children(node):
+            if isLeaf(node):
+                return ()
+            _, operator, *args = node
+            if operator == '*':
+                return [arg for arg in args if not isLeaf(arg)]
+            if operator != ':':
+                return ()
+            largest = largestPureIntersectionNode(args)
+            if largest is not None:
+                # the largest intersection comes first, see combine_union
+                args.insert(0, args.pop(largest))
+            return args
+
+        def combine(node, arg_ids):
+            if isLeaf(node):
+                self.new_cell_key += 1
+                p_id = self.new_cell_key
+                pluses, minuses = self.conv_equa([node])
+                self.dic_vol_t4[p_id] = VolumeT4(pluses=pluses,
+                                                 minuses=minuses,
+                                                 idorigin=idorigin)
+                return p_id
+            if node[1] == '*':
+                return self.combine_intersection(node, arg_ids, idorigin)
+            return self.combine_union(node, arg_ids, idorigin, union_ids)
+
+        return fold_tree(p_tree, children, combine)
+
+    def combine_intersection(self, p_tree, arg_ids, idorigin):
+        '''Create the volume for the intersection node `p_tree`, given the
+        IDs of the volumes of its non-leaf arguments.'''
+        p_id, _, *args = p_tree
+        surfs = [arg for arg in args if isLeaf(arg)]
+        # here we know that paramsOPER starts as ['EQUA', 'INTE', ...]
+        # because operator == '*'
+        if surfs:
+            pluses, minuses = self.conv_equa(surfs)
+            ops = self.conv_intersection(*arg_ids) if arg_ids else None
+        else:
+            # we assume that arg_ids is not empty
+            pluses = []
+            minuses = []
+            ops = self.conv_intersection(*arg_ids)
+        self.dic_vol_t4[p_id] = VolumeT4(pluses=pluses, minuses=minuses,
+                                         ops=ops, idorigin=idorigin)
+        return p_id
 
+    def combine_union(self, p_tree, arg_ids, idorigin, union_ids):
+        '''Create the volume for the union node `p_tree`, given the IDs of
+        the volumes of its arguments. If the union contains a pure
+        intersection of surfaces, its volume comes first in `arg_ids`.'''
         p_id, operator, *args = p_tree
-
-        if operator == '*':
-            surfs = []
-            nodes = []
-            for arg in args:
-                if isLeaf(arg):
-                    surfs.append(arg)
-                else:
-                    nodes.append(arg)
-            # here we know that paramsOPER starts as ['EQUA', 'INTE', ...]
-            # because operator == '*'
-            if surfs:
-                pluses, minuses = self.conv_equa(surfs)
-                if nodes:
-                    arg_ids = [self.pot_convert(node, idorigin, union_ids)
-                               for node in nodes]
-                    ops = self.conv_intersection(*arg_ids)
-                else:
-                    ops = None
-            else:
-                # we assume that nodes is not empty
-                arg_ids = [self.pot_convert(node, idorigin, union_ids)
-                           for node in nodes]
-                pluses = []
-                minuses = []
-                ops = self.conv_intersection(*arg_ids)
-            self.dic_vol_t4[p_id] = VolumeT4(pluses=pluses, minuses=minuses,
-                                             ops=ops, idorigin=idorigin)
-            return p_id
-
-        # here operator == ':'
         if operator != ':':
             raise CellConversionError('Converting cell with unexpected '
                                       'operator: {}'.format(operator))
-        largest = largestPureIntersectionNode(args)
-        if largest is None:
-            arg_ids = [self.pot_convert(arg, idorigin, union_ids)
-                       for arg in args]
+        if largestPureIntersectionNode(args) is None:
             pluses, minuses, ops = self.conv_union_helpers(*arg_ids,
                                                            union_ids=union_ids)
         else:
-            main = args.pop(largest)
-            main_id = self.pot_convert(main, idorigin, union_ids)
+            main_id, *arg_ids = arg_ids
             pluses = self.dic_vol_t4[main_id].pluses
             minuses = self.dic_vol_t4[main_id].minuses
-            arg_ids = [self.pot_convert(arg, idorigin, union_ids)
-                       for arg in args]
             ops = self.conv_union(*arg_ids)
             del self.dic_vol_t4[main_id]
         self.dic_vol_t4[p_id] = VolumeT4(pluses=pluses, minuses=minuses,
                                          ops=ops, idorigin=idorigin)
         return p_id
 
+    def convert_cell(self, key, geometry, idorigin, matching, union_ids):
+        '''Convert the AST of an MCNP cell into TRIPOLI-4 volumes.
+
+        The conversion is performed by :meth:`convert_tree`, in a single pass
+        over the AST. The resulting volumes are stored in
+        ``self.dic_vol_t4``.
+
+        :param key: the ID of the MCNP cell (only used for error reporting)
+        :param geometry: the AST of the cell
+        :param idorigin: the origin of the cell, for comments
+        :param matching: the MCNP-to-TRIPOLI-4 surface ID matching
+        :param union_ids: the IDs of the auxiliary surfaces for unions
+        :returns: the ID of the root volume, or `None` if the cell is empty
+        '''
+        try:
+            return self.convert_tree(geometry, idorigin, matching, union_ids)
+        except CellConversionError as err:
+            raise CellConversionError('{} (while converting cell {})'
+                                      .format(err, key)) from None
+
+    def convert_cell_multipass(self, key, geometry, idorigin, matching,
+                               union_ids):
+        '''Convert the AST of an MCNP cell into TRIPOLI-4 volumes, like
+        :meth:`convert_cell`, by chaining the :meth:`pot_flag`,
+        :meth:`pot_replace`, :meth:`pot_optimise` and :meth:`pot_convert`
+        passes.
+
+        This is the reference implementation of :meth:`convert_tree`; it
+        builds three intermediate trees, and it cannot handle empty
+        intersections below the root of the AST.
+        '''
+        tup = self.pot_flag(geometry)
+        try:
+            replace = self.pot_replace(tup, matching)
+        except CellConversionError as err:
+            raise CellConversionError('{} (while converting cell {})'
+                                      .format(err, key)) from None
+        opt_tree = self.pot_optimise(replace)
+        if opt_tree is None:
+            # the cell is empty, do not emit a converted cell
+            return None
+        return self.pot_convert(opt_tree, idorigin, union_ids)
+
+    def convert_tree(self, p_tree, idorigin, matching, union_ids):
+        '''Convert the AST `p_tree` into TRIPOLI-4 volumes, in a single
+        post-order traversal.
+
+        The volumes, their keys and their order in ``self.dic_vol_t4`` are
+        the same as with :meth:`convert_cell_multipass`, but no intermediate
+        tree is built: the surfaces are replaced when the leaves are visited,
+        the nodes are merged into their parent when they have the same
+        operator, and the volume of a node is recorded as soon as all its
+        operands are known. The keys of some volumes depend on the total
+        number of nodes, so the volumes are only stored at the end of the
+        traversal.
+
+        An empty intersection (containing a surface with both signs) makes
+        the enclosing intersection empty and is dropped from the enclosing
+        union.
+
+        :returns: the ID of the root volume, or `None` if the cell is empty
+        '''
+        base_key = self.new_cell_key
+        events = []
+        # the number of events and the placeholder for the main operand at
+        # the entry of the nodes that are being visited
+        entered = []
+        n_nodes = 0
+        n_replaced = 0
+
+        def leaf(surf, parent_op):
+            # the operands of an intersection are part of its EQUA; all the
+            # other surfaces become volumes
+            if parent_op == '*':
+                return _Operand(_LEAF, surf=surf)
+            event = _VolumeEvent(_LEAF, pluses=surf)
+            events.append(event)
+            return _Operand(_LEAF, surf=surf, event=event)
+
+        def children(item):
+            node, parent_op = item
+            if isLeaf(node):
+                return ()
+            operator = node[0]
+            if operator not in ('*', ':'):
+                raise CellConversionError('Converting cell with unexpected '
+                                          'operator: {}'.format(operator))
+            mark = len(events)
+            main_alloc = None
+            if operator == ':' and parent_op != ':':
+                # placeholder for the key of the main operand of the union,
+                # which is allocated before all the keys below the union
+                main_alloc = _VolumeEvent(_DEAD)
+                events.append(main_alloc)
+            entered.append((mark, main_alloc))
+            return [(arg, operator) for arg in node[1:]]
+
+        def combine_leaf(node, parent_op):
+            nonlocal n_replaced
+            t4_surf = self.t4_leaf(node, matching)
+            if not isinstance(t4_surf, tuple):
+                return leaf(t4_surf, parent_op)
+            n_replaced += 1
+            operator, surfs = t4_surf
+            if operator == parent_op:
+                return _Operand(_MERGED, operands=[leaf(surf, operator)
+                                                   for surf in surfs])
+            if operator == '*':
+                pluses, minuses = self.conv_equa(surfs)
+                event = _VolumeEvent(_NODE, pluses, minuses,
+                                     index=n_replaced)
+                events.append(event)
+                return _Operand(_NODE, event=event, pure=True,
+                                size=len(surfs) + 2)
+            # the first surface of the union is its main operand
+            events.append(_VolumeEvent(_ALLOC))
+            others = [leaf(surf, operator).event for surf in surfs[1:]]
+            pluses, minuses = self.conv_equa(surfs[:1])
+            event = _VolumeEvent(_NODE, pluses, minuses,
+                                 self.conv_union(*others), index=n_replaced)
+            events.append(event)
+            return _Operand(_NODE, event=event, size=len(surfs) + 2)
+
+        def combine(item, results):
+            nonlocal n_nodes
+            node, parent_op = item
+            if isLeaf(node):
+                return combine_leaf(node, parent_op)
+            mark, main_alloc = entered.pop()
+            n_nodes += 1
+            key = base_key + n_nodes
+            operator = node[0]
+            args = []
+            for result in results:
+                if result is None:
+                    if operator == '*':
+                        del events[mark:]
+                        return None
+                elif result.kind is _MERGED:
+                    args.extend(result.operands)
+                else:
+                    args.append(result)
+            if operator == '*':
+                return self.combine_fused_intersection(
+                    key, args, parent_op, mark, events)
+            return self.combine_fused_union(
+                key, args, parent_op, mark, main_alloc, events, union_ids)
+
+        root = fold_tree((p_tree, None), children, combine)
+        # the keys are allocated in the same order as in the multi-pass
+        # conversion: first the nodes of the AST, then the replaced surface
+        # collections, then the leaf volumes
+        next_key = base_key + n_nodes + n_replaced
+        if root is None:
+            self.new_cell_key = next_key
+            return None
+
+        for event in events:
+            kind = event.kind
+            if kind is _DEAD:
+                continue
+            if kind is _NODE:
+                if event.key is None:
+                    event.key = base_key + n_nodes + event.index
+                pluses, minuses = event.pluses, event.minuses
+            else:
+                next_key += 1
+                if kind is _ALLOC:
+                    continue
+                event.key = next_key
+                surf = event.pluses
+                pluses, minuses = ([surf], []) if surf > 0 else ([], [-surf])
+            ops = event.ops
+            if ops is not None:
+                ops = (ops[0], tuple(arg.key for arg in ops[1]))
+            self.dic_vol_t4[event.key] = VolumeT4(
+                pluses=pluses, minuses=minuses, ops=ops, idorigin=idorigin)
+        self.new_cell_key = next_key
+        return root.event.key
+
+    def combine_fused_intersection(self, key, args, parent_op, mark, events):
+        '''Record the volume of an intersection for :meth:`convert_tree`.
+
+        :param key: the key of the volume
+        :param args: the results of the operands of the intersection
+        :param parent_op: the operator of the parent node
+        :param mark: the number of events before the intersection
+        :param events: the list of the volume events
+        '''
+        surfs = [arg.surf for arg in args if arg.kind is _LEAF]
+        pluses = {surf for surf in surfs if surf > 0}
+        minuses = {-surf for surf in surfs if surf < 0}
+        if pluses & minuses:
+            # the intersection is empty; TRIPOLI-4 does not like surfaces to
+            # appear with both signs in the same volume anyway
+            del events[mark:]
+            return None
+        if parent_op == '*':
+            return _Operand(_MERGED, operands=args)
+        nodes = [arg.event for arg in args if arg.kind is _NODE]
+        ops = self.conv_intersection(*nodes) if nodes else None
+        pluses, minuses = self.conv_equa(surfs)
+        event = _VolumeEvent(_NODE, pluses, minuses, ops, key=key)
+        events.append(event)
+        return _Operand(_NODE, event=event, pure=not nodes,
+                        size=len(args) + 2)
+
+    def combine_fused_union(self, key, args, parent_op, mark, main_alloc,
+                            events, union_ids):
+        '''Record the volume of a union for :meth:`convert_tree`.
+
+        The parameters are the same as for
+        :meth:`combine_fused_intersection`, plus the placeholder event for the
+        key of the main operand (`main_alloc`) and the IDs of the auxiliary
+        surfaces for unions.
+        '''
+        if not args:
+            del events[mark:]
+            return None
+        if parent_op == ':':
+            return _Operand(_MERGED, operands=args)
+        if len(args) == 1:
+            # the other operands were empty
+            only = args[0]
+            if only.kind is _LEAF and parent_op == '*':
+                # the surface joins the EQUA of the enclosing intersection
+                only.event.kind = _DEAD
+                return _Operand(_LEAF, surf=only.surf)
+            return only
+
+        # same choice as largestPureIntersectionNode
+        main = None
+        largest_len = 0
+        for index, arg in enumerate(args):
+            if arg.kind is _LEAF:
+                if largest_len < 1:
+                    largest_len = 1
+                    main = index
+            elif arg.pure and arg.size > largest_len:
+                largest_len = arg.size
+                main = index
+
+        if main is None:
+            pluses, minuses, ops = self.conv_union_helpers(
+                *(arg.event for arg in args), union_ids=union_ids)
+        else:
+            # the EQUA of the main operand becomes the EQUA of the union
+            main_arg = args.pop(main)
+            main_arg.event.kind = _DEAD
+            if main_arg.kind is _LEAF:
+                main_alloc.kind = _ALLOC
+                pluses, minuses = self.conv_equa([main_arg.surf])
+            else:
+                pluses = main_arg.event.pluses
+                minuses = main_arg.event.minuses
+            ops = self.conv_union(*(arg.event for arg in args))
+        event = _VolumeEvent(_NODE, pluses, minuses, ops, key=key)
+        events.append(event)
+        return _Operand(_NODE, event=event, size=len(args) + 2)
+
     def pot_optimise(self, p_tree):
         '''
         :brief: method which permit to optimize the course of the cells MCNP
         '''
+        return fold_tree(p_tree, _flagged_operands, self.optimise_node)
 
+    @staticmethod
+    def optimise_node(p_tree, new_args):
+        '''Flatten the node `p_tree`, given its optimised arguments.'''
         if isLeaf(p_tree):
             return p_tree
 
-        p_id, operator, *args = p_tree
-        new_args = [self.pot_optimise(node) for node in args]
+        p_id, operator = p_tree[:2]
         new_node = [p_id, operator]
         for node in new_args:
             if isIntersection(node) and operator == '*':
@@ -269,13 +571,32 @@ class CellConversion:
         intersection/union of the collection (necessary for one-nappe cones and
         macrobodies). Also replace MCNP surface IDs with T4 surface IDs.
         '''
-        if not isLeaf(p_tree):
-            p_id, operator, *args = p_tree
-            new_tree = [p_id, operator]
-            new_tree.extend(self.pot_replace(node, matching)
-                            for node in args)
+        def combine(node, new_args):
+            if isLeaf(node):
+                return self.replace_leaf(node, matching)
+            new_tree = node[:2]
+            new_tree.extend(new_args)
             return new_tree
 
+        return fold_tree(p_tree, _flagged_operands, combine)
+
+    def replace_leaf(self, p_tree, matching):
+        '''Replace the MCNP surface `p_tree` with the corresponding TRIPOLI-4
+        surface(s).'''
+        t4_surf = self.t4_leaf(p_tree, matching)
+        if not isinstance(t4_surf, tuple):
+            return t4_surf
+        operator, surfs = t4_surf
+        self.new_cell_key += 1
+        new_node = [self.new_cell_key, operator]
+        new_node.extend(surfs)
+        return GeomExpression(new_node)
+
+    @staticmethod
+    def t4_leaf(p_tree, matching):
+        '''Return the signed TRIPOLI-4 surface ID corresponding to the MCNP
+        surface `p_tree`, or an ``(operator, IDs)`` pair if the MCNP surface
+        is a collection of TRIPOLI-4 surfaces.'''
         assert isinstance(p_tree, Surface)
         t4_ids = matching[abs(p_tree.surface)]
 
@@ -292,28 +613,86 @@ class CellConversion:
             surf = t4_ids[0]
             return surf if p_tree.surface > 0 else -surf
 
-        self.new_cell_key += 1
         if p_tree.surface < 0:
-            new_node = [self.new_cell_key, '*']
-            new_node.extend(-surf for surf in t4_ids)
-        else:
-            new_node = [self.new_cell_key, ':']
-            new_node.extend(surf for surf in t4_ids)
-        return GeomExpression(new_node)
+            return '*', [-surf for surf in t4_ids]
+        return ':', list(t4_ids)
 
     def pot_complement(self, tree):
-        if not isinstance(tree, (list, tuple)):
-            return tree
-        if tree[0] == '^':
-            assert all(isinstance(k, int) for k in self.dic_cell_mcnp)
-            cell = self.dic_cell_mcnp[int(tree[1])]
-            new_geom = self.pot_complement(cell.geometry)
-            return new_geom.inverse()
-        new_tree = [tree[0]]
-        for node in tree[1:]:
-            new_tree.append(self.pot_complement(node))
-        result = GeomExpression(new_tree)
-        return result
+        '''Replace the complements of cells (``#n``) in `tree` with the
+        inverse of the geometry of the complemented cells.
+
+        The expanded geometry of each complemented cell and its inverse are
+        cached in ``self.complements``, so that every cell is expanded and
+        inverted at most once, however many times it is complemented. The
+        cached geometries are shared by all the trees that refer to them, and
+        they are never traversed again (see :meth:`invert_geometry`): the
+        cost of the expansion is linear in the size of the input, even for
+        long chains of complements.
+        '''
+        cached = self.cached_inverses
+        # the cells whose complement is being expanded (as an ordered set)
+        expanding = {}
+
+        def children(node):
+            if not isinstance(node, (list, tuple)) or id(node) in cached:
+                return ()
+            if node[0] != '^':
+                return node[1:]
+            key = int(node[1])
+            if key in self.complements:
+                return ()
+            if key in expanding:
+                cycle = list(expanding) + [key]
+                raise CellConversionError('circular cell complements: {}'
+                                          .format(' -> '.join(map(str,
+                                                                  cycle))))
+            expanding[key] = None
+            return (self.dic_cell_mcnp[key].geometry,)
+
+        def combine(node, new_args):
+            if not isinstance(node, (list, tuple)) or id(node) in cached:
+                return node
+            if node[0] != '^':
+                return GeomExpression.join(node[0], new_args)
+            key = int(node[1])
+            if key not in self.complements:
+                expanding.popitem()
+                self.cache_complement(key, new_args[0])
+            return self.complements[key][1]
+
+        return fold_tree(tree, children, combine)
+
+    def cache_complement(self, key, geometry):
+        '''Store the expanded `geometry` of cell `key` and its inverse in the
+        complement cache.'''
+        inverse = self.invert_geometry(geometry)
+        self.complements[key] = (geometry, inverse)
+        # the cache keeps both objects alive, so their ids stay valid
+        self.cached_inverses[id(geometry)] = inverse
+        self.cached_inverses[id(inverse)] = geometry
+
+    def invert_geometry(self, geometry):
+        '''Return the inverse of the expanded `geometry`.
+
+        The subtrees that are cached geometries are replaced with their
+        cached inverses without being traversed.
+        '''
+        cached = self.cached_inverses
+
+        def children(node):
+            if not isinstance(node, (list, tuple)) or id(node) in cached:
+                return ()
+            return node[1:]
+
+        def combine(node, new_args):
+            inverse = cached.get(id(node))
+            if inverse is not None:
+                return inverse
+            if not isinstance(node, (list, tuple)):
+                return node.inverse()
+            return GeomExpression.join(FLIP[node[0]], new_args)
+
+        return fold_tree(geometry, children, combine)
 
     def extract_surfaces(self, cell):
         surf_ids = extract_surfaces_list(cell.geometry)
@@ -356,13 +735,27 @@ class CellConversion:
                                    range_[1]))
                     raise LatticeError(msg)
 
-        for index, universe in domain.items():
-            if universe == 0:
-                continue
-            transl = latticeVector(lat_base_vectors, index)
-            trnsf = list(transl) + [1., 0., 0., 0., 1., 0., 0., 0., 1.]
+        # compute the displacement vectors of all the elements at once
+        universes = [universe for universe in domain if universe != 0]
+        indices = np.array([index for index, universe in domain.items()
+                            if universe != 0], dtype=int).reshape(
+                                len(universes), len(domain.bounds))
+        vectors = lattice_vectors(lat_base_vectors, indices)
+
+        # skip the elements that do not overlap with the cells that the
+        # lattice fills, before creating any surface for them
+        envelope = self.universe_envelope(cell.universe, key)
+        if envelope is not None:
+            base_box = cell_bbox(mcnp_element_geom, self.dic_surf_mcnp)
+            keep = base_box.overlaps_translated(vectors, envelope)
+            self.skipped_lattice_elements += len(universes) - int(keep.sum())
+            universes = [universe for universe, kept in zip(universes, keep)
+                         if kept]
+            vectors = vectors[keep]
+
+        trees = self.translate_geometry(mcnp_element_geom, vectors)
+        for universe, trnsf, tree in zip(universes, vectors.tolist(), trees):
             new_cell = cell.copy()
-            tree = self.pot_transform(mcnp_element_geom, trnsf)
             new_cell.geometry = tree
             if universe == cell.universe:
                 new_cell.fillid = None
@@ -386,6 +779,100 @@ class CellConversion:
             self.dic_cell_mcnp[self.new_cell_key] = new_cell
         del self.dic_cell_mcnp[key]
 
+    def translate_geometry(self, p_tree, vectors):
+        '''Translate the AST `p_tree` by each of the displacement `vectors`
+        (an array of shape ``(n, 3)``) and return the list of the `n`
+        translated ASTs.
+
+        The result is the same as calling :meth:`pot_transform` with each
+        translation, but the frames of the surfaces are translated for all
+        the vectors at once (see :func:`~.translate_surface`).
+        '''
+        leaves = {}
+        # postfix program that builds the translated tree from the
+        # dictionary of the new surface keys
+        program = []
+
+        def children(node):
+            if isLeaf(node) or node[0] == '^':
+                return ()
+            return node[1:]
+
+        def compile_node(node, _):
+            if isLeaf(node):
+                lkey = leaf_key(node)
+                leaves.setdefault(lkey, node)
+                program.append(('S', (lkey, node >= 0)))
+            elif node[0] == '^':
+                program.append(('^', node))
+            else:
+                program.append((node[0], len(node) - 1))
+
+        def build_tree(new_keys):
+            stack = []
+            for operator, arg in program:
+                if operator == 'S':
+                    lkey, positive = arg
+                    new_key = new_keys[lkey]
+                    stack.append(Surface(new_key if positive else -new_key))
+                elif operator == '^':
+                    stack.append(arg)
+                else:
+                    start = len(stack) - arg
+                    new_node = (operator,) + tuple(stack[start:])
+                    del stack[start:]
+                    stack.append(new_node)
+            return stack[0]
+
+        fold_tree(p_tree, children, compile_node)
+        translated = [(leaf, lkey,
+                       [(translate_surface(surf, vectors), side)
+                        for surf, side in self.dic_surf_mcnp[abs(leaf)]])
+                      for lkey, leaf in leaves.items()]
+
+        trees = []
+        for i, vec in enumerate(vectors.tolist()):
+            transf = tuple(translation(vec))
+            new_keys = {}
+            for leaf, lkey, parts in translated:
+                memo_key = lkey + (transf,)
+                new_key = self.transformed_surfs.get(memo_key)
+                if new_key is None:
+                    new_key = self.new_surface(
+                        leaf, [(surfs[i], side) for surfs, side in parts])
+                    self.transformed_surfs[memo_key] = new_key
+                    self.derived_surfs[new_key] = (leaf, None)
+                new_keys[lkey] = new_key
+            trees.append(build_tree(new_keys))
+        return trees
+
+    def universe_envelope(self, universe, lattice_key):
+        '''Return a bounding box for the union of the cells that are filled
+        with `universe`, in the coordinate system of `universe`.
+
+        Return `None` if `universe` is not used or if it is used as an element
+        of a lattice (other than `lattice_key`) that has not been developed
+        yet.
+        '''
+        envelope = BoundingBox.empty()
+        found = False
+        for key, cell in self.dic_cell_mcnp.items():
+            fillid = cell.fillid
+            if fillid is None or key == lattice_key:
+                continue
+            if isinstance(fillid, LatticeSpec):
+                if cell.universe != universe and universe in fillid:
+                    return None
+                continue
+            if int(fillid) != universe:
+                continue
+            found = True
+            box = cell_bbox(cell.geometry, self.dic_surf_mcnp)
+            for trcl in reversed(cell.trcl or ()):
+                box = box.inverse_transformed(trcl)
+            envelope |= box.inverse_transformed(cell.filltr)
+        return envelope if found else None
+
     def apply_trcl(self, trcls, geometry):
         '''Apply the given coordinate transformation to the given cell AST
         (`geometry`).
@@ -397,3 +884,108 @@ class CellConversion:
         for trcl in trcls:
             geometry = self.pot_transform(geometry, trcl)
         return geometry
+
+
+# kinds of the events and of the results of :meth:`CellConversion.convert_tree`
+_LEAF = 'leaf'
+_NODE = 'node'
+_ALLOC = 'alloc'
+_DEAD = 'dead'
+_MERGED = 'merged'
+
+
+class _VolumeEvent:
+    '''A volume recorded by :meth:`CellConversion.convert_tree`.
+
+    The kind of the event is `_LEAF` for the volume of a single surface
+    (stored in `pluses`, with its sign), `_NODE` for the volume of a node,
+    `_ALLOC` for a key that is allocated but not used and `_DEAD` for a
+    volume that is not emitted after all.
+
+    The kind of an event only changes in
+    :meth:`CellConversion.combine_fused_union`, when the operands of a union
+    are known:
+
+    * the `_LEAF` or `_NODE` event of the main operand of a union becomes
+      `_DEAD`, because its surfaces go into the EQUA of the union (the
+      multi-pass conversion deletes its volume in :meth:`combine_union`);
+    * if that main operand is a `_LEAF`, the placeholder recorded when the
+      union was entered changes from `_DEAD` to `_ALLOC`, because the
+      multi-pass conversion allocates a key for it before the keys of the
+      other operands;
+    * the `_LEAF` event of the only non-empty operand of a union inside an
+      intersection becomes `_DEAD`, because the surface goes into the EQUA of
+      the intersection.
+    '''
+
+    __slots__ = ('kind', 'pluses', 'minuses', 'ops', 'key', 'index')
+
+    def __init__(self, kind, pluses=(), minuses=(), ops=None, key=None,
+                 index=None):
+        self.kind = kind
+        self.pluses = pluses
+        self.minuses = minuses
+        # the operands in ops are events, not keys
+        self.ops = ops
+        # key is None for leaves and replaced surface collections, whose keys
+        # are known at the end of the traversal; index is the rank of a
+        # replaced surface collection
+        self.key = key
+        self.index = index
+
+
+class _Operand:
+    '''The result of the conversion of an operand by
+    :meth:`CellConversion.convert_tree`.
+
+    * `_LEAF`: a surface `surf` (with its sign); `event` is its `_LEAF`
+      volume event, or `None` if the surface is part of the EQUA of the
+      enclosing intersection;
+    * `_NODE`: a node whose volume is the `_NODE` event `event`; `pure` is
+      true if the node is an intersection of surfaces only, and `size` is
+      the size used to choose the main operand of the unions (see
+      :func:`~.largestPureIntersectionNode`);
+    * `_MERGED`: a node with the same operator as its parent, whose
+      `operands` are merged into the operands of the parent.
+    '''
+
+    __slots__ = ('kind', 'surf', 'event', 'pure', 'size', 'operands')
+
+    def __init__(self, kind, surf=None, event=None, pure=False, size=0,
+                 operands=()):
+        self.kind = kind
+        self.surf = surf
+        self.event = event
+        self.pure = pure
+        self.size = size
+        self.operands = operands
+
+
+def _operands(p_tree):
+    '''Return the operands of an AST node, or an empty tuple for leaves.'''
+    return () if isLeaf(p_tree) else p_tree[1:]
+
+
+def _flagged_operands(p_tree):
+    '''Return the operands of a node flagged by :meth:`pot_flag`, or an empty
+    tuple for leaves.'''
+    return () if isLeaf(p_tree) else p_tree[2:]
+
+
+def convert_new_surface(p_tree, mcnp_surfs):
+    '''Convert the MCNP surfaces `mcnp_surfs` (the parts of the transformed
+    surface `p_tree`) into a TRIPOLI-4 surface collection; the additional
+    TRIPOLI-4 surfaces are marked as auxiliary.'''
+    surf_colls = [(conversion_surface_params(p_tree, mcnp_surf), side)
+                  for mcnp_surf, side in mcnp_surfs]
+    surf_coll = SurfaceCollection.join(surf_colls)
+    for surf, _ in surf_coll.surfs[1:]:
+        surf.idorigin = tuple(list(surf.idorigin) + ['aux surf'])
+    return surf_coll
+
+
+def leaf_key(p_tree):
+    '''Return a hashable key identifying the surface (or the facet of a
+    macrobody) of the leaf `p_tree`, regardless of its sign.'''
+    return (abs(getattr(p_tree, 'surface', p_tree)),
+            getattr(p_tree, 'sub', None))
@@ -6,30 +6,205 @@ Created on 6 févr. 2019
 :data : 06 february 2019
 '''
 
+from contextlib import contextmanager
+from multiprocessing import Pool
+
+from MIP.geom.main import extract_surfaces_list
+
 from ..FileHandlers.Parser.ParseMCNPCell import ParseMCNPCell
 from ..Surface.SurfaceT4 import SurfaceT4
 from ..Surface.ESurfaceTypeT4 import ESurfaceTypeT4 as T4S
 from .DictVolumeT4 import DictVolumeT4
+from .VolumeSpill import VolumeSpill
 from .CellConversion import CellConversion
 from .CellConversionError import CellConversionError
 from .ByUniverse import by_universe
+from .PlanePruning import PlanePruner
+from ..Instrumentation import phase, count
 
 
-def construct_volume_t4(mcnp_parser, lattice_params, cell_cache_path,
-                        dic_surface_t4, dic_surface_mcnp):
+def construct_volume_t4(mcnp_parser, lattice_params, cache,
+                        dic_surface_t4, dic_surface_mcnp, jobs=1,
+                        state=None, geometry_parser='fast', simplifier=None,
+                        prune_planes=False, verbose=0, model=None):
     '''A function that orchestrates the conversion steps for TRIPOLI-4
-    volumes.'''
+    volumes.
+
+    If `cache` is not `None`, the parsed MCNP cells are read from the
+    :class:`~.ConversionCache`, if available. If `model` is not `None`, it
+    must be a :class:`~.ModelReader` (the parsed MCNP cells are read from it)
+    or a :class:`~.ModelWriter` (they are recorded into it).
+
+    If `jobs` is larger than 1, the parsing of the cell cards and the final
+    conversion of the cells into TRIPOLI-4 volumes are distributed over pools
+    of `jobs` worker processes. The result is identical to the serial
+    conversion.
+
+    The converted volumes are not accumulated in memory: the volumes of each
+    cell are appended to a :class:`~.VolumeSpill` as soon as the cell has been
+    converted, and the spill is returned in place of a
+    :class:`~.DictVolumeT4`.
+
+    If `state` is not `None`, it must be an :class:`~.IncrementalState`; the
+    numbering of the surfaces, the origin of the transformed surfaces and the
+    key ranges of the converted cells are recorded into it, so that the next
+    run can patch the output (see :func:`~.patch_output`).
+
+    `geometry_parser` selects the parser for the geometry of the cells (see
+    :func:`~.ParseMCNPGeometry.geometry_parser`).
+
+    If `simplifier` is not `None`, it must be a :class:`~.Simplifier`; the
+    geometries of the cells are simplified before their conversion, and the
+    reduction of the number of nodes is reported (for each cell, if
+    `verbose` is positive).
+
+    If `prune_planes` is true, the plane half-spaces that are implied by the
+    other plane half-spaces of the same volume are removed from the converted
+    volumes (see :class:`~.PlanePruner`), and the number of surface tests
+    saved is reported (for each volume, if `verbose` is positive).
+    '''
     dic_vol_t4 = DictVolumeT4()
-    mcnp_dict, skipped_cells = ParseMCNPCell(mcnp_parser, cell_cache_path,
-                                             lattice_params).parse()
 
+    def parse_cells():
+        with phase('parse'):
+            return ParseMCNPCell(mcnp_parser, lattice_params,
+                                 geometry_parser, jobs).parse()
+
+    if model is not None:
+        mcnp_dict, skipped_cells = model.fetch('mcnp_cells', parse_cells)
+    elif cache is None:
+        mcnp_dict, skipped_cells = parse_cells()
+    else:
+        options = {'lattice': sorted(lattice_params.items())}
+        mcnp_dict, skipped_cells = cache.fetch('mcnp_cells', parse_cells,
+                                               options)
+
+    original_keys = set(mcnp_dict)
     free_key = max(int(k) for k in mcnp_dict) + 1
     free_surf_key = max(max(int(k) for k in dic_surface_mcnp) + 1,
                         max(int(k) for k in dic_surface_t4) + 1)
     conv = CellConversion(free_key, free_surf_key, dic_vol_t4,
                           dic_surface_t4, dic_surface_mcnp, mcnp_dict)
 
-    # treat TRCL
+    with phase('trcl'), _counting_created(conv):
+        _apply_trcls(conv, mcnp_dict)
+
+    with phase('complements'), _counting_created(conv):
+        _convert_complements(conv, mcnp_dict)
+
+    # the parameters of the surfaces of the lattices and of the filled cells
+    # determine which lattice elements are developed
+    fill_surfs = (_fill_surfaces(mcnp_dict)
+                  if any(value.lattice for value in mcnp_dict.values())
+                  else set())
+
+    with phase('lattice'), _counting_created(conv):
+        _develop_lattices(conv, mcnp_dict)
+
+    # update volume and surface free keys
+    conv.new_cell_key = max(int(k) for k in mcnp_dict) + 1
+    conv.new_surf_key = max(max(int(k) for k in dic_surface_mcnp) + 1,
+                            max(int(k) for k in dic_surface_t4) + 1)
+
+    with phase('fill'), _counting_created(conv):
+        _develop_fills(conv, mcnp_dict)
+
+    # update volume and surface free keys
+    conv.new_cell_key = max(int(k) for k in mcnp_dict) + 1
+    conv.new_surf_key = max(max(int(k) for k in dic_surface_mcnp) + 1,
+                            max(int(k) for k in dic_surface_t4) + 1)
+
+    conv_keys = [(key, value) for key, value in mcnp_dict.items()
+                 if value.importance != 0 and value.universe == 0
+                 and value.fillid is None]
+    n_conv_keys = len(conv_keys)
+
+    if simplifier is not None:
+        with phase('simplify'):
+            _simplify_cells(simplifier, conv_keys, verbose)
+
+    fmt_string = ('\rconverting cell {{:{0}d}} ({{:{1}d}}/{{:{1}d}}, {{:3d}}%)'
+                  .format(len(str(max(key for key, _ in conv_keys))),
+                          len(str(n_conv_keys))))
+
+    t4_surf_numbering, matching = dic_surface_t4.number_items()
+    # insert union planes into the T4 surface dictionary
+    free_surf_id = max(int(k) for k in t4_surf_numbering) + 1
+    union_ids = free_surf_id + 1, free_surf_id + 2
+    t4_surf_numbering.update(union_planes(union_ids))
+    pruner = PlanePruner(t4_surf_numbering) if prune_planes else None
+    if state is not None:
+        state.record_surfaces(dic_surface_mcnp, matching, union_ids,
+                              conv.derived_surfs, fill_surfs)
+
+    if jobs > 1:
+        converted = _convert_cells_parallel(conv, conv_keys, matching,
+                                            union_ids, jobs)
+    else:
+        converted = _convert_cells_serial(conv, conv_keys, matching,
+                                          union_ids)
+
+    # the cells are actually converted while `converted` is consumed
+    with phase('cells'):
+        spill = VolumeSpill()
+        first_key = conv.new_cell_key
+        for i, (key, j) in enumerate(converted):
+            percent = int(100.0*i/(n_conv_keys-1)) if n_conv_keys > 1 else 100
+            print(fmt_string.format(key, i+1, n_conv_keys, percent),
+                  end='', flush=True)
+            if j is not None:
+                dic_vol_t4[j].fictive = False
+                if j != key:
+                    dic_vol_t4.replace_key(j, key)
+            if pruner is not None:
+                with phase('prune'):
+                    pruner.prune(dic_vol_t4)
+            if state is not None and key in original_keys:
+                state.record_cell(key, mcnp_dict[key], first_key,
+                                  conv.new_cell_key)
+            first_key = conv.new_cell_key
+            # the volumes of this cell are final, move them to disk
+            count('volumes', len(dic_vol_t4))
+            spill.append(key, dic_vol_t4)
+            dic_vol_t4.clear()
+        spill.flush()
+        print('... done', flush=True)
+        count('cells', n_conv_keys)
+
+    if pruner is not None:
+        _report_pruning(pruner, verbose)
+
+    return spill, mcnp_dict, t4_surf_numbering, skipped_cells
+
+
+def union_planes(union_ids):
+    '''Return a dictionary associating the IDs of the auxiliary surfaces for
+    unions to the surfaces themselves.'''
+    return {union_ids[0]: SurfaceT4(T4S.PLANEX, [1],
+                                    ['aux plane for unions']),
+            union_ids[1]: SurfaceT4(T4S.PLANEX, [-1],
+                                    ['aux plane for unions'])}
+
+
+def _fill_surfaces(mcnp_dict):
+    '''Return the set of the IDs of the surfaces used by the lattices and by
+    the filled cells.'''
+    return {abs(getattr(surf, 'surface', surf))
+            for value in mcnp_dict.values() if value.fillid is not None
+            for surf in extract_surfaces_list(value.geometry)}
+
+
+@contextmanager
+def _counting_created(conv):
+    '''Count the MCNP cells and the surfaces created within the block.'''
+    n_cells, n_surfs = len(conv.dic_cell_mcnp), len(conv.dic_surf_t4)
+    yield
+    count('cells_created', len(conv.dic_cell_mcnp) - n_cells)
+    count('surfaces_created', len(conv.dic_surf_t4) - n_surfs)
+
+
+def _apply_trcls(conv, mcnp_dict):
+    '''Apply the TRCL transformations to the geometry of the cells.'''
     trcl_keys = [key for key, value in mcnp_dict.items()
                  if value.trcl is not None]
     if trcl_keys:
@@ -47,7 +222,10 @@ def construct_volume_t4(mcnp_parser, lattice_params, cell_cache_path,
             mcnp_dict[key] = cell
         print('... done', flush=True)
 
-    # treat complements
+
+def _convert_complements(conv, mcnp_dict):
+    '''Replace the cell complements with the equivalent geometries.'''
+    assert all(isinstance(k, int) for k in mcnp_dict)
     n_compl = len(mcnp_dict)
     fmt_string = ('\rconverting complement for cell {{:{0}d}} '
                   '({{:{1}d}}/{{:{1}d}}, {{:3d}}%)'
@@ -60,7 +238,45 @@ def construct_volume_t4(mcnp_parser, lattice_params, cell_cache_path,
         mcnp_dict[key].geometry = new_geom
     print('... done', flush=True)
 
-    # treat LAT
+
+def _simplify_cells(simplifier, conv_keys, verbose):
+    '''Simplify the geometries of the cells that will be converted.'''
+    for key, cell in conv_keys:
+        cell.geometry = simplifier.simplify(cell.geometry, key)
+    before = after = 0
+    for key, (n_before, n_after) in simplifier.report.items():
+        before += n_before
+        after += n_after
+        if verbose and n_after < n_before:
+            print('simplified cell {}: {} -> {} nodes'
+                  .format(key, n_before, n_after))
+    count('simplify_nodes_before', before)
+    count('simplify_nodes_after', after)
+    print('simplified the cell geometries: {} -> {} nodes ({:.1f}% fewer)'
+          .format(before, after, 100. * (before - after) / max(before, 1)))
+
+
+def _report_pruning(pruner, verbose):
+    '''Report the number of surface tests saved by the pruning of the
+    redundant plane half-spaces.'''
+    saved = 0
+    for key, (n_before, n_after) in pruner.report.items():
+        saved += n_before - n_after
+        if verbose:
+            print('pruned volume {}: {} -> {} surfaces'
+                  .format(key, n_before, n_after))
+    n_pruned = len(pruner.report)
+    count('pruned_volumes', n_pruned)
+    count('prune_surface_tests_before', pruner.n_tests)
+    count('prune_surface_tests_after', pruner.n_tests - saved)
+    print('pruned {} redundant plane half-spaces from {}/{} volumes: {} -> {} '
+          'surface tests ({:.2f} saved per pruned volume)'
+          .format(saved, n_pruned, pruner.n_volumes, pruner.n_tests,
+                  pruner.n_tests - saved, saved / max(n_pruned, 1)))
+
+
+def _develop_lattices(conv, mcnp_dict):
+    '''Develop the lattices into their elements.'''
     lat_cells = [key for key, value in mcnp_dict.items() if value.lattice]
     if lat_cells:
         n_lat_cells = len(lat_cells)
@@ -74,13 +290,14 @@ def construct_volume_t4(mcnp_parser, lattice_params, cell_cache_path,
                   end='', flush=True)
             conv.develop_lattice(key)
         print('... done', flush=True)
+        if conv.skipped_lattice_elements:
+            print('skipped {} lattice elements lying outside their parent '
+                  'cells'.format(conv.skipped_lattice_elements))
+            count('skipped_lattice_elements', conv.skipped_lattice_elements)
 
-    # update volume and surface free keys
-    conv.new_cell_key = max(int(k) for k in mcnp_dict) + 1
-    conv.new_surf_key = max(max(int(k) for k in dic_surface_mcnp) + 1,
-                            max(int(k) for k in dic_surface_t4) + 1)
 
-    # treat FILL
+def _develop_fills(conv, mcnp_dict):
+    '''Develop the filled cells.'''
     dict_universe = by_universe(mcnp_dict)
     fill_keys = [key for key, value in mcnp_dict.items()
                  if value.fillid is not None]
@@ -97,81 +314,98 @@ def construct_volume_t4(mcnp_parser, lattice_params, cell_cache_path,
             conv.pot_fill(key, dict_universe)
         print('... done', flush=True)
 
-    # update volume and surface free keys
-    conv.new_cell_key = max(int(k) for k in mcnp_dict) + 1
-    conv.new_surf_key = max(max(int(k) for k in dic_surface_mcnp) + 1,
-                            max(int(k) for k in dic_surface_t4) + 1)
 
-    conv_keys = [(key, value) for key, value in mcnp_dict.items()
-                 if value.importance != 0 and value.universe == 0
-                 and value.fillid is None]
-    n_conv_keys = len(conv_keys)
-    fmt_string = ('\rconverting cell {{:{0}d}} ({{:{1}d}}/{{:{1}d}}, {{:3d}}%)'
-                  .format(len(str(max(key for key, _ in conv_keys))),
-                          len(str(n_conv_keys))))
+def _convert_cells_serial(conv, conv_keys, matching, union_ids):
+    '''Convert the given cells one after the other, in the current process.
 
-    t4_surf_numbering, matching = dic_surface_t4.number_items()
-    # insert union planes into the T4 surface dictionary
-    free_surf_id = max(int(k) for k in t4_surf_numbering) + 1
-    union_ids = free_surf_id + 1, free_surf_id + 2
-    t4_surf_numbering[union_ids[0]] = SurfaceT4(T4S.PLANEX,
-                                                [1],
-                                                ['aux plane for unions'])
-    t4_surf_numbering[union_ids[1]] = SurfaceT4(T4S.PLANEX,
-                                                [-1],
-                                                ['aux plane for unions'])
-
-    for i, (key, val) in enumerate(conv_keys):
-        percent = int(100.0*i/(n_conv_keys-1)) if n_conv_keys > 1 else 100
-        print(fmt_string.format(key, i+1, n_conv_keys, percent),
-              end='', flush=True)
-        root = val.geometry
-        tup = conv.pot_flag(root)
-        try:
-            replace = conv.pot_replace(tup, matching)
-        except CellConversionError as err:
-            raise CellConversionError('{} (while converting cell {})'
-                                      .format(err, key)) from None
-        opt_tree = conv.pot_optimise(replace)
-        if opt_tree is None:
-            # the cell is empty, do not emit a converted cell
-            continue
-        j = conv.pot_convert(opt_tree, val.idorigin, union_ids)
-        dic_vol_t4[j].fictive = False
-        if j == key:
-            continue
-        dic_vol_t4.replace_key(j, key)
-    print('... done', flush=True)
+    Yield `(key, j)` pairs, where `key` is the MCNP cell ID and `j` is the ID
+    of the root volume in ``conv.dic_vol_t4`` (`None` for empty cells).
+    '''
+    for key, val in conv_keys:
+        j = conv.convert_cell(key, val.geometry, val.idorigin, matching,
+                              union_ids)
+        yield key, j
+
+
+# pylint: disable=invalid-name,global-statement
+_worker_matching = None
+_worker_union_ids = None
+
+
+def _init_worker(matching, union_ids):
+    '''Store the data shared by all the cells in the worker process.'''
+    global _worker_matching, _worker_union_ids
+    _worker_matching = matching
+    _worker_union_ids = union_ids
+
+
+def _convert_cell_relative(item, matching, union_ids):
+    '''Convert one cell in its own key range.
+
+    The volume IDs allocated during the conversion are relative to the
+    beginning of the key range of the cell, i.e. they start at 1.
+
+    :param item: a triple consisting of the cell ID, its geometry and its
+        origin
+    :returns: a triple containing the converted volumes (as a
+        :class:`~.DictVolumeT4` with relative IDs), the relative ID of the
+        root volume (`None` for empty cells) and the number of volume IDs
+        consumed by the conversion.
+    '''
+    key, geometry, idorigin = item
+    conv = CellConversion(0, 0, DictVolumeT4(), None, None, None)
+    j = conv.convert_cell(key, geometry, idorigin, matching, union_ids)
+    return conv.dic_vol_t4, j, conv.new_cell_key
+
+
+def _convert_cell_worker(item):
+    '''Convert one cell in a worker process, see
+    :func:`_convert_cell_relative`.'''
+    return _convert_cell_relative(item, _worker_matching, _worker_union_ids)
+
+
+def _convert_cells_relative(conv_keys, matching, union_ids, jobs):
+    '''Convert the given cells, each in its own key range (see
+    :func:`_convert_cell_relative`), using a pool of `jobs` worker processes
+    if `jobs` is larger than 1. Yield the results in order.'''
+    items = [(key, val.geometry, val.idorigin) for key, val in conv_keys]
+    if jobs <= 1:
+        for item in items:
+            yield _convert_cell_relative(item, matching, union_ids)
+        return
+    chunksize = max(1, len(items) // (4 * jobs))
+    with Pool(jobs, initializer=_init_worker,
+              initargs=(matching, union_ids)) as pool:
+        yield from pool.imap(_convert_cell_worker, items, chunksize)
+
+
+def _merge_relative(conv, volumes, j, consumed):
+    '''Merge the result of :func:`_convert_cell_relative` into
+    ``conv.dic_vol_t4``, shifting the relative IDs to the next free key range.
+
+    :returns: the absolute ID of the root volume, or `None`.
+    '''
+    offset = conv.new_cell_key
+    conv.dic_vol_t4.merge_shifted(volumes, offset)
+    conv.new_cell_key += consumed
+    return None if j is None else j + offset
+
+
+def _convert_cells_parallel(conv, conv_keys, matching, union_ids, jobs):
+    '''Convert the given cells using a pool of `jobs` worker processes.
 
-    return dic_vol_t4, mcnp_dict, t4_surf_numbering, skipped_cells
+    Each cell is converted in its own key range, which starts at 1. The
+    ranges are then laid out one after the other, in the same order as in the
+    serial conversion, so that the merged volumes are numbered exactly as if
+    they had been converted by :func:`_convert_cells_serial`. The volumes are
+    inserted in ``conv.dic_vol_t4`` in the same order, too.
+    '''
+    results = _convert_cells_relative(conv_keys, matching, union_ids, jobs)
+    for (key, _), result in zip(conv_keys, results):
+        yield key, _merge_relative(conv, *result)
 
 
 def remove_empty_cells(dic_volume):
-    '''Remove cells that are patently empty.'''
-    removed = set()
-    to_remove = [key for key, val in dic_volume.items()
-                 if val.empty() and (val.ops is None or val.ops[0] != 'UNION')]
-
-    while to_remove:
-        for key in to_remove:
-            del dic_volume[key]
-        removed |= set(to_remove)
-
-        to_remove = []
-        for key, val in dic_volume.items():
-            if val.ops is None:
-                continue
-            if val.ops[0] == 'INTE' and any(x in removed for x in val.ops[1]):
-                to_remove.append(key)
-            elif val.ops[0] == 'UNION':
-                new_args = tuple(cell for cell in val.ops[1]
-                                 if cell not in removed)
-                if new_args:
-                    val.ops = (val.ops[0], new_args)
-                else:
-                    val.ops = None
-
-
-def extract_used_surfaces(volumes):
-    '''Return the IDs of the surfaces used in the given volumes, as a set.'''
-    return set(surf for volume in volumes for surf in volume.surface_ids())
+    '''Remove cells that are patently empty, see
+    :meth:`.DictVolumeT4.remove_empty`.'''
+    return dic_volume.remove_empty()
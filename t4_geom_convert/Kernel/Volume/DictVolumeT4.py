@@ -7,47 +7,516 @@ Created on 5 févr. 2019
 :file : DictVolumeT4.py
 '''
 
-from collections import OrderedDict
+from array import array
 from collections.abc import MutableMapping
 
+import numpy as np
+
+from .VolumeT4 import BaseVolumeT4, VolumeT4
+
+
+#: The operators that may appear in the `ops` field of a volume; the index in
+#: this tuple is the operator code stored in :class:`DictVolumeT4`.
+OPERATORS = (None, 'UNION', 'INTE')
+
 
 class DictVolumeT4(MutableMapping):
-    '''A simple wrapper around an :class:`OrderedDict` for storing
-    :class:`~.VolumeT4` objects.'''
+    '''An ordered mapping for storing TRIPOLI-4 volumes, with a columnar
+    (array-backed) storage.
+
+    Instead of holding one :class:`~.VolumeT4` object per volume, the mapping
+    stores all volumes in flat integer arrays, in the spirit of the
+    compressed sparse row (CSR) format: each volume is a row, whose surfaces
+    (first the pluses, then the minuses, sorted) and operands are contiguous
+    segments of two shared data arrays. Looking up a key returns a
+    lightweight :class:`VolumeView` on the row, which behaves like a
+    :class:`~.VolumeT4`; assigning a :class:`~.VolumeT4` (or a view) to a key
+    copies it into the arrays.
+
+    Rows are never moved: modifying a volume appends new segments to the data
+    arrays and deleting a volume leaves a tombstone. The insertion order of
+    the keys is the order of the rows, like for an :class:`OrderedDict`.
+
+    >>> vols = DictVolumeT4()
+    >>> vols[3] = VolumeT4(pluses=[2, 1], minuses=[5], idorigin=[(10,)])
+    >>> vols[4] = VolumeT4(pluses=[], minuses=[], ops=('UNION', (3, 1)))
+    >>> vols[3].pluses
+    {1, 2}
+    >>> str(vols[3]), vols[3].comment()
+    ('EQUA PLUS 2 1 2 MINUS 1 5 FICTIVE', ' // (10,)')
+    >>> vols[4].ops = ('INTE', (3,))
+    >>> vols[4].fictive = False
+    >>> str(vols[4])
+    'EQUA INTE 1 3'
+    >>> vols.replace_key(3, 7)
+    >>> list(vols)
+    [4, 7]
+    >>> del vols[4]
+    >>> list(vols.items())
+    [(7, VolumeT4(pluses={1, 2}, minuses={5}, ops=None, idorigin=[(10,)], \
+fictive=True))]
+    '''
 
     def __init__(self):
         '''Constructor'''
-        self.dict_ = OrderedDict()
+        self.clear()
+
+    def clear(self):
+        '''Remove all the volumes.'''
+        # per-row columns
+        self._keys = array('q')
+        self._alive = bytearray()
+        self._fictive = bytearray()
+        self._opcode = bytearray()
+        self._origin = array('i')
+        self._surf_start = array('q')
+        self._n_plus = array('i')
+        self._n_minus = array('i')
+        self._ops_start = array('q')
+        self._n_ops = array('i')
+        # shared data arrays
+        self._surfs = array('q')
+        self._operands = array('q')
+        # interned idorigin lists
+        self._origins = []
+        self._origin_ids = {}
+        self._n_alive = 0
+        # key -> row, built lazily (see _index)
+        self._rows = None
+
+    @property
+    def _index(self):
+        '''The dictionary associating the keys to their rows. It is only built
+        when a key is looked up, so that mappings that are only iterated
+        over (e.g. in the writer) do not pay for it.'''
+        if self._rows is None:
+            keys, alive = self._keys, self._alive
+            self._rows = {keys[row]: row for row in range(len(keys))
+                          if alive[row]}
+        return self._rows
+
+    # --- row storage -----------------------------------------------------
+
+    def _intern_origin(self, idorigin):
+        try:
+            origin_key = tuple(idorigin)
+            hash(origin_key)
+        except TypeError:
+            origin_key = repr(idorigin)
+        origin_id = self._origin_ids.get(origin_key)
+        if origin_id is None:
+            origin_id = len(self._origins)
+            self._origins.append(list(idorigin))
+            self._origin_ids[origin_key] = origin_id
+        return origin_id
+
+    def _write_surfs(self, row, pluses, minuses):
+        pluses = sorted(set(pluses))
+        minuses = sorted(set(minuses))
+        self._surf_start[row] = len(self._surfs)
+        self._n_plus[row] = len(pluses)
+        self._n_minus[row] = len(minuses)
+        self._surfs.extend(pluses)
+        self._surfs.extend(minuses)
+
+    def _write_ops(self, row, ops):
+        if ops is None:
+            self._opcode[row] = 0
+            self._ops_start[row] = len(self._operands)
+            self._n_ops[row] = 0
+            return
+        operator, args = ops
+        self._opcode[row] = OPERATORS.index(operator)
+        self._ops_start[row] = len(self._operands)
+        self._n_ops[row] = len(args)
+        self._operands.extend(args)
+
+    def _new_row(self, key):
+        row = len(self._keys)
+        self._keys.append(key)
+        self._alive.append(1)
+        self._n_alive += 1
+        self._fictive.append(1)
+        self._opcode.append(0)
+        self._origin.append(0)
+        self._surf_start.append(0)
+        self._n_plus.append(0)
+        self._n_minus.append(0)
+        self._ops_start.append(0)
+        self._n_ops.append(0)
+        if self._rows is not None:
+            self._rows[key] = row
+        return row
+
+    def _row_pluses(self, row):
+        start = self._surf_start[row]
+        return set(self._surfs[start:start + self._n_plus[row]])
+
+    def _row_minuses(self, row):
+        start = self._surf_start[row] + self._n_plus[row]
+        return set(self._surfs[start:start + self._n_minus[row]])
+
+    def _row_ops(self, row):
+        opcode = self._opcode[row]
+        if not opcode:
+            return None
+        start = self._ops_start[row]
+        return (OPERATORS[opcode],
+                tuple(self._operands[start:start + self._n_ops[row]]))
+
+    # --- mapping interface -----------------------------------------------
 
     def __getitem__(self, key):
-        return self.dict_[key]
+        return VolumeView(self, self._index[key])
 
     def __setitem__(self, key, value):
-        self.dict_[key] = value
+        row = self._index.get(key)
+        if row is None:
+            row = self._new_row(key)
+        self._write_surfs(row, value.pluses, value.minuses)
+        self._write_ops(row, value.ops)
+        self._origin[row] = self._intern_origin(value.idorigin)
+        self._fictive[row] = bool(value.fictive)
 
     def replace_key(self, key_old, key_new):
-        '''Replace the key of an element with the new key. This method also
-        updates the ``id`` field of the :class:`VolumeT4` object associated to
-        `key_old`.
+        '''Replace the key of an element with the new key. The element is
+        moved to the end of the mapping.
         '''
-        self.dict_[key_old].id = key_new
-        self.dict_[key_new] = self.dict_[key_old]
-        del self.dict_[key_old]
+        old_row = self._index.pop(key_old)
+        row = self._new_row(key_new)
+        for column in (self._fictive, self._opcode, self._origin,
+                       self._surf_start, self._n_plus, self._n_minus,
+                       self._ops_start, self._n_ops):
+            column[row] = column[old_row]
+        self._alive[old_row] = 0
+        self._n_alive -= 1
 
     def __delitem__(self, key):
-        del self.dict_[key]
+        row = self._index.pop(key)
+        self._alive[row] = 0
+        self._n_alive -= 1
 
     def __iter__(self):
-        return iter(self.dict_)
+        keys, alive = self._keys, self._alive
+        return (keys[row] for row in range(len(keys)) if alive[row])
+
+    def items(self):
+        keys, alive = self._keys, self._alive
+        return [(keys[row], VolumeView(self, row))
+                for row in range(len(keys)) if alive[row]]
 
     def __len__(self):
-        return len(self.dict_)
+        return self._n_alive
+
+    def __contains__(self, key):
+        return key in self._index
 
     def __repr__(self):
-        return self.dict_.__repr__()
+        return 'DictVolumeT4({})'.format(
+            ', '.join('{!r}: {!r}'.format(key, volume)
+                      for key, volume in self.items()))
+
+    def __getstate__(self):
+        # the indexes are cheap to rebuild and expensive to pickle
+        state = self.__dict__.copy()
+        state['_rows'] = None
+        del state['_origin_ids']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._origin_ids = {}
+        for origin_id, idorigin in enumerate(self._origins):
+            try:
+                origin_key = tuple(idorigin)
+                hash(origin_key)
+            except TypeError:
+                origin_key = repr(idorigin)
+            self._origin_ids[origin_key] = origin_id
 
     def copy(self):
         '''Return a copy of `self`.'''
         new = DictVolumeT4()
-        new.dict_ = self.dict_.copy()
+        new.merge_shifted(self, 0)
         return new
+
+    # --- bulk operations -------------------------------------------------
+
+    def _live_rows(self):
+        alive = np.frombuffer(self._alive, dtype=np.uint8) \
+            if self._alive else np.zeros(0, dtype=np.uint8)
+        return np.flatnonzero(alive)
+
+    def _column(self, name, rows):
+        column = getattr(self, name)
+        if not column:
+            return np.zeros(0, dtype=np.int64)
+        dtype = getattr(column, 'typecode', np.uint8)
+        return np.frombuffer(column, dtype=dtype)[rows]
+
+    def merge_shifted(self, other, offset):
+        '''Append all the volumes of `other` to `self`, adding `offset` to
+        their keys and to the keys of their operands. The shifted keys must
+        not be present in `self`.'''
+        rows = other._live_rows()
+        if not rows.size:
+            return
+        surf_idx, surf_start, _ = _segments(
+            other._column('_surf_start', rows),
+            other._column('_n_plus', rows) + other._column('_n_minus', rows))
+        ops_idx, ops_start, _ = _segments(other._column('_ops_start', rows),
+                                          other._column('_n_ops', rows))
+        origin_map = np.array([self._intern_origin(idorigin)
+                               for idorigin in other._origins] or [0],
+                              dtype=np.int64)
+        first_row = len(self._keys)
+        new_keys = other._column('_keys', rows) + offset
+        self._keys.extend(new_keys.tolist())
+        self._alive.extend(b'\x01' * rows.size)
+        self._fictive.extend(bytes(other._column('_fictive', rows)))
+        self._opcode.extend(bytes(other._column('_opcode', rows)))
+        self._origin.extend(origin_map[other._column('_origin', rows)]
+                            .tolist())
+        self._surf_start.extend((surf_start + len(self._surfs)).tolist())
+        self._n_plus.extend(other._column('_n_plus', rows).tolist())
+        self._n_minus.extend(other._column('_n_minus', rows).tolist())
+        self._ops_start.extend((ops_start + len(self._operands)).tolist())
+        self._n_ops.extend(other._column('_n_ops', rows).tolist())
+        self._surfs.extend(
+            np.frombuffer(other._surfs, dtype=np.int64)[surf_idx].tolist()
+            if surf_idx.size else [])
+        self._operands.extend(
+            (np.frombuffer(other._operands, dtype=np.int64)[ops_idx]
+             + offset).tolist() if ops_idx.size else [])
+        self._n_alive += rows.size
+        if self._rows is not None:
+            self._rows.update(zip(new_keys.tolist(),
+                                  range(first_row, first_row + rows.size)))
+
+    def used_surfaces(self):
+        '''Return the IDs of the surfaces used in the volumes, as a sorted
+        NumPy array.'''
+        rows = self._live_rows()
+        idx, _, _ = _segments(self._column('_surf_start', rows),
+                              self._column('_n_plus', rows)
+                              + self._column('_n_minus', rows))
+        if not idx.size:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.frombuffer(self._surfs, dtype=np.int64)[idx])
+
+    def renumber_surfaces(self, table):
+        '''Renumber the surfaces of all the volumes.
+
+        :param table: a NumPy array such that ``table[old_id]`` is the new ID
+            of surface `old_id`; see :func:`renumbering_table`. A negative
+            new ID means that the new surface has the opposite orientation,
+            i.e. that the volume must be on its other side.
+        '''
+        rows = self._live_rows()
+        n_plus = self._column('_n_plus', rows)
+        n_minus = self._column('_n_minus', rows)
+        idx, _, owner = _segments(self._column('_surf_start', rows),
+                                  n_plus + n_minus)
+        if not idx.size:
+            return
+        # index right away: an exported buffer cannot be resized
+        old = np.frombuffer(self._surfs, dtype=np.int64)[idx]
+        new = table[old]
+        changed = np.unique(owner[new != old])
+        if not changed.size:
+            return
+        # the renumbering may merge surfaces and change their order: rewrite
+        # the affected rows
+        for row in rows[changed].tolist():
+            pluses, minuses = [], []
+            for surfs, side in ((self._row_pluses(row), 1),
+                                (self._row_minuses(row), -1)):
+                for surf in surfs:
+                    new_surf = int(table[surf]) * side
+                    if new_surf > 0:
+                        pluses.append(new_surf)
+                    else:
+                        minuses.append(-new_surf)
+            self._write_surfs(row, pluses, minuses)
+
+    def _empty_mask(self, rows):
+        '''Return a boolean array telling which of the given rows are
+        patently empty (see :meth:`.VolumeT4.empty`).'''
+        mask = np.zeros(rows.size, dtype=bool)
+        n_plus = self._column('_n_plus', rows)
+        n_minus = self._column('_n_minus', rows)
+        starts = self._column('_surf_start', rows)
+        plus_idx, _, plus_owner = _segments(starts, n_plus)
+        minus_idx, _, minus_owner = _segments(starts + n_plus, n_minus)
+        if not plus_idx.size or not minus_idx.size:
+            return mask
+        surfs = np.frombuffer(self._surfs, dtype=np.int64)
+        stride = int(surfs.max()) + 1
+        plus_code = plus_owner * stride + surfs[plus_idx]
+        minus_code = minus_owner * stride + surfs[minus_idx]
+        mask[np.intersect1d(plus_code, minus_code) // stride] = True
+        return mask
+
+    def remove_empty(self):
+        '''Remove the volumes that are patently empty, and propagate the
+        removal: intersections involving a removed volume are removed, and
+        removed volumes are dropped from unions (a union that loses all its
+        operands keeps only its surfaces).
+
+        :returns: the set of removed keys.
+
+        >>> vols = DictVolumeT4()
+        >>> vols[1] = VolumeT4(pluses=[1], minuses=[1])
+        >>> vols[2] = VolumeT4(pluses=[2], minuses=[])
+        >>> vols[3] = VolumeT4(pluses=[], minuses=[], ops=('INTE', (1, 2)))
+        >>> vols[4] = VolumeT4(pluses=[4], minuses=[], ops=('UNION', (3, 2)))
+        >>> sorted(vols.remove_empty())
+        [1, 3]
+        >>> vols[4].ops
+        ('UNION', (2,))
+        '''
+        rows = self._live_rows()
+        opcode = self._column('_opcode', rows)
+        union, inte = OPERATORS.index('UNION'), OPERATORS.index('INTE')
+        removed = self._empty_mask(rows) & (opcode != union)
+        if not removed.any():
+            return set()
+
+        # resolve the operands into (live) row positions
+        keys = self._column('_keys', rows)
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        ops_idx, _, ops_owner = _segments(self._column('_ops_start', rows),
+                                          self._column('_n_ops', rows))
+        operands = (np.frombuffer(self._operands, dtype=np.int64)[ops_idx]
+                    if ops_idx.size else np.zeros(0, dtype=np.int64))
+        pos = np.searchsorted(sorted_keys, operands).clip(0, keys.size - 1)
+        valid = sorted_keys[pos] == operands
+        operand_pos = order[pos]
+        in_inte = opcode[ops_owner] == inte
+
+        while True:
+            hit = valid & removed[operand_pos]
+            new = np.zeros(rows.size, dtype=bool)
+            new[ops_owner[hit & in_inte]] = True
+            new &= ~removed
+            if not new.any():
+                break
+            removed |= new
+
+        removed_keys = set(keys[removed].tolist())
+        for row in rows[removed].tolist():
+            if self._rows is not None:
+                del self._rows[self._keys[row]]
+            self._alive[row] = 0
+            self._n_alive -= 1
+        hit = valid & removed[operand_pos] & (opcode[ops_owner] == union)
+        for row in rows[np.unique(ops_owner[hit])].tolist():
+            _, args = self._row_ops(row)
+            new_args = tuple(arg for arg in args if arg not in removed_keys)
+            self._write_ops(row, ('UNION', new_args) if new_args else None)
+        return removed_keys
+
+
+def _segments(starts, lengths):
+    '''Expand a list of segments into indices.
+
+    :returns: a triple consisting of the concatenated indices of all the
+        segments, of the start of each segment in the concatenation and of
+        the number of the segment that each index belongs to.
+
+    >>> idx, new_starts, owner = _segments(np.array([5, 0, 9]),
+    ...                                    np.array([2, 0, 3]))
+    >>> idx.tolist(), new_starts.tolist(), owner.tolist()
+    ([5, 6, 9, 10, 11], [0, 2, 2], [0, 0, 2, 2, 2])
+    '''
+    lengths = np.asarray(lengths, dtype=np.int64)
+    starts = np.asarray(starts, dtype=np.int64)
+    new_starts = np.zeros(lengths.size, dtype=np.int64)
+    if lengths.size > 1:
+        np.cumsum(lengths[:-1], out=new_starts[1:])
+    total = int(lengths.sum()) if lengths.size else 0
+    owner = np.repeat(np.arange(lengths.size, dtype=np.int64), lengths)
+    idx = (np.arange(total, dtype=np.int64) - new_starts[owner]
+           + starts[owner])
+    return idx, new_starts, owner
+
+
+def renumbering_table(renumbering):
+    '''Convert a surface renumbering dictionary into a lookup table for
+    :meth:`DictVolumeT4.renumber_surfaces`. The IDs that do not appear in
+    the dictionary are mapped to themselves.
+
+    >>> renumbering_table({1: 1, 2: 1, 4: -3}).tolist()
+    [0, 1, 1, 3, -3]
+    '''
+    if not renumbering:
+        return np.zeros(0, dtype=np.int64)
+    table = np.arange(max(renumbering) + 1, dtype=np.int64)
+    keys = np.fromiter(renumbering.keys(), dtype=np.int64,
+                       count=len(renumbering))
+    values = np.fromiter(renumbering.values(), dtype=np.int64,
+                         count=len(renumbering))
+    table[keys] = values
+    return table
+
+
+class VolumeView(BaseVolumeT4):
+    '''A view on one volume of a :class:`DictVolumeT4`. Reading an attribute
+    builds it from the arrays of the mapping; assigning an attribute writes
+    it back.'''
+
+    __slots__ = ('_store', '_row')
+
+    def __init__(self, store, row):
+        self._store = store
+        self._row = row
+
+    @property
+    def pluses(self):
+        return self._store._row_pluses(self._row)
+
+    @pluses.setter
+    def pluses(self, value):
+        self._store._write_surfs(self._row, value, self.minuses)
+
+    @property
+    def minuses(self):
+        return self._store._row_minuses(self._row)
+
+    @minuses.setter
+    def minuses(self, value):
+        self._store._write_surfs(self._row, self.pluses, value)
+
+    @property
+    def ops(self):
+        return self._store._row_ops(self._row)
+
+    @ops.setter
+    def ops(self, value):
+        self._store._write_ops(self._row, value)
+
+    @property
+    def idorigin(self):
+        return self._store._origins[self._store._origin[self._row]]
+
+    @idorigin.setter
+    def idorigin(self, value):
+        self._store._origin[self._row] = self._store._intern_origin(value)
+
+    @property
+    def fictive(self):
+        return bool(self._store._fictive[self._row])
+
+    @fictive.setter
+    def fictive(self, value):
+        self._store._fictive[self._row] = bool(value)
+
+    def to_volume(self):
+        '''Return a standalone :class:`~.VolumeT4` copy of the volume.'''
+        return VolumeT4(self.pluses, self.minuses, self.ops, self.idorigin,
+                        self.fictive)
+
+    def __reduce__(self):
+        return (VolumeT4, (self.pluses, self.minuses, self.ops,
+                           self.idorigin, self.fictive))
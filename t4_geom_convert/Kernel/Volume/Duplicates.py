@@ -0,0 +1,68 @@
+'''This module contains utilities to share identical fictive volumes.'''
+
+
+class VolumeTable:
+    '''A hash-consing table for TRIPOLI-4 fictive volumes.
+
+    The volumes are presented to :meth:`share` in the order in which they are
+    written, which guarantees that the operands of a volume come before the
+    volume itself. The first occurrence of each fictive volume is kept; the
+    following identical volumes (same surfaces and same operands, in any
+    order, after the replacement of the shared operands) are dropped, and the
+    volumes that refer to them are made to refer to the first occurrence
+    instead.
+
+    >>> from .VolumeT4 import VolumeT4
+    >>> table = VolumeTable()
+    >>> table.share(10, VolumeT4([1], [2]))
+    >>> table.share(11, VolumeT4([1], [2]))
+    10
+    >>> table.share(12, VolumeT4([], [3], ops=('UNION', (11,))))
+    >>> volume = VolumeT4([4], [], ops=('INTE', (10, 11)), fictive=False)
+    >>> table.share(5, volume)
+    >>> volume.ops
+    ('INTE', (10,))
+    >>> table.n_checked, len(table.aliases)
+    (3, 1)
+    >>> table.share(13, VolumeT4([], [], ops=('INTE', (10, 12))))
+    >>> table.share(14, VolumeT4([], [], ops=('INTE', (12, 11))))
+    13
+    '''
+
+    def __init__(self, ids=None, aliases=None):
+        '''Create a table, initially empty or holding the given `ids` and
+        `aliases` of a previous table.'''
+        # (pluses, minuses, ops) -> ID of the first occurrence
+        self.ids = ids if ids is not None else {}
+        # ID of a dropped volume -> ID of the first occurrence
+        self.aliases = aliases if aliases is not None else {}
+        # number of fictive volumes presented to the table
+        self.n_checked = 0
+
+    def share(self, key, volume):
+        '''Replace the shared operands of `volume` (in place) and look it up
+        in the table, if it is fictive.
+
+        :returns: the ID of an identical volume that was presented before, in
+            which case `volume` must be dropped, or `None`.
+        '''
+        ops = volume.ops
+        aliases = self.aliases
+        if ops is not None and aliases:
+            operator, args = ops
+            new_args = tuple(dict.fromkeys(aliases.get(arg, arg)
+                                           for arg in args))
+            if new_args != args:
+                ops = volume.ops = (operator, new_args)
+        if not volume.fictive:
+            return None
+        self.n_checked += 1
+        if ops is not None:
+            ops = (ops[0], tuple(sorted(ops[1])))
+        struct = (tuple(sorted(volume.pluses)), tuple(sorted(volume.minuses)),
+                  ops)
+        first = self.ids.setdefault(struct, key)
+        if first == key:
+            return None
+        aliases[key] = first
+        return first
@@ -1,6 +1,9 @@
 '''Utilities for handling lattices.'''
 
 from functools import reduce
+
+import numpy as np
+
 from ..VectUtils import (vsum, vdiff, rescale, scal, vect, mag2,
                          pointInPlaneIntersection, planeSide,
                          projectPointOnPlane)
@@ -232,14 +235,20 @@ def parse_ranges(intervals):
 class LatticeSpec:
     '''A simple class that holds a list of `n*m*l` integers and provides
     n-dimensional indexing into the list.
+
+    The list may also be a one-dimensional NumPy array, as produced by
+    :func:`~MIP.mip.datacard.expand_data_array` for large lattices; the
+    elements are returned as Python integers in any case.
     '''
     def __init__(self, bounds, spec):
         if not isinstance(bounds, LatticeBounds):
             raise TypeError('Expected a LatticeBounds object for the `bounds` '
                             'argument, got a {}'.format(type(bounds)))
-        if not isinstance(spec, (list, tuple)):
-            raise TypeError('Expected a list or a tuple for the `spec` '
-                            'argument, got a {}'.format(type(spec)))
+        if not isinstance(spec, (list, tuple, np.ndarray)):
+            raise TypeError('Expected a list, a tuple or an array for the '
+                            '`spec` argument, got a {}'.format(type(spec)))
+        if isinstance(spec, np.ndarray) and spec.ndim != 1:
+            raise ValueError('The `spec` array must be one-dimensional')
         if bounds.size() != len(spec):
             raise ValueError('The `spec` argument must have exactly {} '
                              'elements'.format(bounds.size()))
@@ -273,6 +282,13 @@ class LatticeSpec:
         0
         >>> spec[1, 1]
         1
+
+        And with arrays:
+        >>> spec = LatticeSpec(bounds, np.arange(8))
+        >>> spec[4, 1]
+        7
+        >>> 3 in spec, 8 in spec
+        (True, False)
         '''
         if isinstance(arg, tuple):
             if len(arg) != len(self.bounds):
@@ -289,13 +305,25 @@ class LatticeSpec:
         else:
             raise TypeError('LatticeSpec can only be indexed with a tuple or '
                             'an integer')
+        if isinstance(self.spec, np.ndarray):
+            return self.spec[index].item()
         return self.spec[index]
 
+    def _values(self):
+        if isinstance(self.spec, np.ndarray):
+            return self.spec.tolist()
+        return self.spec
+
     def __repr__(self):
-        return 'LatticeSpec({}, {})'.format(self.bounds, self.spec)
+        return 'LatticeSpec({}, {})'.format(self.bounds, self._values())
 
     def __iter__(self):
-        yield from self.spec
+        yield from self._values()
+
+    def __contains__(self, value):
+        if isinstance(self.spec, np.ndarray):
+            return bool((self.spec == value).any())
+        return value in self.spec
 
     def items(self):
         '''Iterate over the lattice indices and the lattice specification, as
@@ -306,7 +334,7 @@ class LatticeSpec:
         >>> list(spec.items())
         [((1, 0), 'a'), ((2, 0), 'b'), ((1, 1), 'c'), ((2, 1), 'd')]
         '''
-        yield from zip(self.bounds.indices(), self.spec)
+        yield from zip(self.bounds.indices(), self._values())
 
 
 def squareLatticeReciprocalVecs(surfaces):
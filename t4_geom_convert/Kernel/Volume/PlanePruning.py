@@ -0,0 +1,399 @@
+'''Module containing a pass that removes redundant plane half-spaces from the
+converted TRIPOLI-4 volumes.
+
+The half-spaces of the ``PLUS`` and ``MINUS`` lists of a volume are
+intersected. A plane half-space is redundant if it contains the intersection
+of the other plane half-spaces of the same volume: removing it does not
+change the volume, and saves one surface evaluation each time TRIPOLI-4
+locates a particle in it. Typical examples are the lattice elements that
+inherit the bounding planes of their parent cell, or the facets of boxes
+that lie outside the enclosing cell.
+
+Redundancy is tested by solving a small linear program in three dimensions:
+the half-space ``a.x <= b`` is redundant if the maximum of ``a.x`` over the
+other half-spaces is at most ``b``. Clarkson's algorithm restricts the
+linear programs to the half-spaces that are already known to be essential
+(see :func:`redundant_half_spaces`); they are solved with Seidel's
+incremental algorithm (see :func:`solve_lp`), in pure Python. The
+geometry is assumed to be contained in a cube of side ``2 * BIG``; the
+half-spaces that are far from the origin are kept.
+
+Only planes are considered; the other surfaces are ignored, which can only
+make the pass more conservative.
+'''
+
+from collections import OrderedDict
+from math import sqrt
+from random import Random
+
+from ..Surface.ESurfaceTypeT4 import ESurfaceTypeT4 as T4S
+
+#: Axis-aligned planes, and the index of their normal axis.
+AXIS_PLANES = {T4S.PLANEX: 0, T4S.PLANEY: 1, T4S.PLANEZ: 2}
+
+#: Half side of the cube containing the geometry, in cm.
+BIG = 1e6
+
+#: Relative tolerance of the redundancy tests.
+TOLERANCE = 1e-9
+
+#: Relative round-off tolerance of the feasibility tests.
+ROUNDOFF = 1e-12
+
+#: Maximum number of plane half-spaces per volume for which the pass is
+#: attempted.
+MAX_PLANES = 64
+
+#: Volumes that are thinner than this (in cm) are left untouched.
+MIN_DEPTH = 1e-6
+
+
+def plane_half_space(surf, side):
+    '''Return the half-space on the given `side` of the TRIPOLI-4 surface
+    `surf` as a pair ``(normal, offset)``, representing the points ``x`` such
+    that ``normal.x <= offset``, with a unit `normal`. Return `None` if `surf`
+    is not a plane.
+
+    :param int side: 1 for the ``PLUS`` side, -1 for the ``MINUS`` side
+
+    >>> from ..Surface.SurfaceT4 import SurfaceT4
+    >>> plane_half_space(SurfaceT4(T4S.PLANEY, [2.0]), 1)
+    ((-0.0, -1.0, -0.0), -2.0)
+    >>> plane_half_space(SurfaceT4(T4S.PLANE, [0.0, 0.0, 2.0, 4.0]), -1)
+    ((0.0, 0.0, 1.0), -2.0)
+    >>> plane_half_space(SurfaceT4(T4S.SPHERE, [0, 0, 0, 1]), 1) is None
+    True
+    '''
+    params = [float(param) for param in surf.param_surface]
+    if surf.type_surface in AXIS_PLANES:
+        coeffs = [0.0, 0.0, 0.0, -params[0]]
+        coeffs[AXIS_PLANES[surf.type_surface]] = 1.0
+    elif surf.type_surface == T4S.PLANE:
+        coeffs = params[:4]
+    else:
+        return None
+    norm = sqrt(sum(coeff*coeff for coeff in coeffs[:3]))
+    if norm == 0.:
+        return None
+    # the PLUS side is a.x + d > 0, i.e. -a.x <= d
+    scale = -side / norm
+    return tuple(scale * coeff for coeff in coeffs[:3]), -scale * coeffs[3]
+
+
+def solve_lp(constraints, objective, lows, highs):
+    '''Maximize ``objective.x`` subject to the `constraints` and to
+    ``lows <= x <= highs``.
+
+    This is Seidel's incremental algorithm: the constraints are added one by
+    one, and the optimum is only recomputed when the current optimum violates
+    the new constraint, by solving the problem restricted to the boundary of
+    the constraint, in one dimension less.
+
+    :param constraints: a list of pairs ``(a, b)``, representing the
+        half-spaces ``a.x <= b``
+    :param objective: the objective vector
+    :param lows: the lower bounds of the variables (finite)
+    :param highs: the upper bounds of the variables (finite)
+    :returns: an optimal point, as a list, or `None` if the problem is not
+        feasible.
+
+    >>> solve_lp([((1., 1.), 1.)], (1., 2.), (-5., -5.), (5., 5.))
+    [-4.0, 5.0]
+    >>> solve_lp([((1.,), 1.), ((-1.,), -2.)], (1.,), (-5.,), (5.,)) is None
+    True
+    '''
+    if len(objective) == 1:
+        return _solve_interval(constraints, objective[0], lows[0], highs[0])
+    point = [min(max(0., low), high) if coeff == 0.
+             else high if coeff > 0. else low
+             for coeff, low, high in zip(objective, lows, highs)]
+    for i, (normal, offset) in enumerate(constraints):
+        excess, scale = -offset, 1. + abs(offset)
+        for coeff, coord in zip(normal, point):
+            term = coeff * coord
+            excess += term
+            scale += abs(term)
+        if excess <= ROUNDOFF * scale:
+            continue
+        if not normal:
+            return None
+        pivot = max(range(len(normal)), key=lambda k: abs(normal[k]))
+        if abs(normal[pivot]) <= TOLERANCE:
+            # the constraint reads 0 <= offset < 0
+            return None
+        point = _solve_on_boundary(constraints[:i], objective, lows, highs,
+                                   normal, offset, pivot)
+        if point is None:
+            return None
+    return point
+
+
+def _solve_interval(constraints, objective, low, high):
+    '''Solve a linear program in one dimension.'''
+    for (coeff,), offset in constraints:
+        if coeff > TOLERANCE:
+            high = min(high, offset / coeff)
+        elif coeff < -TOLERANCE:
+            low = max(low, offset / coeff)
+        elif offset < -ROUNDOFF * (1. + abs(offset)):
+            return None
+    if low > high:
+        if low - high > ROUNDOFF * (1. + abs(low) + abs(high)):
+            return None
+        return [0.5 * (low + high)]
+    if objective == 0.:
+        return [min(max(0., low), high)]
+    return [high if objective > 0. else low]
+
+
+def _solve_on_boundary(constraints, objective, lows, highs, normal, offset,
+                       pivot):
+    '''Solve the linear program on the hyperplane ``normal.x = offset``, by
+    eliminating the variable `pivot`.'''
+    inv = 1. / normal[pivot]
+    others = [k for k in range(len(normal)) if k != pivot]
+
+    def project(vector):
+        factor = vector[pivot] * inv
+        return tuple([vector[k] - factor * normal[k] for k in others])
+
+    # x_pivot = base - ratios.y, where y are the other variables
+    ratios = tuple([normal[k] * inv for k in others])
+    base = offset * inv
+    # bounds of the eliminated variable: low <= base - ratios.y <= high
+    sub_constraints = [(tuple(-ratio for ratio in ratios),
+                        highs[pivot] - base),
+                       (ratios, base - lows[pivot])]
+    for sub_normal, sub_offset in constraints:
+        factor = sub_normal[pivot]
+        sub_constraints.append((project(sub_normal),
+                                sub_offset - factor * base))
+    sub_lows = [lows[k] for k in others]
+    sub_highs = [highs[k] for k in others]
+    sub_point = solve_lp(sub_constraints, project(objective), sub_lows,
+                         sub_highs)
+    if sub_point is None:
+        return None
+    value = base - sum(ratio * coord
+                       for ratio, coord in zip(ratios, sub_point))
+    sub_point.insert(pivot, value)
+    return sub_point
+
+
+def interior_point(constraints):
+    '''Return a point lying at a distance of at least :data:`MIN_DEPTH` inside
+    all the `constraints` (half-spaces with unit normals), or `None` if there
+    is no such point.
+
+    The point is the center of a ball inscribed in the intersection of the
+    half-spaces, found by solving a linear program in four dimensions.
+
+    >>> interior_point([((1., 0., 0.), 1.), ((-1., 0., 0.), 1.)])
+    [0.0, 0.0, 0.0]
+    >>> interior_point([((1., 0., 0.), 1.), ((-1., 0., 0.), -1.)]) is None
+    True
+    '''
+    lifted = [(normal + (1.,), offset) for normal, offset in constraints]
+    # Seidel's algorithm is fast on average for a random order
+    Random(len(lifted)).shuffle(lifted)
+    point = solve_lp(lifted, (0., 0., 0., 1.), (-BIG, -BIG, -BIG, 0.),
+                     (BIG, BIG, BIG, 1.))
+    if point is None:
+        return None
+    point = point[:3]
+    if any(sum(coeff * coord for coeff, coord in zip(normal, point))
+           > offset - 0.5 * MIN_DEPTH for normal, offset in constraints):
+        return None
+    return point
+
+
+def _first_hit(constraints, candidates, start, end):
+    '''Return the index of the first constraint among `candidates` whose
+    boundary is crossed by the segment going from `start` (inside all the
+    constraints) to `end`, or `None`.
+
+    :returns: the index and a flag telling if another constraint is crossed
+        at (almost) the same point.
+    '''
+    direction = [coord_e - coord_s for coord_e, coord_s in zip(end, start)]
+    length = sqrt(sum(coord * coord for coord in direction))
+    best, first, second = None, None, None
+    for index in candidates:
+        normal, offset = constraints[index]
+        speed = sum(coeff * coord for coeff, coord in zip(normal, direction))
+        if speed <= 0.:
+            continue
+        dist = offset - sum(coeff * coord
+                            for coeff, coord in zip(normal, start))
+        fraction = dist / speed
+        if first is None or fraction < first:
+            best, first, second = index, fraction, first
+        elif second is None or fraction < second:
+            second = fraction
+    tied = second is not None and (second - first) * length <= MIN_DEPTH
+    return best, tied
+
+
+def redundant_half_spaces(half_spaces):
+    '''Return the labels of the redundant half-spaces among `half_spaces`, a
+    list of pairs ``(label, (normal, offset))`` with unit normals, in their
+    original order. The intersection of the remaining half-spaces is the same
+    as the intersection of all of them.
+
+    This is Clarkson's algorithm: a set of essential half-spaces is grown as
+    the half-spaces are tested, and each test only solves a linear program
+    over the essential half-spaces. If the optimum violates the tested
+    half-space, the segment going from an interior point to the optimum
+    crosses the boundary of a new essential half-space. If the segment
+    crosses several boundaries at the same point, the new half-space is
+    tested again at the end, against the other essential half-spaces.
+
+    Nothing is removed if the intersection has no interior (for instance, if
+    it is empty).
+
+    >>> cube = [(k, (tuple(float(sign * (i == axis)) for i in range(3)), 1.))
+    ...         for k, (axis, sign) in enumerate([(0, 1), (0, -1), (1, 1),
+    ...                                           (1, -1), (2, 1), (2, -1)])]
+    >>> redundant_half_spaces(cube)
+    []
+    >>> redundant_half_spaces(cube + [('far', ((0.6, 0.8, 0.), 2.))])
+    ['far']
+    >>> redundant_half_spaces(cube + [('out', ((-1., 0., 0.), -2.))])
+    []
+    '''
+    constraints = [constraint for _, constraint in half_spaces]
+    center = interior_point(constraints)
+    if center is None:
+        return []
+    rng = Random(len(constraints))
+    lows, highs = (-BIG, -BIG, -BIG), (BIG, BIG, BIG)
+    essential = []
+    redundant = set()
+    # essential half-spaces that were found at the same time as another one
+    tied = []
+    for index, (normal, offset) in enumerate(constraints):
+        if abs(offset) > 0.5 * BIG:
+            continue
+        while index not in essential:
+            # Seidel's algorithm is fast on average for a random order
+            subset = [constraints[other] for other in essential]
+            rng.shuffle(subset)
+            point = solve_lp(subset, normal, lows, highs)
+            if point is None:
+                # round-off errors; keep the half-space to be on the safe
+                # side
+                essential.append(index)
+                break
+            value = sum(coeff * coord for coeff, coord in zip(normal, point))
+            if value - offset <= TOLERANCE * (1. + abs(offset)):
+                redundant.add(index)
+                break
+            candidates = [other for other in range(len(constraints))
+                          if other not in redundant
+                          and other not in essential]
+            hit, is_tied = _first_hit(constraints, candidates, center,
+                                      point)
+            essential.append(hit)
+            if is_tied:
+                tied.append(hit)
+    # the segments may cross the boundary of a redundant half-space where it
+    # touches the intersection (along an edge, or at a vertex)
+    for index in tied:
+        normal, offset = constraints[index]
+        subset = [constraints[other] for other in essential
+                  if other != index]
+        rng.shuffle(subset)
+        point = solve_lp(subset, normal, lows, highs)
+        if point is None:
+            continue
+        value = sum(coeff * coord for coeff, coord in zip(normal, point))
+        if value - offset <= TOLERANCE * (1. + abs(offset)):
+            essential.remove(index)
+            redundant.add(index)
+    return [label for index, (label, _) in enumerate(half_spaces)
+            if index in redundant]
+
+
+class PlanePruner:
+    '''Remove the redundant plane half-spaces from TRIPOLI-4 volumes (see
+    :func:`redundant_half_spaces`).
+
+    :param surfaces: a dictionary associating the TRIPOLI-4 surface IDs to
+        :class:`~.SurfaceT4` objects
+
+    >>> from ..Surface.SurfaceT4 import SurfaceT4
+    >>> from .VolumeT4 import VolumeT4
+    >>> pruner = PlanePruner({1: SurfaceT4(T4S.PLANEX, [0.]),
+    ...                       2: SurfaceT4(T4S.PLANEX, [1.]),
+    ...                       3: SurfaceT4(T4S.SPHERE, [0, 0, 0, 5])})
+    >>> pruner.prune_volume(7, VolumeT4([1], [2, 3]))
+    0
+    >>> volume = VolumeT4([1, 2], [3])
+    >>> pruner.prune_volume(8, volume)
+    1
+    >>> volume.pluses, volume.minuses
+    ({2}, {3})
+    >>> pruner.report[8]
+    (3, 2)
+    '''
+
+    def __init__(self, surfaces):
+        self.surfaces = surfaces
+        # signed surface ID -> half-space, or None if it is not a plane
+        self.half_spaces = {}
+        # frozenset of the signed IDs of the planes of a volume -> signed IDs
+        # of the redundant ones
+        self.memo = {}
+        # volume key -> (number of surfaces before, number of surfaces
+        # after), for the pruned volumes
+        self.report = OrderedDict()
+        self.n_volumes = 0
+        self.n_tests = 0
+
+    def half_space(self, signed_id):
+        '''Return the half-space of the signed surface ID `signed_id`, or
+        `None` if it is not a plane.'''
+        try:
+            return self.half_spaces[signed_id]
+        except KeyError:
+            surf = self.surfaces[abs(signed_id)]
+            side = 1 if signed_id > 0 else -1
+            result = self.half_spaces[signed_id] = plane_half_space(surf, side)
+            return result
+
+    def prune_volume(self, key, volume):
+        '''Remove the redundant plane half-spaces from `volume`, in place.
+
+        :returns: the number of removed half-spaces.
+        '''
+        pluses, minuses = volume.pluses, volume.minuses
+        n_surfs = len(pluses) + len(minuses)
+        self.n_volumes += 1
+        self.n_tests += n_surfs
+        planes = [signed for signed in
+                  [surf for surf in pluses] + [-surf for surf in minuses]
+                  if self.half_space(signed) is not None]
+        if len(planes) < 2 or len(planes) > MAX_PLANES:
+            return 0
+        planes = frozenset(planes)
+        redundant = self.memo.get(planes)
+        if redundant is None:
+            redundant = redundant_half_spaces(
+                [(signed, self.half_space(signed))
+                 for signed in sorted(planes)])
+            redundant = self.memo[planes] = frozenset(redundant)
+        if not redundant:
+            return 0
+        volume.pluses = pluses - redundant
+        volume.minuses = minuses - {-signed for signed in redundant}
+        self.report[key] = (n_surfs, n_surfs - len(redundant))
+        return len(redundant)
+
+    def prune(self, dic_vol_t4):
+        '''Remove the redundant plane half-spaces from all the volumes of
+        `dic_vol_t4`, a :class:`~.DictVolumeT4`.
+
+        :returns: the number of removed half-spaces.
+        '''
+        return sum(self.prune_volume(key, volume)
+                   for key, volume in dic_vol_t4.items())
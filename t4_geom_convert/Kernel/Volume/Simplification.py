@@ -0,0 +1,344 @@
+'''Module containing a simplification pass for the geometry of the cells.
+
+The pass rewrites the AST of a cell, after the expansion of the cell
+complements (see :meth:`~.CellConversion.pot_complement`), into an equivalent
+AST with fewer nodes. Each node of the converted AST becomes a TRIPOLI-4
+volume, so smaller ASTs mean less work for the tracking. The following laws
+of Boolean algebra are applied bottom-up:
+
+- idempotence: ``a a = a`` and ``a : a = a``;
+- complementation: ``a -a`` is empty and ``a : -a`` is the whole space;
+- absorption: ``a (a : b) = a``, ``a : a b = a``, and more generally an
+  operand is dropped if its operands are a superset of those of another
+  operand;
+- elimination: ``a (-a : b) = a b`` and ``a : -a b = a : b``;
+- common factors: ``a b : a c = a (b : c)`` and ``(a : b) (a : c) = a : b c``.
+
+Identical subtrees are detected by hash-consing: each simplified node is
+interned in a table, with the set of its operands as a key, so that
+duplicate operands (in any order) are recognized in constant time.
+
+Optionally, a node whose disjunctive (for unions) or conjunctive (for
+intersections) normal form has a bounded number of terms is expanded into
+that normal form, minimized and factored again, operand by operand; the
+result is kept if it is smaller.
+
+The complementation and elimination laws are only applied to surfaces:
+``s`` and ``-s`` are complementary half-spaces, for MCNP surfaces and for
+facets of macrobodies alike.
+'''
+
+from collections import OrderedDict
+
+from MIP.geom.semantics import GeomExpression, Surface, FLIP
+
+from .TreeFunctions import fold_tree
+
+
+#: The IDs of the empty set and of the whole space.
+EMPTY, UNIVERSE = 0, 1
+
+#: The maximum number of operands for the pairwise absorption check.
+MAX_PAIRWISE = 64
+
+
+def _is_node(tree):
+    '''Return `True` if `tree` is a union or an intersection node.'''
+    return isinstance(tree, tuple) and tree[0] in FLIP
+
+
+class Simplifier:
+    '''Simplify the ASTs of cells, sharing a hash-consing table.
+
+    :param int max_terms: the maximum number of terms of the normal forms
+        (0 disables the normal-form factoring)
+
+    >>> from t4_geom_convert.Kernel.FileHandlers.Parser.ParseMCNPGeometry \
+import parse_geometry
+    >>> simplifier = Simplifier()
+    >>> simplifier.simplify(parse_geometry('1 2 : 1 3'))
+    ('*', Surface(1, None), (':', Surface(2, None), Surface(3, None)))
+    >>> simplifier.simplify(parse_geometry('1 (1 : 2) (-1 : 3)'))
+    ('*', Surface(1, None), Surface(3, None))
+    >>> simplifier.simplify(parse_geometry('(1 : -1) 2'))
+    Surface(2, None)
+    >>> simplifier.simplify(parse_geometry('1 (2 : -1)'), key=7)
+    ('*', Surface(1, None), Surface(2, None))
+    >>> simplifier.report[7]
+    (5, 3)
+    '''
+
+    def __init__(self, max_terms=0):
+        self.max_terms = max_terms
+        # node ID -> (operator, operand IDs), or (None, Surface) for leaves
+        self.nodes = [(None, None), (None, None)]
+        # node ID -> number of nodes of the (unshared) subtree
+        self.sizes = [1, 1]
+        # hash-consing key -> node ID
+        self.ids = {}
+        # node ID -> simplified AST
+        self.built = {}
+        # operator -> node ID -> normal form, as a tuple of frozensets of leaf
+        # IDs, or None if it has too many terms (see normal_form)
+        self.normal_forms = {}
+        # cell key -> (number of nodes before, number of nodes after)
+        self.report = OrderedDict()
+
+    def leaf(self, surface):
+        '''Return the ID of the leaf for `surface`.'''
+        key = (surface.surface, surface.sub)
+        node_id = self.ids.get(key)
+        if node_id is None:
+            node_id = self.ids[key] = len(self.nodes)
+            self.nodes.append((None, surface))
+            self.sizes.append(1)
+        return node_id
+
+    def complement(self, node_id):
+        '''Return the ID of the complement of the leaf `node_id`.'''
+        return self.leaf(self.nodes[node_id][1].inverse())
+
+    def make(self, operator, operands):
+        '''Return the ID of the node applying `operator` to the (simplified,
+        distinct) `operands`.'''
+        if len(operands) == 1:
+            return operands[0]
+        key = (operator, frozenset(operands))
+        node_id = self.ids.get(key)
+        if node_id is None:
+            node_id = self.ids[key] = len(self.nodes)
+            self.nodes.append((operator, tuple(operands)))
+            self.sizes.append(1 + sum(self.sizes[op] for op in operands))
+        return node_id
+
+    def simplify(self, tree, key=None):
+        '''Return a simplified AST equivalent to `tree`.
+
+        If `key` is not `None`, the number of nodes of `tree` and of the
+        result are stored in ``self.report[key]``. Trees that are equivalent
+        to the whole space are returned as they are, because they cannot be
+        represented otherwise; empty trees are replaced with the intersection
+        of a surface and its complement.
+        '''
+        memo = {}
+
+        def children(node):
+            if id(node) in memo or not _is_node(node):
+                return ()
+            return node[1:]
+
+        def combine(node, results):
+            cached = memo.get(id(node))
+            if cached is not None:
+                return cached[1]
+            if _is_node(node):
+                result = self.reduce(node[0], results)
+                size = 1 + sum(memo[id(arg)][2] for arg in node[1:])
+            else:
+                result = self.leaf(node)
+                size = 1
+            # keep a reference to node, so that its id stays valid
+            memo[id(node)] = (node, result, size)
+            return result
+
+        root = fold_tree(tree, children, combine)
+        size = memo[id(tree)][2]
+        if root == UNIVERSE:
+            new_tree, new_size = tree, size
+        elif root == EMPTY:
+            surf = next(leaf for leaf, _, _ in memo.values()
+                        if isinstance(leaf, Surface))
+            new_tree = GeomExpression(('*', surf, surf.inverse()))
+            new_size = 3
+        else:
+            new_tree, new_size = self.build(root), self.sizes[root]
+        if key is not None:
+            self.report[key] = (size, new_size)
+        return new_tree
+
+    def build(self, root):
+        '''Return the AST for the node `root`.'''
+        built = self.built
+
+        def children(node_id):
+            operator, operands = self.nodes[node_id]
+            if operator is None or node_id in built:
+                return ()
+            return operands
+
+        def combine(node_id, results):
+            tree = built.get(node_id)
+            if tree is None:
+                operator, operands = self.nodes[node_id]
+                if operator is None:
+                    tree = operands
+                else:
+                    tree = GeomExpression((operator,) + tuple(results))
+                built[node_id] = tree
+            return tree
+
+        return fold_tree(root, children, combine)
+
+    def operand_set(self, node_id, operator):
+        '''Return the operands of `node_id` as a tuple, if it applies
+        `operator`, or the 1-tuple containing `node_id` otherwise.'''
+        node_op, operands = self.nodes[node_id]
+        return operands if node_op == operator else (node_id,)
+
+    def reduce(self, operator, args, normalize=True):
+        '''Return the ID of the simplified node applying `operator` to the
+        (already simplified) nodes `args`.'''
+        if operator == '*':
+            absorbing, neutral = EMPTY, UNIVERSE
+        else:
+            absorbing, neutral = UNIVERSE, EMPTY
+        dual = FLIP[operator]
+        nodes = self.nodes
+
+        # flattening and idempotence
+        operands = OrderedDict()
+        for arg in args:
+            if arg == absorbing:
+                return absorbing
+            if arg == neutral:
+                continue
+            for operand in self.operand_set(arg, operator):
+                operands[operand] = None
+        if not operands:
+            return neutral
+
+        # complementation
+        leaves = {op for op in operands if nodes[op][0] is None}
+        if any(self.complement(leaf) in leaves for leaf in leaves):
+            return absorbing
+
+        # absorption and elimination
+        duals = [op for op in operands if nodes[op][0] == dual]
+        for op in duals:
+            sub_ops = nodes[op][1]
+            if any(sub_op in operands for sub_op in sub_ops):
+                del operands[op]
+                continue
+            kept = [sub_op for sub_op in sub_ops
+                    if nodes[sub_op][0] is not None
+                    or self.complement(sub_op) not in leaves]
+            if len(kept) < len(sub_ops):
+                new_args = [self.reduce(dual, kept, normalize)
+                            if arg == op else arg for arg in operands]
+                return self.reduce(operator, new_args, normalize)
+        duals = [op for op in duals if op in operands]
+        if 1 < len(duals) <= MAX_PAIRWISE:
+            sets = {op: frozenset(nodes[op][1]) for op in duals}
+            for op in duals:
+                if any(sets[other] < sets[op] for other in duals
+                       if other in operands):
+                    del operands[op]
+
+        operands = list(operands)
+        if len(operands) == 1:
+            return operands[0]
+
+        # common factors
+        terms = [self.operand_set(op, dual) for op in operands]
+        common = set(terms[0]).intersection(*terms[1:])
+        if common:
+            factors = [op for op in terms[0] if op in common]
+            rests = [[op for op in term if op not in common]
+                     for term in terms]
+            if not all(rests):
+                return self.reduce(dual, factors, normalize)
+            inner = self.reduce(operator,
+                                [self.reduce(dual, rest, normalize)
+                                 for rest in rests], normalize)
+            return self.reduce(dual, factors + [inner], normalize)
+
+        node_id = self.make(operator, operands)
+        if normalize and self.max_terms:
+            return self.normalize(node_id)
+        return node_id
+
+    def normalize(self, node_id):
+        '''Try to shrink the node `node_id` by expanding it into its normal
+        form, minimizing it and factoring it again.'''
+        operator = self.nodes[node_id][0]
+        terms = self.normal_form(node_id, operator)
+        if terms is None:
+            return node_id
+        # absorption: drop the terms that contain another term
+        terms = sorted(set(terms), key=len)
+        minimal = []
+        for term in terms:
+            if not any(other <= term for other in minimal):
+                minimal.append(term)
+        dual = FLIP[operator]
+        new_id = self.factor(operator, dual, minimal)
+        if self.sizes[new_id] < self.sizes[node_id]:
+            return new_id
+        return node_id
+
+    def factor(self, operator, dual, terms):
+        '''Build a node applying `operator` to the `terms` (sets of leaves
+        combined with `dual`), factoring the most frequent leaves out.'''
+        if not terms:
+            return UNIVERSE if operator == '*' else EMPTY
+        counts = {}
+        for term in terms:
+            for leaf in term:
+                counts[leaf] = counts.get(leaf, 0) + 1
+        leaf, count = max(counts.items(), key=lambda item: (item[1],
+                                                            -item[0]))
+        if count < 2:
+            return self.reduce(operator,
+                               [self.reduce(dual, sorted(term), False)
+                                for term in terms], False)
+        with_leaf = [term - {leaf} for term in terms if leaf in term]
+        others = [term for term in terms if leaf not in term]
+        factored = self.reduce(dual, [leaf, self.factor(operator, dual,
+                                                        with_leaf)], False)
+        if not others:
+            return factored
+        return self.reduce(operator, [factored,
+                                      self.factor(operator, dual, others)],
+                           False)
+
+    def normal_form(self, root, operator):
+        '''Return the normal form of the node `root` as a tuple of sets of
+        leaf IDs: the disjunctive normal form if `operator` is ``':'``, the
+        conjunctive one if it is ``'*'``. Return `None` if the normal form
+        has more than ``self.max_terms`` terms.'''
+        cache = self.normal_forms.setdefault(operator, {})
+        max_terms = self.max_terms
+
+        def children(node_id):
+            if node_id in cache or self.nodes[node_id][0] is None:
+                return ()
+            return self.nodes[node_id][1]
+
+        def combine(node_id, results):
+            if node_id in cache:
+                return cache[node_id]
+            node_op = self.nodes[node_id][0]
+            if node_op is None:
+                form = (frozenset((node_id,)),)
+            elif any(result is None for result in results):
+                form = None
+            elif node_op == operator:
+                form = tuple(term for result in results for term in result)
+            else:
+                form = (frozenset(),)
+                for result in results:
+                    if len(form) * len(result) > max_terms:
+                        form = None
+                        break
+                    form = tuple(term | other for term in form
+                                 for other in result)
+                    # drop the empty (or universal) terms
+                    form = tuple(term for term in form
+                                 if not any(self.complement(leaf) in term
+                                            for leaf in term))
+            if form is not None and len(form) > max_terms:
+                form = None
+            cache[node_id] = form
+            return form
+
+        return fold_tree(root, children, combine)
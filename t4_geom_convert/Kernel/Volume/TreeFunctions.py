@@ -79,3 +79,45 @@ def largestPureIntersectionNode(nodes):
             largest_len = len(node)
             largest_index = index
     return largest_index
+
+
+def fold_tree(tree, children, combine):
+    '''Fold `tree` bottom-up, without recursion.
+
+    `children(node)` returns the subtrees of `node` that must be folded, in
+    the order in which they must be visited (an empty sequence for leaves),
+    and `combine(node, results)` returns the value of `node` given the values
+    of those subtrees. The nodes are combined in the same order as in the
+    obvious recursive implementation (post-order), so that side effects of
+    `combine` happen in the same order too, but the depth of the tree is not
+    limited by the recursion limit.
+
+    >>> def children(node):
+    ...     return node[1:] if isinstance(node, tuple) else ()
+    >>> def combine(node, results):
+    ...     if not isinstance(node, tuple):
+    ...         return str(node)
+    ...     return '(' + node[0].join(results) + ')'
+    >>> fold_tree((':', 1, ('*', 2, 3), 4), children, combine)
+    '(1:(2*3):4)'
+    >>> deep = 0
+    >>> for i in range(10**5):
+    ...     deep = ('*', i, deep)
+    >>> fold_tree(deep, children, lambda node, results: sum(results) + 1)
+    200001
+    '''
+    stack = [(tree, iter(children(tree)), [])]
+    while True:
+        node, subtrees, results = stack[-1]
+        for subtree in subtrees:
+            grandchildren = children(subtree)
+            if grandchildren:
+                stack.append((subtree, iter(grandchildren), []))
+                break
+            results.append(combine(subtree, ()))
+        else:
+            stack.pop()
+            value = combine(node, results)
+            if not stack:
+                return value
+            stack[-1][2].append(value)
@@ -0,0 +1,152 @@
+'''Module containing the :class:`VolumeSpill` class, an on-disk store for
+the TRIPOLI-4 volumes produced by the conversion of the MCNP cells.'''
+
+import pickle
+import shutil
+import struct
+import tempfile
+from array import array
+
+from .DictVolumeT4 import DictVolumeT4
+
+
+class VolumeSpill:
+    '''An append-only, on-disk sequence of converted cells.
+
+    The volumes of the appended cells are accumulated in a
+    :class:`~.DictVolumeT4` batch; when the batch holds `batch_size` volumes
+    or more, it is pickled to an anonymous temporary file and a new batch is
+    started. Only one batch at a time needs to be held in memory; iterating
+    over the spill reads the batches back in order, as pairs consisting of
+    the list of cell IDs in the batch and of the volumes.
+
+    Since the volumes of a cell only refer to other volumes of the same cell,
+    each batch can be post-processed and written out independently.
+
+    >>> from .VolumeT4 import VolumeT4
+    >>> cell = DictVolumeT4()
+    >>> spill = VolumeSpill(batch_size=2)
+    >>> for key in (1, 2, 3):
+    ...     cell[key] = VolumeT4(pluses=[key], minuses=[])
+    ...     spill.append(key, cell)
+    ...     cell.clear()
+    >>> [(keys, list(volumes)) for keys, volumes in spill]
+    [([1, 2], [1, 2]), ([3], [3])]
+    >>> len(spill), spill.n_volumes, list(spill.keys)
+    (3, 3, [1, 2, 3])
+    >>> spill.close()
+    '''
+
+    #: Default number of volumes per batch.
+    DEFAULT_BATCH_SIZE = 1 << 16
+
+    def __init__(self, directory=None, batch_size=DEFAULT_BATCH_SIZE):
+        '''Create an empty spill.
+
+        :param directory: the directory for the temporary file (default:
+            the system temporary directory, see :mod:`tempfile`)
+        :param int batch_size: the number of volumes per batch
+        '''
+        self.directory = directory
+        self.batch_size = batch_size
+        self.file = tempfile.TemporaryFile(dir=directory)
+        #: the IDs of the cells in the spill, in order
+        self.keys = array('q')
+        self.n_volumes = 0
+        self.n_batches = 0
+        self.pending_keys = []
+        self.pending = DictVolumeT4()
+
+    def append(self, key, volumes):
+        '''Append the volumes of cell `key` (a :class:`~.DictVolumeT4`) to the
+        spill. The volumes are copied.'''
+        self.pending.merge_shifted(volumes, 0)
+        self.pending_keys.append(key)
+        self.keys.append(key)
+        self.n_volumes += len(volumes)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        '''Write the current batch to disk.'''
+        if not self.pending_keys:
+            return
+        self._dump(self.pending_keys, self.pending)
+        self.pending_keys = []
+        self.pending = DictVolumeT4()
+
+    def _dump(self, keys, volumes):
+        self.file.seek(0, 2)
+        pickle.dump((keys, volumes), self.file,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+        self.n_batches += 1
+
+    def __iter__(self):
+        self.flush()
+        self.file.flush()
+        self.file.seek(0)
+        for _ in range(self.n_batches):
+            yield pickle.load(self.file)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def close(self):
+        '''Close and delete the temporary file.'''
+        self.file.close()
+
+    def header(self):
+        '''Return the attributes of the spill, without the batches. The
+        spill is recreated by :meth:`from_header` and :meth:`read_batches`.'''
+        self.flush()
+        return (self.directory, self.batch_size, self.keys, self.n_volumes,
+                self.n_batches)
+
+    @classmethod
+    def from_header(cls, header):
+        '''Create a spill from the result of :meth:`header`; its batches must
+        then be read with :meth:`read_batches`.'''
+        directory, batch_size, keys, n_volumes, n_batches = header
+        spill = cls(directory, batch_size)
+        spill.keys = keys
+        spill.n_volumes = n_volumes
+        spill.n_batches = n_batches
+        return spill
+
+    def write_batches(self, file):
+        '''Copy the batches to the binary `file`, preceded by their size,
+        without loading them in memory.
+
+        >>> import io
+        >>> from .VolumeT4 import VolumeT4
+        >>> cell = DictVolumeT4()
+        >>> cell[1] = VolumeT4(pluses=[1], minuses=[])
+        >>> spill = VolumeSpill(batch_size=1)
+        >>> spill.append(10, cell)
+        >>> spill.append(11, cell)
+        >>> stream = io.BytesIO()
+        >>> spill.write_batches(stream)
+        >>> copy = VolumeSpill.from_header(spill.header())
+        >>> copy.read_batches(io.BytesIO(stream.getvalue()))
+        >>> [keys for keys, _ in copy], copy.n_volumes
+        ([[10], [11]], 2)
+        >>> spill.close(); copy.close()
+        '''
+        self.flush()
+        self.file.flush()
+        size = self.file.seek(0, 2)
+        file.write(struct.pack('<Q', size))
+        self.file.seek(0)
+        shutil.copyfileobj(self.file, file)
+
+    def read_batches(self, file):
+        '''Read the batches written by :meth:`write_batches` from the binary
+        `file`, in chunks.'''
+        size, = struct.unpack('<Q', file.read(8))
+        self.file.seek(0, 2)
+        while size:
+            chunk = file.read(min(size, 1 << 20))
+            if not chunk:
+                raise EOFError('truncated volume spill')
+            self.file.write(chunk)
+            size -= len(chunk)
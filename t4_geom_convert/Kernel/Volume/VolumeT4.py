@@ -7,33 +7,28 @@ Created on 5 févr. 2019
 :file : VolumeT4.py
 '''
 
+from .BoundingBox import volume_bbox
 
-class VolumeT4:
-    '''
-    :brief: class which permits to access precisely of the value of a volume T4
-    '''
 
-    def __init__(self, pluses, minuses, ops=None, idorigin=None, fictive=True):
-        '''
-        Constructor
-        '''
-        self.pluses = set(pluses)
-        self.minuses = set(minuses)
-        self.ops = ops
-        self.idorigin = idorigin.copy() if idorigin is not None else []
-        self.fictive = fictive
+class BaseVolumeT4:
+    '''Methods shared by :class:`VolumeT4` and by the views returned by
+    :class:`~.DictVolumeT4`. Subclasses must provide the `pluses`, `minuses`,
+    `ops`, `idorigin` and `fictive` attributes.'''
+
+    __slots__ = ()
 
     def __str__(self):
         str_params = ['EQUA']
-        if self.pluses:
-            str_params.extend(('PLUS', len(self.pluses)))
-            str_params.extend(sorted(self.pluses))
-        if self.minuses:
-            str_params.extend(('MINUS', len(self.minuses)))
-            str_params.extend(sorted(self.minuses))
-        if self.ops is not None:
-            str_params.extend((self.ops[0], len(self.ops[1])))
-            str_params.extend(self.ops[1])
+        pluses, minuses, ops = self.pluses, self.minuses, self.ops
+        if pluses:
+            str_params.extend(('PLUS', len(pluses)))
+            str_params.extend(sorted(pluses))
+        if minuses:
+            str_params.extend(('MINUS', len(minuses)))
+            str_params.extend(sorted(minuses))
+        if ops is not None:
+            str_params.extend((ops[0], len(ops[1])))
+            str_params.extend(ops[1])
         if self.fictive:
             str_params.append('FICTIVE')
         return ' '.join(str(param) for param in str_params)
@@ -44,8 +39,9 @@ class VolumeT4:
                                      self.idorigin, self.fictive))
 
     def comment(self):
-        if self.idorigin:
-            return ' // ' + '; '.join(map(str, self.idorigin))
+        idorigin = self.idorigin
+        if idorigin:
+            return ' // ' + '; '.join(map(str, idorigin))
         return ''
 
     def empty(self):
@@ -56,3 +52,32 @@ class VolumeT4:
     def surface_ids(self):
         '''Return the surface IDs used in this volume, as a set.'''
         return self.pluses | self.minuses
+
+    def bounding_box(self, surfaces, boxes=None):
+        '''Return a conservative axis-aligned bounding box for this volume, as
+        a :class:`~.BoundingBox`.
+
+        :param surfaces: a dictionary associating surface IDs to
+            :class:`~.SurfaceT4` objects
+        :param boxes: a dictionary associating the IDs of the operands of this
+            volume to their bounding boxes (see :func:`~.volume_bbox`)
+        '''
+        return volume_bbox(self, surfaces, {} if boxes is None else boxes)
+
+
+class VolumeT4(BaseVolumeT4):
+    '''
+    :brief: class which permits to access precisely of the value of a volume T4
+    '''
+
+    __slots__ = ('pluses', 'minuses', 'ops', 'idorigin', 'fictive')
+
+    def __init__(self, pluses, minuses, ops=None, idorigin=None, fictive=True):
+        '''
+        Constructor
+        '''
+        self.pluses = set(pluses)
+        self.minuses = set(minuses)
+        self.ops = ops
+        self.idorigin = idorigin.copy() if idorigin is not None else []
+        self.fictive = fictive
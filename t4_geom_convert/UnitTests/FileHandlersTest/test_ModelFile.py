@@ -0,0 +1,141 @@
+'''Unit tests for the :mod:`~.ModelFile` module.'''
+# pylint: disable=no-value-for-parameter
+
+import struct
+import tempfile
+from collections import OrderedDict
+from functools import reduce
+from pathlib import Path
+
+import pytest
+from hypothesis import assume, given, settings
+from hypothesis.strategies import (composite, dictionaries, floats, integers,
+                                   lists, none, one_of, recursive,
+                                   sampled_from, text, tuples)
+
+from t4_geom_convert.Kernel.FileHandlers.ModelFile import (
+    ModelReader, ModelWriter, FORMAT_VERSION, MAGIC)
+from t4_geom_convert.Kernel.FileHandlers.Parser.ParseMCNPGeometry import (
+    parse_geometry, same_ast, GeometryParseError)
+from t4_geom_convert.Kernel.Surface.CollectionDict import CollectionDict
+from t4_geom_convert.Kernel.Surface.ESurfaceTypeMCNP import ESurfaceTypeMCNP
+from t4_geom_convert.Kernel.Surface.SurfaceMCNP import SurfaceMCNP
+from t4_geom_convert.Kernel.Volume.CellMCNP import CellMCNP
+from t4_geom_convert.Kernel.Volume.Lattice import LatticeBounds, LatticeSpec
+from ..ParserTest.test_ParseMCNPGeometry import geometries
+
+
+def values():
+    '''Generate the nested values found in the parameters of the surfaces and
+    in the transformations.'''
+    scalars = one_of(none(), integers(-2**62, 2**62), floats(allow_nan=False),
+                     text(max_size=5))
+    return recursive(scalars,
+                     lambda children: one_of(lists(children, max_size=4),
+                                             tuples(children, children)),
+                     max_leaves=10)
+
+
+@composite
+def surfaces(draw):
+    '''Generate a dictionary of MCNP surfaces.'''
+    subsurface = tuples(sampled_from(['', '*', '+']),
+                        sampled_from(list(ESurfaceTypeMCNP)),
+                        lists(values(), max_size=3),
+                        lists(values(), max_size=3),
+                        lists(integers(1, 99), max_size=2),
+                        sampled_from([1, -1]))
+    dic = CollectionDict()
+    for key, subs in draw(dictionaries(integers(1, 10**6),
+                                       lists(subsurface, min_size=1,
+                                             max_size=3),
+                                       max_size=5)).items():
+        dic[key] = [(SurfaceMCNP(*sub[:5]), sub[5]) for sub in subs]
+    return dic
+
+
+@composite
+def lattice_specs(draw):
+    '''Generate a lattice specification.'''
+    bounds = draw(lists(tuples(integers(-2, 0), integers(0, 2)), min_size=1,
+                        max_size=3))
+    size = reduce(lambda acc, bound: acc * (bound[1] - bound[0] + 1),
+                  bounds, 1)
+    spec = draw(lists(integers(0, 10**6), min_size=size, max_size=size))
+    return LatticeSpec(LatticeBounds(bounds), spec)
+
+
+@composite
+def cells(draw):
+    '''Generate a dictionary of MCNP cells.'''
+    dic = OrderedDict()
+    for key in draw(lists(integers(1, 10**6), max_size=5, unique=True)):
+        try:
+            geometry = parse_geometry(draw(geometries()))
+        except GeometryParseError:
+            assume(False)
+        dic[key] = CellMCNP(
+            str(draw(integers(0, 99))),
+            draw(one_of(none(), floats(-10, 10).map(str))),
+            geometry, draw(one_of(none(), floats(0, 10))),
+            draw(integers(0, 99)),
+            draw(one_of(none(), integers(0, 99), lattice_specs())),
+            draw(one_of(none(), lists(floats(), max_size=12).map(tuple))),
+            draw(sampled_from([None, 1, 2])),
+            draw(lists(lists(values(), max_size=12).map(tuple), max_size=2)),
+            draw(lists(tuples(integers(1, 99)), max_size=2)))
+    return dic
+
+
+def same_fillid(first, second):
+    '''Return `True` if the two fill specifications are identical.'''
+    if isinstance(first, LatticeSpec):
+        return (isinstance(second, LatticeSpec)
+                and first.bounds.bounds == second.bounds.bounds
+                and list(first) == list(second))
+    return first == second and type(first) is type(second)
+
+
+@settings(deadline=None)
+@given(surfs=surfaces(), mcnp_cells=cells(),
+       skipped=lists(integers(1, 10**6), max_size=3),
+       materials=dictionaries(integers(1, 999),
+                              lists(text(max_size=8), max_size=6),
+                              max_size=3))
+def test_round_trip(surfs, mcnp_cells, skipped, materials):
+    '''Test that the parsed stages are read back identically.'''
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir) / 'model'
+        writer = ModelWriter(path)
+        writer.fetch('mcnp_materials', lambda: materials)
+        writer.fetch('mcnp_surfaces', lambda: surfs)
+        writer.fetch('mcnp_cells', lambda: (mcnp_cells, skipped))
+        reader = ModelReader(path)
+        read_materials = reader.fetch('mcnp_materials', None)
+        read_surfs = reader.fetch('mcnp_surfaces', None)
+        read_cells, read_skipped = reader.fetch('mcnp_cells', None)
+    assert read_materials == materials
+    assert repr(list(read_surfs.items())) == repr(list(surfs.items()))
+    assert read_skipped == skipped
+    assert list(read_cells) == list(mcnp_cells)
+    for key, cell in mcnp_cells.items():
+        read = read_cells[key]
+        assert same_ast(read.geometry, cell.geometry)
+        assert same_fillid(read.fillid, cell.fillid)
+        for attr in ('materialID', 'density', 'importance', 'universe',
+                     'filltr', 'lattice', 'trcl', 'idorigin'):
+            assert repr(getattr(read, attr)) == repr(getattr(cell, attr))
+
+
+def test_bad_files(tmp_path):
+    '''Test that files that are not model files, or that were written in
+    another version of the format, are rejected.'''
+    path = tmp_path / 'model'
+    for content in (b'', b'MCNP input\n',
+                    struct.pack('<8sII', b'NOTMODEL', FORMAT_VERSION, 0)):
+        path.write_bytes(content)
+        with pytest.raises(ValueError, match='is not a model file'):
+            ModelReader(path)
+    path.write_bytes(struct.pack('<8sII', MAGIC, FORMAT_VERSION + 1, 0))
+    with pytest.raises(ValueError, match='version'):
+        ModelReader(path)
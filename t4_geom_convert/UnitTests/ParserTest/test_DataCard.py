@@ -0,0 +1,58 @@
+'''Unit tests for the expansion of MCNP data cards.'''
+# pylint: disable=no-value-for-parameter
+
+import math
+
+from hypothesis import given
+from hypothesis.strategies import (composite, integers, lists, one_of,
+                                   sampled_from, tuples)
+
+from MIP.mip.datacard import expand_data_array, expand_data_card
+
+
+@composite
+def data(draw):
+    '''Generate a list of tokens made of numbers, repetitions (``nR``) and
+    jumps (``nJ``), along with the list of values that it describes (`None`
+    for the jumps).'''
+    entries = draw(lists(
+        tuples(one_of(integers(-5, 5), sampled_from(['j', 'J']).map(str)),
+               integers(0, 3), sampled_from(['r', 'R'])),
+        max_size=10))
+    tokens = []
+    values = []
+    for value, n_reps, letter in entries:
+        if isinstance(value, str):
+            tokens.append('{}{}'.format(n_reps or '', value))
+            values.extend([None] * (n_reps or 1))
+            continue
+        tokens.append(str(value))
+        values.append(value)
+        if n_reps:
+            tokens.append('{}{}'.format(n_reps, letter))
+            values.extend([values[-1]] * n_reps)
+    return tokens, values
+
+
+@given(token_values=data())
+def test_expand(token_values):
+    '''Test that the data cards are expanded into the expected values, as
+    lists and as arrays.'''
+    tokens, values = token_values
+    assert expand_data_card(tokens, dtype='int') == (values, len(tokens))
+    array, consumed = expand_data_array(tokens)
+    assert consumed == len(tokens)
+    assert [None if math.isnan(value) else value
+            for value in array.tolist()] == values
+
+
+@given(token_values=data(), extra=integers(0, 3))
+def test_expected(token_values, extra):
+    '''Test that the expansion stops as soon as the expected number of values
+    has been collected, without looking at the following tokens.'''
+    tokens, values = token_values
+    array, consumed = expand_data_array(tokens + ['other'] * extra,
+                                        expected=len(values))
+    assert len(array) == len(values)
+    assert consumed <= len(tokens)
+    assert expand_data_card(tokens[:consumed]) == expand_data_card(tokens)
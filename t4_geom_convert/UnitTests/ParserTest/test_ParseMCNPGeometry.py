@@ -0,0 +1,118 @@
+'''Unit tests for the :mod:`~.ParseMCNPGeometry` module.'''
+
+import pytest
+import tatsu.exceptions
+from hypothesis import given
+from hypothesis.strategies import (composite, integers, just, one_of,
+                                   recursive, sampled_from, tuples)
+
+from MIP.geom.parsegeom import get_ast
+from t4_geom_convert.Kernel.FileHandlers.Parser.ParseMCNPGeometry import (
+    parse_geometry, same_ast, GeometryParseError)
+
+
+def spaces():
+    '''Generate some (possibly empty) whitespace.'''
+    return sampled_from(['', ' ', '  ', '\n     '])
+
+
+@composite
+def surfaces(draw):
+    '''Generate a signed surface, possibly with a facet.'''
+    sign = draw(sampled_from(['', '-', '+']))
+    surface = draw(integers(1, 999))
+    facet = draw(one_of(just(''), integers(1, 8).map('.{}'.format)))
+    return '{}{}{}'.format(sign, surface, facet)
+
+
+@composite
+def cell_complements(draw):
+    '''Generate the complement of a cell.'''
+    return '#{}{}'.format(draw(spaces()), draw(integers(1, 999)))
+
+
+@composite
+def combine(draw, children):
+    '''Combine geometries with unions, intersections, parentheses and
+    complements.'''
+    kind = draw(sampled_from(['union', 'isect', 'paren', 'compl']))
+    if kind == 'union':
+        left, right = draw(tuples(children, children))
+        return '{}{}:{}{}'.format(left, draw(spaces()), draw(spaces()),
+                                  right)
+    if kind == 'isect':
+        left, right = draw(tuples(children, children))
+        return '{} {}'.format(left, right)
+    geom = '({}{}{})'.format(draw(spaces()), draw(children), draw(spaces()))
+    if kind == 'compl':
+        geom = '#' + draw(sampled_from(['', ' '])) + geom
+    return geom
+
+
+def geometries():
+    '''Generate a cell geometry.'''
+    return recursive(one_of(surfaces(), cell_complements()), combine,
+                     max_leaves=20)
+
+
+@given(geom=geometries())
+def test_same_as_tatsu(geom):
+    '''Test that the fast parser yields exactly the same AST as the TatSu
+    parser, whenever the latter succeeds.
+
+    The regular expressions that prepare the input for the TatSu grammar
+    reject a few valid geometries (e.g. ``#1:#2``), which the fast parser
+    accepts.'''
+    try:
+        ref_ast = get_ast(geom)
+    except tatsu.exceptions.ParseException:
+        return
+    except AttributeError:
+        # the TatSu parser cannot complement a complemented cell either
+        with pytest.raises(GeometryParseError):
+            parse_geometry(geom)
+        return
+    assert same_ast(parse_geometry(geom), ref_ast)
+
+
+@pytest.mark.parametrize('geom', ['', '1 :', ': 1', '1 ()', '(1', '1)',
+                                  '1 :: 2', '1 & 2', '#', '1 #(2'])
+def test_syntax_errors(geom):
+    '''Test that invalid geometries raise :exc:`GeometryParseError`.'''
+    with pytest.raises(GeometryParseError):
+        parse_geometry(geom)
+
+
+@given(geom=geometries())
+def test_flat(geom):
+    '''Test that the operands of unions (intersections) are never unions
+    (intersections) themselves.'''
+    try:
+        ast = parse_geometry(geom)
+    except GeometryParseError:
+        return
+    to_visit = [ast]
+    while to_visit:
+        node = to_visit.pop()
+        if not isinstance(node, tuple) or node[0] == '^':
+            continue
+        assert len(node) > 2
+        for arg in node[1:]:
+            assert not isinstance(arg, tuple) or arg[0] != node[0]
+        to_visit.extend(node[1:])
+
+
+def test_long_cell():
+    '''Test that long intersections and unions yield shallow trees.'''
+    n_surfs = 5000
+    geom = ' '.join(str(-surf) for surf in range(1, n_surfs + 1))
+    geom += ' : ' + ' : '.join(str(surf) for surf in range(1, n_surfs + 1))
+    ast = parse_geometry(geom)
+    assert ast[0] == ':'
+    assert len(ast) == n_surfs + 2
+    assert ast[1][0] == '*'
+    assert len(ast[1]) == n_surfs + 1
+    inverse = parse_geometry('#(' + geom + ')')
+    assert inverse == ast.inverse()
+    assert inverse[0] == '*'
+    assert len(inverse) == n_surfs + 2
@@ -0,0 +1,43 @@
+'''Unit tests for the :mod:`~.Translation` module.'''
+# pylint: disable=no-value-for-parameter
+
+import numpy as np
+from hypothesis import given
+from hypothesis.strategies import (composite, floats, lists, sampled_from,
+                                   tuples)
+
+from t4_geom_convert.Kernel.Transformation.Translation import (
+    translation, translate_surface)
+from t4_geom_convert.Kernel.Transformation.Transformation import (
+    transformation)
+from t4_geom_convert.Kernel.Surface.SurfaceMCNP import SurfaceMCNP
+from t4_geom_convert.Kernel.Surface.ESurfaceTypeMCNP import (
+    ESurfaceTypeMCNP as MS)
+
+
+def coords():
+    '''Generate a coordinate.'''
+    return floats(-1e3, 1e3, allow_nan=False, allow_infinity=False)
+
+
+@composite
+def surfaces(draw):
+    '''Generate a plane, a sphere, a cylinder or a cone.'''
+    typ = draw(sampled_from((MS.P, MS.S, MS.C, MS.K)))
+    point = draw(tuples(coords(), coords(), coords()))
+    direction = draw(sampled_from([(1., 0., 0.), (0., 0.6, 0.8),
+                                   (0.48, 0.6, 0.64)]))
+    compl = {MS.P: (), MS.S: (2.,), MS.C: (1.5,), MS.K: (0.3, 1.)}[typ]
+    return SurfaceMCNP('', typ, (point, direction), compl)
+
+
+@given(surf=surfaces(),
+       vectors=lists(tuples(coords(), coords(), coords()), min_size=1,
+                     max_size=10))
+def test_translate_surface(surf, vectors):
+    '''Test that translating a surface by many vectors at once gives the same
+    results as translating it by each vector separately.'''
+    translated = translate_surface(surf, np.array(vectors))
+    expected = [transformation(translation(vec), surf) for vec in vectors]
+    assert [repr(surf) for surf in translated] == [repr(surf)
+                                                   for surf in expected]
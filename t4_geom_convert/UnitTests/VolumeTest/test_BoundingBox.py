@@ -0,0 +1,247 @@
+'''Unit tests for the :mod:`~.BoundingBox` module.'''
+# pylint: disable=no-value-for-parameter
+
+from math import sqrt
+
+from hypothesis import given, assume
+from hypothesis.strategies import (composite, floats, integers, lists,
+                                   sampled_from, recursive, tuples)
+
+from t4_geom_convert.Kernel.Volume.BoundingBox import (BoundingBox, cell_bbox,
+                                                       VolumeBoxes, INF)
+from t4_geom_convert.Kernel.Volume.VolumeT4 import VolumeT4
+from t4_geom_convert.Kernel.Surface.SurfaceMCNP import SurfaceMCNP
+from t4_geom_convert.Kernel.Surface.SurfaceT4 import SurfaceT4
+from t4_geom_convert.Kernel.Surface.ESurfaceTypeMCNP import (
+    ESurfaceTypeMCNP as MS)
+from t4_geom_convert.Kernel.Surface.ESurfaceTypeT4 import (
+    ESurfaceTypeT4 as T4S)
+from t4_geom_convert.Kernel.VectUtils import (scal, vdiff, vect, mag2,
+                                              vsum, renorm)
+
+
+def coords():
+    '''Generate a coordinate.'''
+    return floats(-10., 10., allow_nan=False, allow_infinity=False)
+
+
+@composite
+def points(draw):
+    '''Generate a point.'''
+    return draw(coords()), draw(coords()), draw(coords())
+
+
+@composite
+def directions(draw):
+    '''Generate a (not necessarily normalized) direction, which is often
+    parallel to one of the axes.'''
+    vec = draw(sampled_from([(1., 0., 0.), (0., 1., 0.), (0., 0., 1.)])
+               | points())
+    assume(mag2(vec) > 1e-2)
+    return vec
+
+
+@composite
+def surfaces(draw):
+    '''Generate a plane, a sphere or a cylinder.'''
+    typ = draw(sampled_from((MS.P, MS.S, MS.C)))
+    point, direction = draw(points()), draw(directions())
+    if typ == MS.P:
+        norm = sqrt(mag2(direction))
+        direction = tuple(x / norm for x in direction)
+        return SurfaceMCNP('', typ, (point, direction), ())
+    radius = draw(floats(0.1, 10.))
+    return SurfaceMCNP('', typ, (point, direction), (radius,))
+
+
+def inside(surf, side, point):
+    '''Return `True` if `point` lies on the `side` side of `surf`.'''
+    origin, direction = surf.param_surface
+    diff = vdiff(point, origin)
+    if surf.type_surface == MS.P:
+        value = scal(diff, direction)
+    elif surf.type_surface == MS.S:
+        value = mag2(diff) - surf.compl_param[0]**2
+    else:
+        value = (mag2(vect(diff, direction)) / mag2(direction)
+                 - surf.compl_param[0]**2)
+    return value * side > 0
+
+
+def evaluate(tree, surfs, point):
+    '''Return `True` if `point` lies in the region described by `tree`.'''
+    if isinstance(tree, int):
+        parts = surfs[abs(tree)]
+        sign = 1 if tree > 0 else -1
+        if sign < 0 or len(parts) == 1:
+            return all(inside(surf, sign * side, point)
+                       for surf, side in parts)
+        return any(inside(surf, side, point) for surf, side in parts)
+    operator, *args = tree
+    if operator == '*':
+        return all(evaluate(arg, surfs, point) for arg in args)
+    return any(evaluate(arg, surfs, point) for arg in args)
+
+
+@composite
+def geometries(draw):
+    '''Generate a dictionary of surfaces (possibly consisting of several
+    parts, like macrobodies) and an AST using them.'''
+    n_surfs = draw(integers(1, 6))
+    surfs = {}
+    for key in range(1, n_surfs + 1):
+        parts = draw(lists(tuples(surfaces(), sampled_from((-1, 1))),
+                           min_size=1, max_size=3))
+        surfs[key] = parts
+    leaves = integers(1, n_surfs).flatmap(
+        lambda key: sampled_from((key, -key)))
+    tree = draw(recursive(
+        leaves,
+        lambda children: tuples(sampled_from(('*', ':')),
+                                lists(children, min_size=1, max_size=4))
+        .map(lambda pair: (pair[0],) + tuple(pair[1])),
+        max_leaves=8))
+    if isinstance(tree, int):
+        tree = ('*', tree)
+    return surfs, tree
+
+
+@given(geometry=geometries(), samples=lists(points(), min_size=1,
+                                            max_size=50))
+def test_cell_bbox(geometry, samples):
+    '''Test that the points in a cell lie in its bounding box.'''
+    surfs, tree = geometry
+    box = cell_bbox(tree, surfs)
+    # also sample points close to the spheres and to the cylinders
+    for surf, _ in (part for parts in surfs.values() for part in parts):
+        if surf.compl_param:
+            origin, radius = surf.param_surface[0], surf.compl_param[0]
+            samples.extend(vsum(origin, renorm(point, 0.999 * radius))
+                           for point in samples[:10] if mag2(point) > 0.)
+    for point in samples:
+        if evaluate(tree, surfs, point):
+            assert all(low <= coord <= high for low, coord, high
+                       in zip(box.lows, point, box.highs))
+
+
+@given(point=tuples(floats(-1., 3.), floats(-2., 1.), floats(-1e3, 5.)),
+       angles=tuples(floats(0., 6.3), floats(0., 6.3)), shift=points())
+def test_transformed(point, angles, shift):
+    '''Test that the image of a point in a box lies in the transformed box,
+    and that the inverse transformation brings it back.'''
+    from math import cos, sin
+    cos_a, sin_a = cos(angles[0]), sin(angles[0])
+    cos_b, sin_b = cos(angles[1]), sin(angles[1])
+    # rotation matrix, as a product of two rotations about the z and x axes
+    rows = [(cos_a, -sin_a, 0.),
+            (sin_a * cos_b, cos_a * cos_b, -sin_b),
+            (sin_a * sin_b, cos_a * sin_b, cos_b)]
+    trpl = tuple(shift) + tuple(rows[i][j] for j in range(3) for i in range(3))
+    box = BoundingBox((-1., -2., -INF), (3., 1., 5.))
+    image = tuple(shift[i] + scal(rows[i], point) for i in range(3))
+    transformed = box.transformed(trpl)
+    assert all(low - 1e-9 <= x <= high + 1e-9 for low, x, high
+               in zip(transformed.lows, image, transformed.highs))
+    back = transformed.inverse_transformed(trpl)
+    assert all(low - 1e-9 <= x <= high + 1e-9 for low, x, high
+               in zip(back.lows, point, back.highs))
+
+
+@composite
+def t4_surfaces(draw):
+    '''Generate a TRIPOLI-4 plane, sphere or cylinder.'''
+    typ = draw(sampled_from((T4S.PLANEX, T4S.PLANEY, T4S.PLANEZ, T4S.PLANE,
+                             T4S.SPHERE, T4S.CYLX, T4S.CYLY, T4S.CYLZ,
+                             T4S.CYL)))
+    point, direction = draw(points()), draw(directions())
+    radius = draw(floats(0.1, 10.))
+    if typ in (T4S.PLANEX, T4S.PLANEY, T4S.PLANEZ):
+        return SurfaceT4(typ, (point[0],))
+    if typ == T4S.PLANE:
+        return SurfaceT4(typ, direction + (-scal(direction, point),))
+    if typ == T4S.SPHERE:
+        return SurfaceT4(typ, point + (radius,))
+    if typ == T4S.CYL:
+        return SurfaceT4(typ, point + (radius,) + direction)
+    return SurfaceT4(typ, point[:2] + (radius,))
+
+
+def t4_value(surf, point):
+    '''Return the value of the equation of `surf` at `point`.'''
+    typ, params = surf.type_surface, surf.param_surface
+    if typ in (T4S.PLANEX, T4S.PLANEY, T4S.PLANEZ):
+        return point[typ.value - T4S.PLANEX.value] - params[0]
+    if typ == T4S.PLANE:
+        return scal(params[:3], point) + params[3]
+    if typ == T4S.SPHERE:
+        return mag2(vdiff(point, params[:3])) - params[3]**2
+    if typ == T4S.CYL:
+        direction = params[4:7]
+        diff = vdiff(point, params[:3])
+        return mag2(vect(diff, direction)) / mag2(direction) - params[3]**2
+    axis = typ.value - T4S.CYLX.value
+    coords = point[:axis] + point[axis + 1:]
+    return sum((coord - center)**2
+               for coord, center in zip(coords, params[:2])) - params[2]**2
+
+
+@composite
+def t4_geometries(draw):
+    '''Generate a dictionary of TRIPOLI-4 surfaces and a list of `(key,
+    volume)` pairs, where the operands of a volume always come before the
+    volume itself.'''
+    surfs = dict(enumerate(draw(lists(t4_surfaces(), min_size=1,
+                                      max_size=5)), 1))
+    surf_ids = lists(integers(1, len(surfs)), max_size=3, unique=True)
+    volumes = []
+    for key in range(1, draw(integers(1, 6)) + 1):
+        ops = None
+        if key > 1 and draw(sampled_from([False, True])):
+            args = draw(lists(integers(1, key - 1), min_size=1, max_size=3,
+                              unique=True))
+            ops = (draw(sampled_from(['UNION', 'INTE'])), tuple(args))
+        volumes.append((key, VolumeT4(draw(surf_ids), draw(surf_ids),
+                                      ops=ops)))
+    return surfs, volumes
+
+
+def t4_inside(surfs, volumes, key, point):
+    '''Return `True` if `point` lies in volume `key`.'''
+    volume = volumes[key]
+    inside_surfs = (all(t4_value(surfs[surf], point) > 0
+                        for surf in volume.pluses)
+                    and all(t4_value(surfs[surf], point) < 0
+                            for surf in volume.minuses))
+    if volume.ops is None:
+        return inside_surfs
+    operator, args = volume.ops
+    if operator == 'INTE':
+        return inside_surfs and all(t4_inside(surfs, volumes, arg, point)
+                                    for arg in args)
+    return inside_surfs or any(t4_inside(surfs, volumes, arg, point)
+                               for arg in args)
+
+
+@given(geometry=t4_geometries(), samples=lists(points(), min_size=1,
+                                               max_size=50))
+def test_volume_boxes(geometry, samples):
+    '''Test that the points in a TRIPOLI-4 volume lie in its bounding box,
+    and that the boxes computed by :class:`VolumeBoxes` agree with
+    :meth:`~.VolumeT4.bounding_box`.'''
+    surfs, volumes = geometry
+    boxes = VolumeBoxes(surfs)
+    for key, volume in volumes:
+        box = boxes.add(key, volume)
+        assert box == volume.bounding_box(surfs, boxes.boxes)
+    # also sample points close to the spheres and to the cylinders
+    for surf in surfs.values():
+        if surf.type_surface in (T4S.SPHERE, T4S.CYL):
+            origin, radius = surf.param_surface[:3], surf.param_surface[3]
+            samples.extend(vsum(origin, renorm(point, 0.999 * radius))
+                           for point in samples[:10] if mag2(point) > 0.)
+    volumes = dict(volumes)
+    for point in samples:
+        for key, box in boxes.boxes.items():
+            if t4_inside(surfs, volumes, key, point):
+                assert all(low <= coord <= high for low, coord, high
+                           in zip(box.lows, point, box.highs))
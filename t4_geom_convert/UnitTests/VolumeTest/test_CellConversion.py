@@ -0,0 +1,183 @@
+'''Unit tests for the :mod:`~.CellConversion` module.'''
+
+import sys
+
+import numpy as np
+import pytest
+from hypothesis import given
+from hypothesis.strategies import (composite, integers, one_of, just,
+                                   recursive, sampled_from, tuples)
+
+from MIP.geom.semantics import Surface
+from t4_geom_convert.Kernel.FileHandlers.Parser.ParseMCNPGeometry import (
+    parse_geometry, same_ast)
+from t4_geom_convert.Kernel.Surface.CollectionDict import CollectionDict
+from t4_geom_convert.Kernel.Surface.ESurfaceTypeMCNP import (
+    ESurfaceTypeMCNP as MS)
+from t4_geom_convert.Kernel.Surface.SurfaceMCNP import SurfaceMCNP
+from t4_geom_convert.Kernel.Transformation.Translation import translation
+from t4_geom_convert.Kernel.Volume.CellConversion import CellConversion
+from t4_geom_convert.Kernel.Volume.CellConversionError import (
+    CellConversionError)
+from t4_geom_convert.Kernel.Volume.CellMCNP import CellMCNP
+from t4_geom_convert.Kernel.Volume.DictVolumeT4 import DictVolumeT4
+
+
+#: The MCNP-to-TRIPOLI-4 surface matching used by the equivalence tests;
+#: surfaces 5 and 6 are collections of surfaces (like macrobodies).
+MATCHING = {1: [1], 2: [2], 3: [3], 4: [4], 5: [5, 7], 6: [6, 8, 9]}
+
+#: Deeper than the default recursion limit.
+DEPTH = 3 * sys.getrecursionlimit()
+
+
+def make_conversion(geometries):
+    '''Return a :class:`CellConversion` object for the cells described by
+    `geometries`, a dictionary associating cell IDs to geometry strings.'''
+    cells = {key: CellMCNP(1, -1., parse_geometry(geom), 1., 0, None, None,
+                           False, [])
+             for key, geom in geometries.items()}
+    return CellConversion(DEPTH + 1, DEPTH + 1, DictVolumeT4(), {}, {}, cells)
+
+
+def convert(conv, key, n_surfs):
+    '''Expand the complements in cell `key` and convert it.'''
+    geometry = conv.pot_complement(conv.dic_cell_mcnp[key].geometry)
+    matching = {surf: [surf] for surf in range(1, n_surfs + 1)}
+    return conv.convert_cell(key, geometry, [key], matching,
+                             (n_surfs + 1, n_surfs + 2))
+
+
+def nested_geometry():
+    '''Return a geometry nested deeper than the recursion limit, made of the
+    surfaces from 1 to :data:`DEPTH`.'''
+    geom = ''.join('{} {}('.format(k, ': ' if k % 2 == 0 else '')
+                   for k in range(1, DEPTH))
+    return geom + str(DEPTH) + ')' * (DEPTH - 1)
+
+
+def test_nested_parentheses():
+    '''Test that deeply nested geometries do not hit the recursion limit.'''
+    conv = make_conversion({1: nested_geometry()})
+    root = convert(conv, 1, DEPTH)
+    assert list(conv.dic_vol_t4[root].pluses) == [1]
+
+
+def test_nested_translation():
+    '''Test that deeply nested geometries are translated without hitting the
+    recursion limit, and in the same way as by :meth:`pot_transform`.'''
+    conv = make_conversion({1: nested_geometry()})
+    plane = SurfaceMCNP('', MS.P, ((0., 0., 0.), (0., 0., 1.)), ())
+    conv.dic_surf_mcnp = CollectionDict()
+    for key in range(1, DEPTH + 1):
+        conv.dic_surf_mcnp[key] = [(plane, 1)]
+    geometry = conv.dic_cell_mcnp[1].geometry
+    vectors = np.array([[1., 2., 3.], [0., 0., -1.]])
+    trees = conv.translate_geometry(geometry, vectors)
+    assert len(trees) == 2
+    for tree, vec in zip(trees, vectors.tolist()):
+        assert same_ast(tree, conv.pot_transform(geometry, translation(vec)))
+
+
+def test_complement_chain():
+    '''Test that long chains of cell complements do not hit the recursion
+    limit, and that they are expanded correctly.'''
+    geometries = {key: '-{} #{}'.format(key, key + 1)
+                  for key in range(1, DEPTH)}
+    geometries[DEPTH] = '-{}'.format(DEPTH)
+    conv = make_conversion(geometries)
+    geometry = conv.pot_complement(conv.dic_cell_mcnp[DEPTH - 2].geometry)
+    # -(n-2) #(-(n-1) #(-n)) = -(n-2) (n-1 : -n)
+    assert geometry == ('*', Surface(-(DEPTH - 2)),
+                        (':', Surface(DEPTH - 1), Surface(-DEPTH)))
+    assert convert(conv, 1, DEPTH) is not None
+
+
+def test_complement_cache():
+    '''Test that complemented cells are expanded once and that their
+    inverses are shared.'''
+    conv = make_conversion({1: '1 #3 : 2 #3', 2: '2 #1', 3: '-3 4', 4: '#2'})
+    geometries = {key: conv.pot_complement(conv.dic_cell_mcnp[key].geometry)
+                  for key in range(1, 5)}
+    inverse3 = conv.complements[3][1]
+    assert inverse3 == (':', Surface(3), Surface(-4))
+    assert geometries[1][1][2] is inverse3
+    assert geometries[1][2][2] is inverse3
+    assert sorted(conv.complements) == [1, 2, 3]
+    # double complement: #2 = #(2 #1) = -2 : 1 #3 : 2 #3
+    assert geometries[4] == (':', Surface(-2)) + geometries[1][1:]
+
+
+def test_complement_cycle():
+    '''Test that circular cell complements are reported.'''
+    conv = make_conversion({1: '-1 #2', 2: '-2 #3', 3: '-3 #1'})
+    with pytest.raises(CellConversionError, match='2 -> 3 -> 1 -> 2'):
+        conv.pot_complement(conv.dic_cell_mcnp[1].geometry)
+
+
+@composite
+def surfaces(draw):
+    '''Generate a signed surface of :data:`MATCHING`, possibly with a
+    facet.'''
+    surface = draw(integers(1, 6))
+    facet = ''
+    if surface >= 5:
+        facet = draw(one_of(just(''), integers(1, 2).map('.{}'.format)))
+    return '{}{}{}'.format(draw(sampled_from(['', '-'])), surface, facet)
+
+
+@composite
+def combine_geometries(draw, children):
+    '''Combine geometries with unions, intersections and parentheses.'''
+    left, right = draw(tuples(children, children))
+    return '({}{}{})'.format(left, draw(sampled_from([' ', ' : '])), right)
+
+
+def convert_with(method, geom):
+    '''Convert `geom` with the given method of :class:`~.CellConversion`.
+
+    :returns: the root key, the next free key and the volumes
+    '''
+    conv = CellConversion(100, 100, DictVolumeT4(), {}, {}, {})
+    root = getattr(conv, method)(1, parse_geometry(geom), [1], MATCHING,
+                                 (10, 11))
+    volumes = [(key, str(val), val.comment())
+               for key, val in conv.dic_vol_t4.items()]
+    return root, conv.new_cell_key, volumes
+
+
+@given(geom=recursive(surfaces(), combine_geometries, max_leaves=12))
+def test_fused_conversion(geom):
+    '''Test that the single-pass conversion yields the same volumes, with
+    the same keys, as the multi-pass conversion.'''
+    try:
+        multipass = convert_with('convert_cell_multipass', geom)
+    except TypeError:
+        # the multi-pass conversion fails on empty intersections nested
+        # inside other nodes
+        return
+    assert convert_with('convert_cell', geom) == multipass
+
+
+@pytest.mark.parametrize('geom,equivalent', [
+    ('(1 -1) : 2', '2'),
+    ('3 (1 -1 : 2)', '3 2'),
+    ('3 (1 -1 : 2 -2)', '3 1 -1'),
+    ('(1 -1 : 2 -2) : 3 4', '3 4'),
+])
+def test_nested_empty_intersections(geom, equivalent):
+    '''Test the conversion of cells containing empty intersections below
+    the root of the AST.'''
+    conv = CellConversion(100, 100, DictVolumeT4(), {}, {}, {})
+    root = conv.convert_cell(1, parse_geometry(geom), [1], MATCHING, (10, 11))
+    ref_conv = CellConversion(100, 100, DictVolumeT4(), {}, {}, {})
+    ref_root = ref_conv.convert_cell(1, parse_geometry(equivalent), [1],
+                                     MATCHING, (10, 11))
+    if ref_root is None:
+        assert root is None
+        return
+    volume = conv.dic_vol_t4[root]
+    ref_volume = ref_conv.dic_vol_t4[ref_root]
+    assert sorted(volume.pluses) == sorted(ref_volume.pluses)
+    assert sorted(volume.minuses) == sorted(ref_volume.minuses)
+    assert (volume.ops is None) == (ref_volume.ops is None)
@@ -0,0 +1,126 @@
+'''Unit tests for the :mod:`~.DictVolumeT4` module.'''
+# pylint: disable=no-value-for-parameter
+
+from collections import OrderedDict
+
+from hypothesis import given
+from hypothesis.strategies import (composite, lists, integers, sets,
+                                   sampled_from, dictionaries)
+
+from t4_geom_convert.Kernel.Volume.DictVolumeT4 import (DictVolumeT4,
+                                                        renumbering_table)
+from t4_geom_convert.Kernel.Volume.VolumeT4 import VolumeT4
+
+
+@composite
+def volume_dicts(draw):
+    '''Generate an ordered dictionary of random volumes, whose operands refer
+    to volumes that were inserted before them.'''
+    n_volumes = draw(integers(1, 20))
+    keys = draw(lists(integers(1, 1000), min_size=n_volumes,
+                      max_size=n_volumes, unique=True))
+    volumes = OrderedDict()
+    for i, key in enumerate(keys):
+        pluses = draw(sets(integers(1, 10), max_size=4))
+        minuses = draw(sets(integers(1, 10), max_size=4))
+        operator = draw(sampled_from((None, 'UNION', 'INTE')))
+        if operator is None or i == 0:
+            ops = None
+        else:
+            ops = (operator, tuple(draw(lists(sampled_from(keys[:i]),
+                                              min_size=1, max_size=3,
+                                              unique=True))))
+        volumes[key] = VolumeT4(pluses, minuses, ops, idorigin=[(key % 3,)],
+                                fictive=draw(sampled_from((True, False))))
+    return volumes
+
+
+def reference_remove_empty(dic_volume):
+    '''A straightforward implementation of the removal of empty cells, on a
+    dictionary of :class:`~.VolumeT4` objects.'''
+    removed = set()
+    to_remove = [key for key, val in dic_volume.items()
+                 if val.empty() and (val.ops is None or val.ops[0] != 'UNION')]
+    while to_remove:
+        for key in to_remove:
+            del dic_volume[key]
+        removed |= set(to_remove)
+        to_remove = []
+        for key, val in dic_volume.items():
+            if val.ops is None:
+                continue
+            if val.ops[0] == 'INTE' and any(x in removed for x in val.ops[1]):
+                to_remove.append(key)
+            elif val.ops[0] == 'UNION':
+                new_args = tuple(cell for cell in val.ops[1]
+                                 if cell not in removed)
+                val.ops = (val.ops[0], new_args) if new_args else None
+    return removed
+
+
+def as_strings(volumes):
+    '''Return the TRIPOLI-4 representation of the volumes.'''
+    return [(key, str(val), val.comment()) for key, val in volumes.items()]
+
+
+def to_dict_volume(volumes):
+    '''Convert an ordered dictionary of volumes into a :class:`DictVolumeT4`.
+    '''
+    dic = DictVolumeT4()
+    for key, val in volumes.items():
+        dic[key] = val
+    return dic
+
+
+@given(volumes=volume_dicts())
+def test_roundtrip(volumes):
+    '''Test that the volumes stored in a :class:`DictVolumeT4` are read back
+    unchanged, also after copying and pickling.'''
+    import pickle
+    dic = to_dict_volume(volumes)
+    assert as_strings(dic) == as_strings(volumes)
+    assert as_strings(dic.copy()) == as_strings(volumes)
+    assert as_strings(pickle.loads(pickle.dumps(dic))) == as_strings(volumes)
+
+
+@given(volumes=volume_dicts())
+def test_remove_empty(volumes):
+    '''Test the vectorized removal of empty cells against the reference
+    implementation.'''
+    dic = to_dict_volume(volumes)
+    assert dic.remove_empty() == reference_remove_empty(volumes)
+    assert as_strings(dic) == as_strings(volumes)
+
+
+@given(volumes=volume_dicts(),
+       renumbering=dictionaries(integers(1, 10),
+                                integers(1, 10) | integers(-10, -1)))
+def test_renumber_surfaces(volumes, renumbering):
+    '''Test the vectorized surface renumbering, including renumberings that
+    flip the orientation of the surfaces (negative IDs).'''
+    renumbering = {surf: renumbering.get(surf, surf) for surf in range(11)}
+    dic = to_dict_volume(volumes)
+    dic.renumber_surfaces(renumbering_table(renumbering))
+    for val in volumes.values():
+        signed = ([renumbering[surf] for surf in val.pluses]
+                  + [-renumbering[surf] for surf in val.minuses])
+        val.pluses = set(surf for surf in signed if surf > 0)
+        val.minuses = set(-surf for surf in signed if surf < 0)
+    assert as_strings(dic) == as_strings(volumes)
+    used = set(surf for val in volumes.values() for surf in val.surface_ids())
+    assert dic.used_surfaces().tolist() == sorted(used)
+
+
+@given(volumes=volume_dicts(), offset=integers(0, 100))
+def test_merge_shifted(volumes, offset):
+    '''Test that merging shifts the keys and the operands.'''
+    dic = DictVolumeT4()
+    dic.merge_shifted(to_dict_volume(volumes), offset)
+    assert list(dic) == [key + offset for key in volumes]
+    for key, val in volumes.items():
+        ops = dic[key + offset].ops
+        if val.ops is None:
+            assert ops is None
+        else:
+            assert ops == (val.ops[0],
+                           tuple(arg + offset for arg in val.ops[1]))
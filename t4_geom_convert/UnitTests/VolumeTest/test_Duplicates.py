@@ -0,0 +1,90 @@
+'''Unit tests for the :mod:`~.Duplicates` module.'''
+# pylint: disable=no-value-for-parameter
+
+from itertools import product
+
+from hypothesis import given
+from hypothesis.strategies import (composite, frozensets, integers, lists,
+                                   sampled_from)
+
+from t4_geom_convert.Kernel.Volume.Duplicates import VolumeTable
+from t4_geom_convert.Kernel.Volume.VolumeT4 import VolumeT4
+
+N_SURFACES = 3
+
+
+@composite
+def volume_lists(draw):
+    '''Generate a list of `(key, volume)` pairs where the operands of a volume
+    always come before the volume itself; the last volume is not fictive.'''
+    surfaces = frozensets(integers(1, N_SURFACES), max_size=2)
+    n_volumes = draw(integers(1, 12))
+    volumes = []
+    for key in range(1, n_volumes + 1):
+        ops = None
+        if key > 1 and draw(sampled_from([False, True])):
+            args = draw(lists(integers(1, key - 1), min_size=1, max_size=3,
+                              unique=True))
+            ops = (draw(sampled_from(['UNION', 'INTE'])), tuple(args))
+        volumes.append((key, VolumeT4(draw(surfaces), draw(surfaces), ops=ops,
+                                      fictive=key < n_volumes)))
+    return volumes
+
+
+def inside(volumes, key, values):
+    '''Return `True` if the point where the surfaces take the given `values`
+    lies in volume `key`.'''
+    volume = volumes[key]
+    inside_surfs = (all(values[surf] for surf in volume.pluses)
+                    and not any(values[surf] for surf in volume.minuses))
+    if volume.ops is None:
+        return inside_surfs
+    operator, args = volume.ops
+    results = (inside(volumes, arg, values) for arg in args)
+    if operator == 'UNION':
+        return inside_surfs or any(results)
+    return inside_surfs and all(results)
+
+
+def test_inside():
+    '''Test the evaluator on volumes that have both surfaces and operands:
+    the surfaces are intersected with an intersection of the operands, and
+    united with a union of the operands.'''
+    volumes = {1: VolumeT4([1], []), 2: VolumeT4([2], []),
+               3: VolumeT4([3], [], ops=('UNION', (1, 2))),
+               4: VolumeT4([3], [], ops=('INTE', (1, 2)))}
+    values = {1: True, 2: False, 3: False}
+    assert inside(volumes, 3, values)
+    assert not inside(volumes, 4, values)
+    values = {1: False, 2: False, 3: True}
+    assert inside(volumes, 3, values)
+    assert not inside(volumes, 4, values)
+    values = {1: True, 2: True, 3: True}
+    assert inside(volumes, 4, values)
+
+
+@given(volumes=volume_lists())
+def test_share(volumes):
+    '''Test that sharing the fictive volumes preserves the geometry of the
+    written volumes, and that no two written fictive volumes are identical.'''
+    original = {key: VolumeT4(vol.pluses, vol.minuses, ops=vol.ops,
+                              fictive=vol.fictive)
+                for key, vol in volumes}
+    table = VolumeTable()
+    written = {key: vol for key, vol in volumes
+               if table.share(key, vol) is None}
+    assert table.n_checked == len(volumes) - 1
+    assert len(written) == len(volumes) - len(table.aliases)
+    structs = [(frozenset(vol.pluses), frozenset(vol.minuses),
+                None if vol.ops is None
+                else (vol.ops[0], frozenset(vol.ops[1])))
+               for vol in written.values() if vol.fictive]
+    assert len(set(structs)) == len(structs)
+    for vol in written.values():
+        if vol.ops is not None:
+            assert all(arg in written for arg in vol.ops[1])
+    for bits in product((False, True), repeat=N_SURFACES):
+        values = dict(enumerate(bits, 1))
+        for key in written:
+            assert (inside(written, key, values)
+                    == inside(original, key, values))
@@ -0,0 +1,139 @@
+'''Unit tests for the :mod:`~.PlanePruning` module.'''
+# pylint: disable=no-value-for-parameter
+
+from itertools import combinations, product
+from math import sqrt
+
+from hypothesis import given
+from hypothesis.strategies import composite, integers, lists, tuples
+
+from t4_geom_convert.Kernel.Surface.SurfaceT4 import SurfaceT4
+from t4_geom_convert.Kernel.Surface.ESurfaceTypeT4 import (
+    ESurfaceTypeT4 as T4S)
+from t4_geom_convert.Kernel.Volume.PlanePruning import (
+    PlanePruner, interior_point, redundant_half_spaces, solve_lp)
+from t4_geom_convert.Kernel.Volume.VolumeT4 import VolumeT4
+from t4_geom_convert.Kernel.VectUtils import mixed, scal
+
+
+#: Sample points for the membership tests; they never lie on the planes
+#: generated by :func:`half_spaces`.
+SAMPLES = [(x + 0.0137, y + 0.0291, z + 0.0419)
+           for x, y, z in product([k / 2. for k in range(-8, 9)], repeat=3)]
+
+
+@composite
+def half_spaces(draw):
+    '''Generate a half-space with a unit normal, proportional to a vector
+    with small integer components, and an integer offset.'''
+    normal = draw(tuples(integers(-2, 2), integers(-2, 2), integers(-2, 2))
+                  .filter(any))
+    norm = sqrt(sum(coeff * coeff for coeff in normal))
+    return (tuple(coeff / norm for coeff in normal),
+            float(draw(integers(-3, 3))))
+
+
+def inside(constraints, point):
+    '''Return `True` if `point` lies in all the `constraints`.'''
+    return all(scal(normal, point) <= offset
+               for normal, offset in constraints)
+
+
+def brute_force_max(constraints, objective, size):
+    '''Maximize ``objective.x`` over the `constraints` and the cube of side
+    ``2 * size``, by enumerating the vertices.'''
+    box = [(tuple(float(sign * (i == axis)) for i in range(3)), size)
+           for axis, sign in product(range(3), (1, -1))]
+    constraints = constraints + box
+    best = None
+    for triple in combinations(constraints, 3):
+        (n_1, d_1), (n_2, d_2), (n_3, d_3) = triple
+        det = mixed(n_1, n_2, n_3)
+        if abs(det) < 1e-9:
+            continue
+        # Cramer's rule
+        point = tuple(mixed(*[[d_1, d_2, d_3] if col == axis else
+                              [n_1[col], n_2[col], n_3[col]]
+                              for col in range(3)]) / det
+                      for axis in range(3))
+        if all(scal(normal, point) <= offset + 1e-7
+               for normal, offset in constraints):
+            value = scal(objective, point)
+            best = value if best is None else max(best, value)
+    return best
+
+
+@given(constraints=lists(half_spaces(), max_size=6),
+       objective=half_spaces())
+def test_solve_lp(constraints, objective):
+    '''Test the solution of linear programs against the enumeration of the
+    vertices.'''
+    point = solve_lp(constraints, objective[0], (-10., -10., -10.),
+                     (10., 10., 10.))
+    expected = brute_force_max(constraints, objective[0], 10.)
+    if expected is None:
+        assert point is None
+        return
+    assert point is not None
+    assert abs(scal(objective[0], point) - expected) < 1e-6
+    assert all(scal(normal, point) <= offset + 1e-6
+               for normal, offset in constraints)
+
+
+@given(constraints=lists(half_spaces(), min_size=1, max_size=8))
+def test_redundant_half_spaces(constraints):
+    '''Test that removing the redundant half-spaces does not change their
+    intersection, and that all the redundant half-spaces are removed.'''
+    labelled = list(enumerate(constraints))
+    redundant = redundant_half_spaces(labelled)
+    kept = [constraint for label, constraint in labelled
+            if label not in redundant]
+    for point in SAMPLES:
+        assert inside(kept, point) == inside(constraints, point)
+    if interior_point(constraints) is None:
+        assert not redundant
+        return
+    # the remaining half-spaces are all necessary
+    for index, (normal, offset) in enumerate(kept):
+        others = kept[:index] + kept[index + 1:]
+        assert brute_force_max(others, normal, 100.) > offset + 1e-6
+
+
+def test_lattice_element():
+    '''Test the pruning of a lattice element that inherits the bounding
+    planes of its parent cell and a duplicate plane.'''
+    surfaces = {1: SurfaceT4(T4S.PLANEX, [0.]),
+                2: SurfaceT4(T4S.PLANEX, [1.]),
+                3: SurfaceT4(T4S.PLANEY, [0.]),
+                4: SurfaceT4(T4S.PLANEY, [1.]),
+                # parent cell
+                5: SurfaceT4(T4S.PLANEX, [-10.]),
+                6: SurfaceT4(T4S.PLANE, [1., 1., 0., -30.]),
+                # duplicate of 2, with a different normalization
+                7: SurfaceT4(T4S.PLANE, [-2., 0., 0., 2.]),
+                8: SurfaceT4(T4S.SPHERE, [0., 0., 0., 0.5])}
+    pruner = PlanePruner(surfaces)
+    volume = VolumeT4([1, 3, 5, 7], [2, 4, 6, 8])
+    assert pruner.prune_volume(1, volume) == 3
+    # either of the duplicate planes is kept
+    assert volume.pluses - {7} == {1, 3}
+    assert volume.minuses - {2} == {4, 8}
+    assert len(volume.pluses) + len(volume.minuses) == 5
+    assert pruner.report[1] == (8, 5)
+    # the same planes are not tested again
+    assert pruner.prune_volume(2, VolumeT4([1, 3, 5, 7], [2, 4, 6])) == 3
+    assert len(pruner.memo) == 1
+
+
+def test_empty_volume():
+    '''Test that the empty volumes (like the auxiliary volumes of unions) are
+    left untouched.'''
+    surfaces = {1: SurfaceT4(T4S.PLANEX, [1.]),
+                2: SurfaceT4(T4S.PLANEX, [-1.]),
+                3: SurfaceT4(T4S.PLANEY, [0.])}
+    pruner = PlanePruner(surfaces)
+    for pluses in ([1], [1, 3]):
+        volume = VolumeT4(pluses, [2])
+        assert pruner.prune_volume(1, volume) == 0
+        assert volume.pluses == set(pluses)
+        assert volume.minuses == {2}
@@ -0,0 +1,106 @@
+'''Unit tests for the :mod:`~.Simplification` module.'''
+# pylint: disable=no-value-for-parameter
+
+from itertools import product
+
+from hypothesis import given
+from hypothesis.strategies import (composite, integers, just, one_of,
+                                   recursive, sampled_from, tuples)
+
+from MIP.geom.semantics import Surface
+from t4_geom_convert.Kernel.FileHandlers.Parser.ParseMCNPGeometry import (
+    parse_geometry)
+from t4_geom_convert.Kernel.Volume.Simplification import Simplifier
+
+
+@composite
+def surfaces(draw):
+    '''Generate a signed surface among a few ones, possibly a facet.'''
+    surface = draw(integers(1, 4))
+    facet = draw(one_of(just(''), just('.1')))
+    return '{}{}{}'.format(draw(sampled_from(['', '-'])), surface, facet)
+
+
+@composite
+def combine_geometries(draw, children):
+    '''Combine geometries with unions, intersections and parentheses.'''
+    left, right = draw(tuples(children, children))
+    return '({}{}{})'.format(left, draw(sampled_from([' ', ' : '])), right)
+
+
+def geometries():
+    '''Generate a cell geometry.'''
+    return recursive(surfaces(), combine_geometries, max_leaves=16)
+
+
+def atoms(tree):
+    '''Return the set of the unsigned surfaces and facets of `tree`.'''
+    if isinstance(tree, Surface):
+        return {(abs(tree.surface), tree.sub)}
+    return set().union(*(atoms(arg) for arg in tree[1:]))
+
+
+def evaluate(tree, values):
+    '''Evaluate `tree`, given the truth values of its unsigned surfaces.'''
+    if isinstance(tree, Surface):
+        value = values[abs(tree.surface), tree.sub]
+        return value if tree.surface > 0 else not value
+    results = (evaluate(arg, values) for arg in tree[1:])
+    return all(results) if tree[0] == '*' else any(results)
+
+
+def size(tree):
+    '''Return the number of nodes of `tree`.'''
+    if isinstance(tree, Surface):
+        return 1
+    return 1 + sum(size(arg) for arg in tree[1:])
+
+
+def check_equivalent(tree, simplified):
+    '''Check that `tree` and `simplified` have the same truth table.'''
+    keys = list(atoms(tree) | atoms(simplified))
+    for bits in product((False, True), repeat=len(keys)):
+        values = dict(zip(keys, bits))
+        assert evaluate(tree, values) == evaluate(simplified, values)
+
+
+@given(geom=geometries(), max_terms=sampled_from([0, 16]))
+def test_equivalent(geom, max_terms):
+    '''Test that the simplified geometries are equivalent to the original
+    ones, and not larger.'''
+    tree = parse_geometry(geom)
+    simplifier = Simplifier(max_terms)
+    simplified = simplifier.simplify(tree, key=1)
+    check_equivalent(tree, simplified)
+    before, after = simplifier.report[1]
+    assert before == size(tree)
+    assert after == size(simplified)
+    assert after <= before
+
+
+def test_shared_subtrees():
+    '''Test that identical subtrees are shared and that duplicate operands are
+    removed, whatever their order.'''
+    simplifier = Simplifier()
+    first = simplifier.simplify(parse_geometry('(1 : 2) (3 : -4)'))
+    second = simplifier.simplify(parse_geometry('(-4 : 3) (2 : 1) 5'))
+    assert second[1] is first[2]
+    assert second[2] is first[1]
+    assert simplifier.simplify(parse_geometry('(1 2 : 3) (2 1 : 3)')) == (
+        ':', ('*', Surface(1), Surface(2)), Surface(3))
+
+
+def test_normal_form():
+    '''Test that the normal-form factoring finds simplifications that the
+    local rules miss.'''
+    geom = '(1 : 2) (1 : 3) (2 : 3)'
+    local = Simplifier().simplify(parse_geometry(geom))
+    factored = Simplifier(16).simplify(parse_geometry(geom))
+    assert size(factored) < size(local)
+    check_equivalent(parse_geometry(geom), factored)
+
+
+def test_empty():
+    '''Test that empty cells are replaced with an empty intersection.'''
+    tree = Simplifier().simplify(parse_geometry('1 (2 : 3) -1'))
+    assert tree == ('*', Surface(1), Surface(-1))
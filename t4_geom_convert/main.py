@@ -7,16 +7,25 @@ Created on 6 févr. 2019
 '''
 import sys
 import argparse
+from collections import OrderedDict
 from datetime import datetime
 
 from MIP import mip
+from MIP.geom.composition import get_material_composition
 
 from . import __version__
 from .Kernel.FileHandlers.Writer.WriteT4Geometry import writeT4Geometry
 from .Kernel.FileHandlers.Writer.WriteT4Composition import writeT4Composition
 from .Kernel.FileHandlers.Writer.WriteT4GeomComp import writeT4GeomComp
 from .Kernel.FileHandlers.Writer.WriteT4BoundCond import writeT4BoundCond
+from .Kernel.FileHandlers.Parser.ParseMCNPGeometry import GEOMETRY_PARSERS
 from .Kernel.Volume.Lattice import parse_ranges
+from .Kernel.Surface.Duplicates import DEFAULT_TOLERANCE
+from .Kernel.Cache.ConversionCache import ConversionCache, default_cache_dir
+from .Kernel.Cache.IncrementalState import IncrementalState, fingerprint
+from .Kernel.Cache.IncrementalPatch import patch_output, PatchError
+from .Kernel.FileHandlers.ModelFile import ModelReader, ModelWriter
+from .Kernel.Instrumentation import STATS, phase, peak_memory
 
 
 def parse_lattice(lattice_list):
@@ -98,6 +107,7 @@ def conversion(args):
 
     start = datetime.now()
     print('started at: {}\n'.format(start.isoformat()))
+    STATS.reset()
 
     from pathlib import Path
     if args.output is not None:
@@ -105,24 +115,93 @@ def conversion(args):
     else:
         t4_output_filename = Path(args.input).with_suffix('.t4')
 
-    try:
-        mcnp_parser = mip.MIP(args.input, encoding=args.encoding)
-    except UnicodeError as err:
-        msg = ("Could not decode input file using encoding {!r}. Probably you "
-               "need to specify the encoding with the `-e' option."
-               .format(args.encoding))
-        raise UnicodeError(msg)
-
     lattice_params = parse_lattice(args.lattice)
-    with t4_output_filename.open('w') as ofile:
-        geom_conv = writeT4Geometry(mcnp_parser, lattice_params, args, ofile)
-        dic_surf_mcnp, dic_vol, mcnp_new_dict, skipped_cells = geom_conv
-        if not args.skip_compositions:
-            writeT4Composition(mcnp_parser, mcnp_new_dict, ofile)
-        if not args.skip_geomcomp:
-            writeT4GeomComp(dic_vol, mcnp_new_dict, ofile)
-        if not args.skip_boundary_conditions:
-            writeT4BoundCond(dic_surf_mcnp, ofile)
+    if args.cache and args.incremental:
+        raise ValueError('the --cache and --incremental options are mutually '
+                         'exclusive')
+    if args.from_model and (args.cache or args.incremental
+                            or args.dump_model is not None):
+        raise ValueError('the --from-model option is incompatible with the '
+                         '--cache, --incremental and --dump-model options')
+    if args.dump_model is not None and args.cache:
+        raise ValueError('the --dump-model and --cache options are mutually '
+                         'exclusive')
+
+    if args.from_model:
+        with phase('parse'):
+            mcnp_parser = None
+            model = ModelReader(args.input)
+    else:
+        try:
+            with phase('parse'):
+                mcnp_parser = mip.MIP(args.input, encoding=args.encoding)
+        except UnicodeError as err:
+            msg = ("Could not decode input file using encoding {!r}. Probably "
+                   "you need to specify the encoding with the `-e' option."
+                   .format(args.encoding))
+            raise UnicodeError(msg)
+        model = (ModelWriter(args.dump_model) if args.dump_model is not None
+                 else None)
+    if model is not None:
+        materials = model.fetch(
+            'mcnp_materials', lambda: get_material_composition(mcnp_parser))
+    else:
+        materials = None
+    if args.cache:
+        cache_dir = (Path(args.cache_dir) if args.cache_dir is not None
+                     else default_cache_dir())
+        cache = ConversionCache.from_parser(
+            cache_dir, mcnp_parser, version=__version__,
+            max_size=int(args.cache_max_size * 1024**2))
+    else:
+        cache = None
+    patched = None
+    if args.incremental:
+        state_filename = t4_output_filename.with_name(
+            t4_output_filename.name + '.incr')
+        state = IncrementalState.load(state_filename, __version__)
+        changes = state.update_cards(mcnp_parser)
+        print('incremental conversion: {} modified cards, {} added or removed '
+              'cards\n'.format(*map(len, changes)))
+        options = fingerprint(
+            args.lattice, args.encoding, args.geometry_parser, args.simplify,
+            args.simplify_max_terms, args.prune_planes, args.bounding_boxes,
+            args.skip_deduplication, args.dedup_tolerance,
+            args.skip_volume_deduplication, args.skip_compositions,
+            args.skip_geomcomp, args.skip_boundary_conditions)
+        try:
+            with phase('patch'):
+                patched = patch_output(state, mcnp_parser, t4_output_filename,
+                                       changes, options, args, lattice_params)
+        except PatchError as err:
+            print('incremental conversion: converting the whole deck ({})\n'
+                  .format(err))
+            state.clear_index()
+    else:
+        state = None
+    if patched is None:
+        with t4_output_filename.open('w') as ofile:
+            geom_conv = writeT4Geometry(mcnp_parser, lattice_params, args,
+                                        ofile, cache, state, model)
+            (dic_surf_mcnp, vol_origins, mcnp_new_dict,
+             skipped_cells) = geom_conv
+            with phase('compositions'):
+                if not args.skip_compositions:
+                    writeT4Composition(mcnp_parser, mcnp_new_dict, ofile,
+                                       materials)
+                if not args.skip_geomcomp:
+                    writeT4GeomComp(vol_origins, mcnp_new_dict, ofile)
+                if not args.skip_boundary_conditions:
+                    writeT4BoundCond(dic_surf_mcnp, ofile)
+        if state is not None:
+            state.record_output(t4_output_filename, options, skipped_cells)
+    else:
+        skipped_cells = state.skipped_cells
+        print('incremental conversion: rewrote {} SURF and {} VOLU records'
+              .format(*patched))
+
+    if state is not None:
+        state.save(state_filename)
 
     if skipped_cells:
         print('\nNOTE: the following cells have been omitted from the '
@@ -133,6 +212,31 @@ def conversion(args):
     elapsed = end - start
     print('\nfinished at: {}'.format(end.isoformat()))
     print('elapsed time: {} s'.format(elapsed.total_seconds()))
+    peak = peak_memory()
+    if peak is not None:
+        peak_self, peak_children = peak
+        msg = 'peak memory: {:.1f} MiB'.format(peak_self)
+        if peak_children:
+            msg += ' (worker processes: {:.1f} MiB)'.format(peak_children)
+        print(msg)
+
+    if args.profile:
+        print('\n' + STATS.format_table())
+    if args.stats_json is not None:
+        write_stats_json(args.stats_json, args)
+
+
+def write_stats_json(filename, args):
+    '''Write the measurements of the conversion phases (see
+    :mod:`~.Instrumentation`) to a JSON file.'''
+    import json
+    stats = OrderedDict()
+    stats['input'] = str(args.input)
+    stats['version'] = __version__
+    stats['jobs'] = args.jobs
+    stats.update(STATS.as_dict())
+    with open(filename, 'w') as json_file:
+        json.dump(stats, json_file, indent=2)
 
 
 def parse_args(argv):
@@ -160,6 +264,12 @@ def parse_args(argv):
                            help='encoding of the input file', default='utf-8')
     g_general.add_argument('--skip-deduplication', action='store_true',
                            help='skip deduplication of surfaces')
+    g_general.add_argument('--skip-volume-deduplication', action='store_true',
+                           help='skip sharing of identical fictive volumes')
+    g_general.add_argument('--dedup-tolerance', metavar='TOL', type=float,
+                           default=DEFAULT_TOLERANCE,
+                           help='merge surfaces whose canonical parameters '
+                           'differ by at most TOL (default: %(default)s)')
     g_general.add_argument('--skip-compositions', action='store_true',
                            help='skip conversion of the compositions')
     g_general.add_argument('--skip-geomcomp', action='store_true',
@@ -167,10 +277,84 @@ def parse_args(argv):
                            'association')
     g_general.add_argument('--skip-boundary-conditions', action='store_true',
                            help='skip conversion of the boundary conditions')
-    g_general.add_argument('--cache', action='store_true',
-                           help='read/write surfaces, cells etc. from a disk '
-                           'cache (avoids parsing, mostly for debug)',
-                           default=False)
+    g_general.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                           help='parse the cards and convert the cells '
+                           'using N worker processes')
+    g_general.add_argument('--geometry-parser', choices=GEOMETRY_PARSERS,
+                           default='fast',
+                           help='parser for the geometry of the MCNP cells: '
+                           'the built-in precedence parser (fast), the TatSu '
+                           'grammar (tatsu) or both, checking that they '
+                           'agree (check) (default: %(default)s)')
+    g_general.add_argument('--simplify', action='store_true',
+                           help='simplify the geometry of the cells with the '
+                           'laws of Boolean algebra before converting them, '
+                           'and report the reduction of the number of nodes')
+    g_general.add_argument('--simplify-max-terms', metavar='N', type=int,
+                           default=0,
+                           help='with --simplify, also expand the nodes whose '
+                           'disjunctive/conjunctive normal form has at most N '
+                           'terms, and factor them again (default: '
+                           '%(default)s, disabled)')
+    g_general.add_argument('--prune-planes', action='store_true',
+                           help='remove the plane half-spaces that are '
+                           'implied by the other planes of the same volume, '
+                           'and report the number of surface tests saved')
+    g_general.add_argument('--bounding-boxes', action='store_true',
+                           help='write a conservative axis-aligned bounding '
+                           'box for each volume as a comment')
+
+    # cache args
+    g_cache = parser.add_argument_group('arguments for the conversion cache')
+    g_cache.add_argument('--cache', action='store_true',
+                         help='read/write the intermediate results of the '
+                         'conversion (parsed cells, surfaces, developed '
+                         'cells) from/to a disk cache; the cache is '
+                         'invalidated when the input file, the converter '
+                         'version or the relevant options change',
+                         default=False)
+    g_cache.add_argument('--cache-dir', metavar='DIR', default=None,
+                         help='directory for the conversion cache (default: '
+                         '$XDG_CACHE_HOME/t4_geom_convert)')
+    g_cache.add_argument('--cache-max-size', metavar='MB', type=float,
+                         default=ConversionCache.DEFAULT_MAX_SIZE / 1024**2,
+                         help='maximum size of the conversion cache, in MB; '
+                         'the least recently used artifacts are evicted '
+                         'first (default: %(default)s)')
+    g_cache.add_argument('--incremental', action='store_true',
+                         help='save an index of the output file next to it '
+                         '(with the .incr suffix); on the next run, if only '
+                         'surface and cell cards were modified, only the '
+                         'affected SURF and VOLU records are converted and '
+                         'rewritten, otherwise the whole deck is converted '
+                         'again; incompatible with --cache', default=False)
+
+    # model args
+    g_model = parser.add_argument_group('arguments for the parsed model '
+                                        'files')
+    g_model.add_argument('--dump-model', metavar='MODEL_FILE', default=None,
+                         help='write the parsed MCNP model (surfaces, cells '
+                         'and material compositions) to MODEL_FILE, in a '
+                         'compact binary format that can be read back with '
+                         '--from-model')
+    g_model.add_argument('--from-model', action='store_true',
+                         help='read the parsed model from MCNP_INPUT_FILE, '
+                         'which must have been written by --dump-model, '
+                         'instead of parsing an MCNP input file; the '
+                         'options that affect the parsing (--lattice, '
+                         '--geometry-parser, --encoding) are ignored',
+                         default=False)
+
+    # profiling args
+    g_profile = parser.add_argument_group('arguments for profiling the '
+                                          'conversion')
+    g_profile.add_argument('--profile', action='store_true',
+                           help='print the wall-clock time, the CPU time, '
+                           'the peak memory usage and the item counts of '
+                           'each phase of the conversion')
+    g_profile.add_argument('--stats-json', metavar='JSON_FILE', default=None,
+                           help='write the measurements of each phase of '
+                           'the conversion to JSON_FILE')
 
     # lattice args
     g_lattice = parser.add_argument_group('arguments for the conversion of '